@@ -1,4 +1,5 @@
 from math import sin, cos, pi, atan2, hypot
+import numpy as np
 import pg
 import random
 
@@ -85,15 +86,22 @@ class Window(pg.Window):
         solid = (a - b) | c | d
         self.mesh = solid.mesh()
         self.model = Model(400, 400, 100)
-    def set_matrix(self, x, y, z, a):
-        matrix = pg.Matrix().rotate((0, 1, 0), a).translate((x, y, z))
-        inverse = pg.Matrix().rotate((0, 1, 0), -a)
-        self.context.light_direction = inverse * pg.normalize((1, 1, 1))
-        self.context.camera_position = matrix.inverse() * self.wasd.position
-        matrix = self.wasd.get_matrix(matrix)
-        matrix = matrix.perspective(65, self.aspect, 0.1, 1000)
+    def set_matrix(self, matrix, light_direction, camera_position):
+        self.context.light_direction = light_direction
+        self.context.camera_position = camera_position
         self.context.matrix = matrix
-        # mesh.draw(self.context)
+    def bot_matrices(self, positions, angles):
+        models = pg.MatrixArray.identity(len(angles)).rotate(
+            (0, 1, 0), angles).translate(positions)
+        inverses = pg.MatrixArray.identity(len(angles)).rotate(
+            (0, 1, 0), -angles)
+        light_directions = inverses.transform_vectors(pg.normalize((1, 1, 1)))
+        camera_positions = models.inverse().transform_points(
+            self.wasd.position)
+        matrices = self.wasd.get_matrix(models)
+        matrices = matrices.perspective(65, self.aspect, 0.1, 1000)
+        return zip(matrices, light_directions.tolist(),
+            camera_positions.tolist())
     def update(self, t, dt):
         self.clear()
         self.model.update(dt)
@@ -106,13 +114,16 @@ class Window(pg.Window):
         # draw target
         self.context.object_color = (1, 0, 0)
         x, z = bot.target
-        self.set_matrix(x, bot.y, z, 0)
+        target = self.bot_matrices([(x, bot.y, z)], np.zeros(1))[0]
+        self.set_matrix(*target)
         self.target.draw(self.context)
         # draw bots
         self.context.object_color = (0.4, 0.6, 0.8)
-        for bot in self.model.bots:
-            x, z = bot.position
-            self.set_matrix(x, bot.y, z, bot.angle)
+        bots = self.model.bots
+        positions = [(b.position[0], b.y, b.position[1]) for b in bots]
+        angles = np.array([b.angle for b in bots])
+        for args in self.bot_matrices(positions, angles):
+            self.set_matrix(*args)
             self.mesh.draw(self.context)
 
 if __name__ == "__main__":
@@ -0,0 +1,39 @@
+from OpenGL.GL import glFinish
+import numpy as np
+import pg
+import time
+
+# points per append and total points per run (3 floats per point)
+CHUNK = 100000
+TOTAL = 10000000
+
+class HostVertexBuffer(pg.VertexBuffer):
+    # the old growth path, copying through host memory
+    def resize(self, old_size, new_size):
+        self.resize_on_host(old_size, new_size)
+
+def run(name, vertex_buffer):
+    chunk = np.random.random((CHUNK, 3)).astype(np.float32)
+    start = time.time()
+    worst = 0
+    for _ in xrange(TOTAL // CHUNK):
+        t = time.time()
+        vertex_buffer.extend(chunk)
+        glFinish()
+        worst = max(worst, time.time() - t)
+    elapsed = time.time() - start
+    megabytes = TOTAL * 3 * 4 / 1e6
+    print '%8s %9.3fs %10.1f MB/s %9.1f ms worst append' % (
+        name, elapsed, megabytes / elapsed, worst * 1000)
+    vertex_buffer.delete()
+
+def main():
+    pg.App()
+    window = pg.Window(visible=False)
+    run('host', HostVertexBuffer())
+    run('device', pg.VertexBuffer())
+    run('paged', pg.PagedVertexBuffer())
+    window.close()
+
+if __name__ == '__main__':
+    main()
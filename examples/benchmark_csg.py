@@ -0,0 +1,54 @@
+import pg
+import time
+
+DETAILS = [1, 2, 3, 4, 5]
+# spheres in the boolean assembly
+COUNT = 32
+OPERATIONS = [
+    ('union', lambda a, b: a.union(b)),
+    ('difference', lambda a, b: a.difference(b)),
+    ('intersection', lambda a, b: a.intersection(b)),
+]
+
+def assembly():
+    spheres = [pg.Solid(pg.Sphere(3, 0.6, (i * 0.8, i % 3 * 0.5, i % 2 * 0.4)))
+        for i in xrange(COUNT)]
+    def eager():
+        result = spheres[0]
+        for sphere in spheres[1:]:
+            result = result.union(sphere)
+        return result
+    def lazy(processes):
+        result = spheres[0]
+        for sphere in spheres[1:]:
+            result = result | sphere
+        return result.evaluate(processes)
+    runs = [
+        ('eager chain', eager),
+        ('lazy serial', lambda: lazy(1)),
+        ('lazy parallel', lambda: lazy(None)),
+    ]
+    print
+    print 'union of %d spheres' % COUNT
+    for name, func in runs:
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        print '%14s %9d %9.3f' % (name, len(result.polygons), elapsed)
+
+def main():
+    print '%6s %9s %14s %9s %9s' % (
+        'detail', 'polygons', 'operation', 'result', 'seconds')
+    for detail in DETAILS:
+        a = pg.Solid(pg.Sphere(detail, 1))
+        b = pg.Solid(pg.Sphere(detail, 1, (0.5, 0.3, 0.2)))
+        for name, func in OPERATIONS:
+            start = time.time()
+            result = func(a, b)
+            elapsed = time.time() - start
+            print '%6d %9d %14s %9d %9.3f' % (detail, len(a.polygons), name,
+                len(result.polygons), elapsed)
+    assembly()
+
+if __name__ == '__main__':
+    main()
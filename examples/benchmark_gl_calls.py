@@ -0,0 +1,33 @@
+# counts the GL calls of a few frames; runs with a software driver too:
+# LIBGL_ALWAYS_SOFTWARE=1 python -m examples.benchmark_gl_calls
+import pg
+
+COUNT = 10
+FRAMES = 3
+
+def draw(window, context, sphere):
+    window.clear()
+    matrix = pg.Matrix().perspective(65, window.aspect, 0.1, 100)
+    for i in xrange(COUNT):
+        context.matrix = pg.Matrix().translate((i - COUNT / 2, 0, -10)) * matrix
+        sphere.draw(context)
+
+def main():
+    pg.App()
+    window = pg.Window(visible=False)
+    context = pg.Context(pg.SolidColorProgram())
+    sphere = pg.Sphere(2, 0.5, (0, 0, 0))
+    tracer = pg.GLTracer()
+    tracer.start()
+    for i in xrange(FRAMES):
+        draw(window, context, sphere)
+        frame = tracer.end_frame()
+        print frame.report()
+        print
+    tracer.stop()
+    # the first frame creates the buffers, the others only draw
+    tracer.assert_budget(draw_calls=COUNT, bytes_uploaded=0)
+    window.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+from pg import indexing, util
+import numpy as np
+import time
+
+SIZES = [10000, 1000000, 10000000]
+# the legacy indexer needs several GB of tuples beyond this size
+LEGACY_LIMIT = 1000000
+
+def legacy_index(*args):
+    data = util.interleave(*filter(None, args))
+    unique = list(util.distinct(data))
+    lookup = dict((x, i) for i, x in enumerate(unique))
+    indices = [lookup[x] for x in data]
+    return unique, indices
+
+def generate_terrain(vertex_count):
+    # triangle soup over a height field, each grid point is shared by
+    # roughly six triangles like an STL terrain mesh
+    n = max(2, int((vertex_count / 6) ** 0.5))
+    x, z = np.meshgrid(np.arange(n + 1), np.arange(n + 1))
+    y = np.sin(x * 0.1) * np.cos(z * 0.1)
+    grid = np.dstack((x, y, z)).astype(np.float32)
+    a = grid[:-1, :-1].reshape((-1, 3))
+    b = grid[:-1, 1:].reshape((-1, 3))
+    c = grid[1:, :-1].reshape((-1, 3))
+    d = grid[1:, 1:].reshape((-1, 3))
+    positions = np.hstack((a, c, b, b, c, d)).reshape((-1, 3))
+    normals = np.zeros_like(positions)
+    normals[:, 1] = 1
+    return positions[:vertex_count], normals[:vertex_count]
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+def main():
+    print '%10s %10s %10s %10s %8s' % (
+        'vertices', 'unique', 'legacy', 'numpy', 'type')
+    for size in SIZES:
+        positions, normals = generate_terrain(size)
+        data = np.hstack((positions, normals))
+        numpy_time, (vertices, indices) = timed(indexing.deduplicate, data)
+        if size <= LEGACY_LIMIT:
+            lists = map(tuple, positions.tolist())
+            normal_lists = map(tuple, normals.tolist())
+            legacy_time, _ = timed(legacy_index, lists, normal_lists)
+            legacy = '%9.3fs' % legacy_time
+        else:
+            legacy = 'skipped'
+        print '%10d %10d %10s %9.3fs %8s' % (
+            len(data), len(vertices), legacy, numpy_time, indices.dtype)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+from math import pi
+import numpy as np
+import pg
+
+SIZE = 100
+# seconds spent in each mode before switching
+DURATION = 5
+
+class Window(pg.Window):
+    def setup(self):
+        self.wasd = pg.WASD(self, speed=20)
+        self.wasd.look_at((-20, 20, -20), (SIZE / 2, 0, SIZE / 2))
+        self.sphere = pg.Sphere(2, 0.3, (0, 0, 0))
+        self.context = pg.Context(pg.DirectionalLightProgram())
+        self.instanced = pg.Context(pg.InstancedDirectionalLightProgram())
+        x, z = np.meshgrid(np.arange(SIZE), np.arange(SIZE))
+        self.grid = np.column_stack(
+            (x.ravel(), np.zeros(x.size), z.ravel())).astype(np.float32)
+        self.modes = ['loop', 'instanced']
+        self.mode = 0
+        self.mode_time = 0
+        self.frames = 0
+        self.draw_calls = 0
+    def positions(self):
+        x = self.grid[:, 0]
+        z = self.grid[:, 2]
+        positions = self.grid.copy()
+        positions[:, 1] = np.sin(self.t * pi / 2 + x * 0.3 + z * 0.2)
+        return positions
+    def draw_loop(self, matrix, positions):
+        self.context.camera_position = self.wasd.position
+        for x, y, z in positions.tolist():
+            model_matrix = pg.Matrix().translate((x, y, z))
+            self.context.model_matrix = model_matrix
+            self.context.matrix = matrix * model_matrix
+            self.sphere.draw(self.context)
+        return len(positions)
+    def draw_instanced(self, matrix, positions):
+        self.instanced.camera_position = self.wasd.position
+        self.instanced.matrix = matrix
+        transforms = pg.MatrixArray.identity(len(positions)).translate(
+            positions)
+        self.sphere.draw_instanced(self.instanced, transforms)
+        return 1
+    def report(self):
+        elapsed = self.t - self.mode_time
+        if self.frames:
+            print '%10s: %8d instances %8d draw calls %8.2f ms/frame' % (
+                self.modes[self.mode], len(self.grid),
+                self.draw_calls // self.frames, elapsed * 1000 / self.frames)
+        self.mode = (self.mode + 1) % len(self.modes)
+        self.mode_time = self.t
+        self.frames = 0
+        self.draw_calls = 0
+    def draw(self):
+        if self.t - self.mode_time > DURATION:
+            self.report()
+        self.clear()
+        matrix = self.wasd.get_matrix()
+        matrix = matrix.perspective(65, self.aspect, 0.1, 500)
+        positions = self.positions()
+        if self.modes[self.mode] == 'loop':
+            self.draw_calls += self.draw_loop(matrix, positions)
+        else:
+            self.draw_calls += self.draw_instanced(matrix, positions)
+        self.frames += 1
+
+def main():
+    pg.run(Window)
+
+if __name__ == "__main__":
+    main()
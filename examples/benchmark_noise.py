@@ -0,0 +1,36 @@
+import numpy as np
+import pg
+import time
+
+# points per measurement and octaves per point
+COUNT = 200000
+SCALAR_COUNT = 20000
+OCTAVES = 4
+
+def measure(name, count, func):
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    print '%24s %12.0f points/s' % (name, count / elapsed)
+
+def main():
+    noise = pg.Noise()
+    for dimensions in [2, 3, 4]:
+        scalar = getattr(noise, 'simplex%d' % dimensions)
+        array = getattr(noise, 'simplex%d_array' % dimensions)
+        points = np.random.uniform(-100, 100, (COUNT, dimensions))
+        rows = points[:SCALAR_COUNT].tolist()
+        measure('simplex%d scalar' % dimensions, SCALAR_COUNT,
+            lambda: [scalar(*(row + [OCTAVES])) for row in rows])
+        measure('simplex%d_array' % dimensions, COUNT,
+            lambda: array(points, OCTAVES))
+    size = 1024
+    xs = np.linspace(-100, 100, size)
+    ys = np.linspace(-100, 100, size)
+    measure('simplex2_grid 1 process', size * size,
+        lambda: noise.simplex2_grid(xs, ys, OCTAVES, processes=1))
+    measure('simplex2_grid all cores', size * size,
+        lambda: noise.simplex2_grid(xs, ys, OCTAVES))
+
+if __name__ == '__main__':
+    main()
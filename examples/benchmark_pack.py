@@ -0,0 +1,64 @@
+from pg.pack import Packer, estimate_size
+import random
+import time
+
+COUNTS = [100, 1000, 5000]
+MAX_SIZE = 1024
+
+class Node(object):
+    # the previous packer: a binary tree that restarts from scratch,
+    # doubling one side, whenever an attempt fails
+    def __init__(self, x, y, w, h):
+        self.x, self.y, self.w, self.h = x, y, w, h
+        self.right = self.down = None
+    def insert(self, w, h):
+        if self.right:
+            return self.right.insert(w, h) or self.down.insert(w, h)
+        if w <= self.w and h <= self.h:
+            self.right = Node(self.x + w, self.y, self.w - w, h)
+            self.down = Node(self.x, self.y + h, self.w, self.h - h)
+            return (self.x, self.y, w, h)
+
+def old_pack(sizes):
+    items = sorted(sizes, key=max, reverse=True)
+    tw, th = estimate_size(sizes)
+    while True:
+        node = Node(0, 0, tw, th)
+        result = [node.insert(w, h) for w, h in items]
+        if all(result):
+            tw = max(x + w for x, y, w, h in result)
+            th = max(y + h for x, y, w, h in result)
+            return [tw * th]
+        if tw <= th:
+            tw *= 2
+        else:
+            th *= 2
+
+def new_pack(sizes, max_size=None, rotate=False):
+    packer = Packer(max_size, rotate)
+    packer.pack(sizes)
+    packer.fix()
+    return [page.width * page.height for page in packer.pages]
+
+def measure(name, count, sizes, func):
+    start = time.time()
+    areas = func(sizes)
+    elapsed = time.time() - start
+    used = sum(w * h for w, h in sizes)
+    print '%24s %6d sprites %8.3fs %6.1f%% occupancy %4d pages' % (
+        name, count, elapsed, 100.0 * used / sum(areas), len(areas))
+
+def main():
+    random.seed(1)
+    for count in COUNTS:
+        sizes = [(random.randint(8, 64), random.randint(8, 64))
+            for _ in xrange(count)]
+        measure('binary tree', count, sizes, old_pack)
+        measure('maxrects', count, sizes, new_pack)
+        measure('maxrects rotate', count, sizes,
+            lambda x: new_pack(x, rotate=True))
+        measure('maxrects rotate %d' % MAX_SIZE, count, sizes,
+            lambda x: new_pack(x, MAX_SIZE, True))
+
+if __name__ == '__main__':
+    main()
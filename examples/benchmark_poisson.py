@@ -0,0 +1,61 @@
+from math import cos, pi, sin
+import pg
+import random
+import time
+
+SIZES = [25, 50, 100, 200]
+
+def old_poisson_disc(x1, y1, x2, y2, r, n):
+    # the previous sampler: dict grid, random.choice and list.remove
+    size = r / 2 ** 0.5
+    cells = {}
+    def key(x, y):
+        return (int((x - x1) // size), int((y - y1) // size))
+    def fits(x, y):
+        i, j = key(x, y)
+        for p in xrange(i - 2, i + 3):
+            for q in xrange(j - 2, j + 3):
+                point = cells.get((p, q))
+                if point and (point[0] - x) ** 2 + (point[1] - y) ** 2 < r * r:
+                    return False
+        return True
+    x, y = (x1 + x2) / 2.0, (y1 + y2) / 2.0
+    cells[key(x, y)] = (x, y)
+    active = [(x, y)]
+    while active:
+        px, py = random.choice(active)
+        for _ in xrange(n):
+            a = random.random() * 2 * pi
+            d = random.random() * r + r
+            x, y = px + cos(a) * d, py + sin(a) * d
+            if x < x1 or y < y1 or x > x2 or y > y2 or not fits(x, y):
+                continue
+            cells[key(x, y)] = (x, y)
+            active.append((x, y))
+            break
+        else:
+            active.remove((px, py))
+    return cells.values()
+
+def measure(name, size, func):
+    start = time.time()
+    count = len(func())
+    elapsed = time.time() - start
+    print '%10s %4d x %-4d %8d points %8.2fs %8.0f points/s' % (
+        name, size, size, count, elapsed, count / elapsed)
+
+def main():
+    for size in SIZES:
+        if size <= 100:
+            measure('old', size,
+                lambda: old_poisson_disc(0, 0, size, size, 1, 32))
+        measure('bridson', size,
+            lambda: pg.poisson_disc(0, 0, size, size, 1, 32, seed=1))
+        measure('tiled', size,
+            lambda: pg.poisson_disc(0, 0, size, size, 1, 32, seed=1,
+                tile_size=size / 4))
+    measure('3d', 30,
+        lambda: pg.poisson_sample((0, 0, 0), (30, 30, 30), 1, 32, seed=1))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+from OpenGL.GL import glFinish
+from PIL import Image
+import os
+import pg
+import random
+import tempfile
+import time
+
+COUNTS = [10000, 100000]
+FRACTIONS = [0.01, 0.1, 1.0]
+FRAMES = 20
+
+class OldBatch(object):
+    # the previous batch: rebuild and re-upload every sprite if any moved
+    def __init__(self, sheet):
+        self.sprites = []
+        self.vb = pg.StreamBuffer(5)
+        self.context = pg.Context(pg.TextureProgram())
+        self.context.sampler = sheet
+        self.context.position, self.context.uv = self.vb.slices(3, 2)
+    def append(self, sprite):
+        self.sprites.append(sprite)
+    def draw(self, matrix):
+        if not all(x.vertex_data for x in self.sprites):
+            data = []
+            for sprite in self.sprites:
+                data.extend(sprite.get_vertex_data())
+            self.first, self.count = self.vb.write(data)
+        self.context.matrix = matrix
+        self.context.draw(first=self.first, count=self.count)
+    def delete(self):
+        self.vb.delete()
+
+def run(name, batch, frame, count, fraction):
+    sprites = [frame(batch) for _ in xrange(count)]
+    for sprite in sprites:
+        sprite.position = (random.random() * 1000, random.random() * 1000)
+    matrix = pg.Matrix().orthographic(0, 1000, 0, 1000, -1, 1)
+    batch.draw(matrix)
+    moving = sprites[:int(count * fraction)]
+    glFinish()
+    start = time.time()
+    for i in xrange(FRAMES):
+        for sprite in moving:
+            sprite.rotation = i * 0.1
+        batch.draw(matrix)
+        glFinish()
+    elapsed = (time.time() - start) / FRAMES
+    print '%10s %7d sprites %5.1f%% moving %9.2f ms/frame' % (
+        name, count, fraction * 100, elapsed * 1000)
+    batch.delete()
+
+def main():
+    pg.App()
+    window = pg.Window(visible=False)
+    path = os.path.join(tempfile.mkdtemp(), 'star.png')
+    Image.new('RGBA', (16, 16), (255, 255, 255, 255)).save(path)
+    sheet = pg.SpriteSheet(0, path)
+    for count in COUNTS:
+        for fraction in FRACTIONS:
+            run('full', OldBatch(sheet), sheet.star, count, fraction)
+            run('quads', pg.SpriteBatch(sheet, False), sheet.star,
+                count, fraction)
+            run('instanced', pg.SpriteBatch(sheet, True), sheet.star,
+                count, fraction)
+    window.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,9 @@
-from collections import defaultdict
 from math import atan2
 import pg
 
 NAME = 'ESP_025735_2185'
 FONT = '/Library/Fonts/Arial.ttf'
 FLY = True
-STEP = 16
 HEIGHT = 1.8288 * 10
 SPEED = 1.34 * 500
 SHOW_INFO = False
@@ -41,18 +39,11 @@ class MainScene(pg.Scene):
         self.wasd = pg.WASD(self, speed=SPEED)
         self.dy = 0
     def get_height(self):
-        p = x, y, z = self.wasd.position
-        x, z = int(round(x / STEP)), int(round(z / STEP))
-        for i in xrange(x - 1, x + 2):
-            for j in xrange(z - 1, z + 2):
-                for v1, v2, v3 in self.lookup[(i, j)]:
-                    t = pg.ray_triangle_intersection(v1, v2, v3, p, (0, -1, 0))
-                    if t:
-                        return t
-                    t = pg.ray_triangle_intersection(v1, v2, v3, p, (0, 1, 0))
-                    if t:
-                        return -t
-        return None
+        x, y, z = self.wasd.position
+        h = self.bvh.height(x, z)
+        if h is None:
+            return None
+        return y - h
     def on_key(self, key, scancode, action, mods):
         if key == pg.KEY_SPACE and action == pg.PRESS:
             if self.dy == 0:
@@ -97,21 +88,16 @@ class Worker(pg.Worker):
         context = pg.Context(Program())
         font = pg.Font(self, 2, FONT, 24, (0, 0, 0, 1))
         self.message = 'loading triangle mesh'
-        mesh = pg.STL('examples/%s.stl' % NAME).center()
+        mesh = pg.load_stl('examples/%s.stl' % NAME).center()
         self.triangles = '%d triangles' % (len(mesh.positions) / 3)
         self.message = 'computing bounding box'
-        (x0, y0, z0), (x1, y1, z1) = pg.bounding_box(mesh.positions)
+        (x0, y0, z0), (x1, y1, z1) = mesh.bounding_box()
         context.uv0 = (x0, z0)
         context.uv1 = (x1, z1)
         self.message = 'generating vertex buffer'
         context.position = pg.VertexBuffer(mesh.positions)
-        self.message = 'generating height map'
-        p = mesh.positions
-        lookup = defaultdict(list)
-        for v1, v2, v3 in zip(p[::3], p[1::3], p[2::3]):
-            x, y, z = v1
-            x, z = int(round(x / STEP)), int(round(z / STEP))
-            lookup[(x, z)].append((v1, v2, v3))
+        self.message = 'building bounding volume hierarchy'
+        bvh = pg.BVH(mesh)
         self.message = 'loading brightness texture'
         context.sampler = pg.Texture(0, 'examples/%s.jpg' % NAME)
         self.message = 'loading normal texture'
@@ -119,7 +105,7 @@ class Worker(pg.Worker):
         self.result = {
             'font': font,
             'context': context,
-            'lookup': lookup,
+            'bvh': bvh,
         }
 
 class Window(pg.Window):
@@ -1,19 +1,20 @@
 from collections import defaultdict
 import colorsys
+import numpy as np
 import pg
 
-def noise(x, z):
-    a = pg.simplex2(-x * 0.01, -z * 0.01, 4)
-    b = pg.simplex2(x * 0.1, z * 0.1, 4)
+def noise(xs, zs):
+    a = pg.simplex2_grid(-xs * 0.01, -zs * 0.01, 4)
+    b = pg.simplex2_grid(xs * 0.1, zs * 0.1, 4)
     return (a + 1) * 16 + b / 10
 
-def generate_color(x, z):
+def generate_colors(xs, zs):
     m = 0.005
-    h = (pg.simplex2(x * m, z * m, 4) + 1) / 2
-    s = (pg.simplex2(-x * m, z * m, 4) + 1) / 2
-    v = (pg.simplex2(x * m, -z * m, 4) + 1) / 2
+    h = (pg.simplex2_grid(xs * m, zs * m, 4) + 1) / 2
+    s = (pg.simplex2_grid(-xs * m, zs * m, 4) + 1) / 2
+    v = (pg.simplex2_grid(xs * m, -zs * m, 4) + 1) / 2
     v = v * 0.5 + 0.5
-    return colorsys.hsv_to_rgb(h, s, v)
+    return h.tolist(), s.tolist(), v.tolist()
 
 class Window(pg.Window):
     def setup(self):
@@ -31,10 +32,13 @@ class Window(pg.Window):
         # generate height map
         height = {}
         colors = {}
-        for x in xrange(-size, size + 1):
-            for z in xrange(-size, size + 1):
-                height[(x, z)] = noise(x, z)
-                colors[(x, z)] = generate_color(x, z)
+        coords = np.arange(-size, size + 1, dtype=np.float64)
+        heights = noise(coords, coords).tolist()
+        h, s, v = generate_colors(coords, coords)
+        for i, x in enumerate(xrange(-size, size + 1)):
+            for j, z in enumerate(xrange(-size, size + 1)):
+                height[(x, z)] = heights[i][j]
+                colors[(x, z)] = colorsys.hsv_to_rgb(h[i][j], s[i][j], v[i][j])
         # generate triangles and track normals for all vertices
         for x in xrange(-size, size):
             for z in xrange(-size, size):
@@ -4,12 +4,17 @@ from .gl import *
 # use case: from pg.gl import *
 from . import gl
 
+from .bvh import (
+    BVH,
+)
+
 from .camera import (
     Camera,
 )
 
 from .core import (
     App,
+    ArrayMesh,
     async,
     call_after,
     Context,
@@ -18,13 +23,16 @@ from .core import (
     index,
     IndexBuffer,
     Mesh,
+    PagedVertexBuffer,
     poll_events,
     Program,
     run,
     Scene,
     Shader,
+    StreamBuffer,
     Texture,
     Ticker,
+    UniformBlock,
     VertexBuffer,
     VertexShader,
     Window,
@@ -37,6 +45,8 @@ from .csg import (
 
 from .font import (
     Font,
+    GlyphAtlas,
+    TextBatch,
 )
 
 from .geometry import (
@@ -52,25 +62,49 @@ from .geometry import (
 
 from .matrix import (
     Matrix,
+    MatrixArray,
+)
+
+from .meshfile import (
+    load_mesh,
+    MeshFile,
 )
 
 from .noise import (
     Noise,
     simplex2,
+    simplex2_array,
+    simplex2_grid,
+    simplex3,
+    simplex3_array,
+    simplex3_grid,
+    simplex4,
+    simplex4_array,
+    simplex4_grid,
 )
 
 from .obj import (
+    load_obj,
     OBJ,
 )
 
 from .poisson import (
     poisson_disc,
+    poisson_sample,
+)
+
+from .profiler import (
+    Profiler,
+    ProfilerOverlay,
 )
 
 from .programs import (
     BaseProgram,
     DirectionalLightProgram,
+    InstancedDirectionalLightProgram,
+    SDFTextProgram,
     SolidColorProgram,
+    SpriteProgram,
     TextProgram,
     TextureProgram,
 )
@@ -83,9 +117,15 @@ from .sprite import (
 )
 
 from .stl import (
+    iter_binary_stl,
+    load_stl,
     STL,
 )
 
+from .tracer import (
+    GLTracer,
+)
+
 from .util import (
     add,
     bounding_box,
@@ -101,10 +141,13 @@ from .util import (
     normal_from_points,
     normalize,
     pack_list,
+    pack_vertices,
     ray_triangle_intersection,
     recenter,
     smooth_normals,
     sub,
+    vertex_array,
+    vertex_tuples,
 )
 
 from .wasd import (
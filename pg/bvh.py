@@ -0,0 +1,273 @@
+'''A bounding volume hierarchy over a mesh's triangles for ray queries.
+
+The tree is built with the surface area heuristic (SAH) over binned
+centroids. Construction works one level at a time, splitting every open
+node with a handful of NumPy operations. Queries process batches of rays
+as a wavefront: every (ray, node) pair that is still alive is tested at
+once, so a single call traces thousands of rays without a Python loop per
+ray or per node.
+'''
+from __future__ import division
+
+import numpy as np
+
+BINS = 16
+LEAF_SIZE = 4
+MAX_LEAF_SIZE = 32
+TRAVERSAL_COST = 1.0
+EPS = 1e-9
+
+def box_area(lo, hi):
+    d = np.maximum(hi - lo, 0)
+    return d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0]
+
+def segment_ranges(starts, counts):
+    '''Returns the concatenated ranges [start, start + count) and the index
+    of the range that each element belongs to.
+    '''
+    total = counts.sum()
+    segment = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.cumsum(counts) - counts
+    return starts[segment] + np.arange(total) - offsets[segment], segment
+
+def intersect_triangles(triangles, origins, directions):
+    '''Moller-Trumbore intersection of each ray with the matching triangle.
+    Returns the distance along the ray, or inf where there is no hit.
+    '''
+    v0 = triangles[:, 0].astype(np.float64)
+    e1 = triangles[:, 1] - v0
+    e2 = triangles[:, 2] - v0
+    p = np.cross(directions, e2)
+    det = (e1 * p).sum(axis=1)
+    valid = np.abs(det) > EPS
+    inv = 1 / np.where(valid, det, 1)
+    s = origins - v0
+    u = (s * p).sum(axis=1) * inv
+    q = np.cross(s, e1)
+    v = (directions * q).sum(axis=1) * inv
+    t = (e2 * q).sum(axis=1) * inv
+    valid &= (u >= 0) & (v >= 0) & (u + v <= 1) & (t > 1e-6)
+    return np.where(valid, t, np.inf)
+
+class BVH(object):
+    '''A BVH over the triangles of a Mesh, an ArrayMesh or an (N, 3) array
+    of positions with three rows per triangle.
+
+        >>> bvh = BVH([(0, 0, 0), (1, 0, 0), (0, 0, 1)])
+        >>> bvh.raycast((0.25, 1, 0.25), (0, -1, 0))
+        (1.0, 0)
+        >>> bvh.height(0.25, 0.25)
+        0.0
+    '''
+    def __init__(self, mesh, leaf_size=LEAF_SIZE, bins=BINS):
+        positions = getattr(mesh, 'positions', mesh)
+        positions = np.asarray(positions, dtype=np.float32)
+        triangles = positions.reshape((-1, 3, 3))
+        self.leaf_size = leaf_size
+        self.bins = bins
+        self.build(triangles)
+    def build(self, triangles):
+        count = len(triangles)
+        lo = triangles.min(axis=1)
+        hi = triangles.max(axis=1)
+        centroids = (lo + hi) / 2
+        order = np.arange(count)
+        size = max(2 * count - 1, 1)
+        self.lo = np.zeros((size, 3), dtype=np.float32)
+        self.hi = np.zeros((size, 3), dtype=np.float32)
+        self.child = np.full(size, -1, dtype=np.int64)
+        self.start = np.zeros(size, dtype=np.int64)
+        self.count = np.zeros(size, dtype=np.int64)
+        self.node_count = 1
+        # open nodes still need to be split
+        ids = np.array([0])
+        starts = np.array([0])
+        counts = np.array([count])
+        if count:
+            node_lo = lo.min(axis=0).reshape((1, 3))
+            node_hi = hi.max(axis=0).reshape((1, 3))
+        else:
+            # a single empty leaf, which no ray hits
+            node_lo = node_hi = np.zeros((1, 3), dtype=np.float32)
+        bins = self.bins
+        while len(ids) and count:
+            n = len(ids)
+            self.lo[ids] = node_lo
+            self.hi[ids] = node_hi
+            self.start[ids] = starts
+            self.count[ids] = counts
+            positions, segment = segment_ranges(starts, counts)
+            offsets = np.cumsum(counts) - counts
+            tri = order[positions]
+            # bin the centroids along the longest axis of the node
+            extent = node_hi - node_lo
+            axis = extent.argmax(axis=1)
+            length = extent[np.arange(n), axis]
+            scale = np.where(length > 0, bins / np.maximum(length, 1e-30), 0)
+            value = centroids[tri, axis[segment]]
+            value -= node_lo[segment, axis[segment]]
+            value *= scale[segment]
+            key = segment * bins
+            key += np.clip(value.astype(np.int64), 0, bins - 1)
+            # sorting by key groups each node's triangles by bin, which is
+            # also the partition for any split plane between bins
+            sort = np.argsort(key)
+            tri = tri[sort]
+            key = key[sort]
+            order[positions] = tri
+            tri_lo = lo[tri]
+            tri_hi = hi[tri]
+            bin_counts = np.bincount(key, minlength=n * bins).reshape((n, bins))
+            first = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+            bin_lo = np.full((n * bins, 3), np.inf, dtype=np.float32)
+            bin_hi = np.full((n * bins, 3), -np.inf, dtype=np.float32)
+            bin_lo[key[first]] = np.minimum.reduceat(tri_lo, first)
+            bin_hi[key[first]] = np.maximum.reduceat(tri_hi, first)
+            bin_lo = bin_lo.reshape((n, bins, 3))
+            bin_hi = bin_hi.reshape((n, bins, 3))
+            # surface area heuristic for the bins - 1 candidate splits
+            left_lo = np.minimum.accumulate(bin_lo, axis=1)[:, :-1]
+            left_hi = np.maximum.accumulate(bin_hi, axis=1)[:, :-1]
+            right_lo = np.minimum.accumulate(bin_lo[:, ::-1], axis=1)[:, ::-1][:, 1:]
+            right_hi = np.maximum.accumulate(bin_hi[:, ::-1], axis=1)[:, ::-1][:, 1:]
+            left_count = np.cumsum(bin_counts, axis=1)[:, :-1]
+            right_count = counts[:, np.newaxis] - left_count
+            cost = (box_area(left_lo, left_hi) * left_count +
+                box_area(right_lo, right_hi) * right_count)
+            best = cost.argmin(axis=1)
+            index = np.arange(n), best
+            area = box_area(node_lo, node_hi)
+            split = counts > self.leaf_size
+            split &= ((cost[index] + TRAVERSAL_COST * area < counts * area) |
+                (counts > MAX_LEAF_SIZE))
+            left = left_count[index]
+            # the children's bounds come from the bins on each side
+            child_lo = np.stack((left_lo[index], right_lo[index]), axis=1)
+            child_hi = np.stack((left_hi[index], right_hi[index]), axis=1)
+            # all centroids in one bin, fall back to splitting in half
+            degenerate = np.flatnonzero(split & ((left == 0) | (left == counts)))
+            if len(degenerate):
+                left[degenerate] = counts[degenerate] // 2
+                halves = np.column_stack((
+                    offsets[degenerate], offsets[degenerate] + left[degenerate],
+                )).ravel()
+                halves_count = np.column_stack((
+                    left[degenerate], counts[degenerate] - left[degenerate],
+                )).ravel()
+                p, _ = segment_ranges(halves, halves_count)
+                bounds = np.cumsum(halves_count) - halves_count
+                child_lo[degenerate] = np.minimum.reduceat(
+                    tri_lo[p], bounds).reshape((-1, 2, 3))
+                child_hi[degenerate] = np.maximum.reduceat(
+                    tri_hi[p], bounds).reshape((-1, 2, 3))
+            ids, starts, counts, left = (
+                ids[split], starts[split], counts[split], left[split])
+            children = self.node_count + 2 * np.arange(len(ids))
+            self.child[ids] = children
+            self.node_count += 2 * len(ids)
+            ids = np.column_stack((children, children + 1)).ravel()
+            starts = np.column_stack((starts, starts + left)).ravel()
+            counts = np.column_stack((left, counts - left)).ravel()
+            node_lo = child_lo[split].reshape((-1, 3))
+            node_hi = child_hi[split].reshape((-1, 3))
+        self.lo = self.lo[:self.node_count]
+        self.hi = self.hi[:self.node_count]
+        self.child = self.child[:self.node_count]
+        self.start = self.start[:self.node_count]
+        self.count = self.count[:self.node_count]
+        self.triangles = triangles[order]
+        self.indices = order
+    def traverse(self, origins, directions, tmax, any_hit):
+        origins = np.asarray(origins, dtype=np.float64).reshape((-1, 3))
+        directions = np.asarray(directions, dtype=np.float64).reshape((-1, 3))
+        n = max(len(origins), len(directions))
+        origins = np.broadcast_to(origins, (n, 3))
+        directions = np.broadcast_to(directions, (n, 3))
+        best = np.empty(n)
+        best[:] = tmax
+        hit = np.full(n, -1, dtype=np.int64)
+        if len(self.triangles) == 0:
+            return np.where(hit >= 0, best, np.inf), hit
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inverse = 1 / directions
+        rays = np.arange(n)
+        nodes = np.zeros(n, dtype=np.int64)
+        while len(rays):
+            # slab test against the node bounds
+            with np.errstate(invalid='ignore'):
+                t1 = (self.lo[nodes] - origins[rays]) * inverse[rays]
+                t2 = (self.hi[nodes] - origins[rays]) * inverse[rays]
+            near = np.nanmax(np.minimum(t1, t2), axis=1)
+            far = np.nanmin(np.maximum(t1, t2), axis=1)
+            keep = (near <= far) & (far >= 0) & (near < best[rays])
+            rays = rays[keep]
+            nodes = nodes[keep]
+            child = self.child[nodes]
+            leaf = child < 0
+            # test every triangle in the leaves that were reached
+            leaf_rays = rays[leaf]
+            leaf_nodes = nodes[leaf]
+            if len(leaf_rays):
+                tris, segment = segment_ranges(
+                    self.start[leaf_nodes], self.count[leaf_nodes])
+                tri_rays = leaf_rays[segment]
+                t = intersect_triangles(self.triangles[tris],
+                    origins[tri_rays], directions[tri_rays])
+                found = t < best[tri_rays]
+                t, tris, tri_rays = t[found], tris[found], tri_rays[found]
+                if len(t):
+                    # keep the closest hit per ray
+                    sort = np.lexsort((t, tri_rays))
+                    t, tris, tri_rays = t[sort], tris[sort], tri_rays[sort]
+                    first = np.concatenate(
+                        ([True], tri_rays[1:] != tri_rays[:-1]))
+                    best[tri_rays[first]] = t[first]
+                    hit[tri_rays[first]] = tris[first]
+            rays = rays[~leaf]
+            child = child[~leaf]
+            if any_hit:
+                alive = hit[rays] < 0
+                rays = rays[alive]
+                child = child[alive]
+            rays = np.repeat(rays, 2)
+            nodes = np.column_stack((child, child + 1)).ravel()
+        t = np.where(hit >= 0, best, np.inf)
+        hit = np.where(hit >= 0, self.indices[np.maximum(hit, 0)], -1)
+        return t, hit
+    def intersect(self, origins, directions, tmax=np.inf):
+        '''Finds the closest hit along each ray. Returns (t, triangle) arrays
+        where t is inf and triangle is -1 for rays that miss. Triangle
+        indices refer to the original mesh, i.e. positions[3 * i:3 * i + 3].
+        '''
+        return self.traverse(origins, directions, tmax, False)
+    def occluded(self, origins, directions, tmax=np.inf):
+        '''Returns a boolean array that is True for every ray that hits any
+        triangle closer than tmax. Stops tracing each ray at its first hit.
+        '''
+        t, hit = self.traverse(origins, directions, tmax, True)
+        return hit >= 0
+    def raycast(self, origin, direction, tmax=np.inf):
+        '''Returns a (t, triangle) tuple for the closest hit along one ray,
+        or None if it misses.
+        '''
+        t, hit = self.intersect(origin, direction, tmax)
+        if hit[0] < 0:
+            return None
+        return float(t[0]), int(hit[0])
+    def any_hit(self, origin, direction, tmax=np.inf):
+        return bool(self.occluded(origin, direction, tmax)[0])
+    def heights(self, points):
+        '''Returns the height of the highest surface below or above each
+        (x, z) point, or nan where there is none.
+        '''
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 2))
+        top = float(self.hi[0, 1]) + 1
+        origins = np.column_stack(
+            (points[:, 0], np.full(len(points), top), points[:, 1]))
+        t, hit = self.intersect(origins, (0, -1, 0))
+        return np.where(hit >= 0, top - t, np.nan)
+    def height(self, x, z):
+        h = self.heights([(x, z)])[0]
+        if np.isnan(h):
+            return None
+        return float(h)
@@ -2,10 +2,13 @@ from ctypes import *
 from OpenGL.GL import *
 from PIL import Image
 from math import copysign
-from .matrix import Matrix
+from .matrix import Matrix, MatrixArray
 from . import glfw
+from . import indexing
 from . import util
 import cPickle as pickle
+import heapq
+import numpy as np
 import os
 import Queue
 import threading
@@ -28,6 +31,12 @@ def delete_all(obj):
         if isinstance(child, types):
             child.delete()
 
+def delete_objects(func, *handles):
+    '''Deletes GL objects with one of the glDelete* functions that take a
+    count and an array. glGen* returns numpy scalars, which PyOpenGL does
+    not accept as arrays, so the handles are passed as a list of ints.'''
+    func(len(handles), [int(x) for x in handles])
+
 class Shader(object):
     def __init__(self, shader_type, shader_source):
         if os.path.exists(shader_source):
@@ -55,6 +64,8 @@ class FragmentShader(Shader):
 class Cache(object):
     def __init__(self):
         self.data = {}
+    def get(self, key, default=None):
+        return self.data.get(key, default)
     def set(self, key, value):
         if key in self.data and self.data[key] == value:
             return False
@@ -74,6 +85,7 @@ class Mesh(object):
         self.index = None
         self.vertex_buffer = None
         self.slices = None
+        self.instance_buffer = None
     def delete(self):
         if self.index:
             self.index.delete()
@@ -81,6 +93,9 @@ class Mesh(object):
         if self.vertex_buffer:
             self.vertex_buffer.delete()
             self.vertex_buffer = None
+        if self.instance_buffer:
+            self.instance_buffer.delete()
+            self.instance_buffer = None
     def __add__(self, other):
         positions = self.positions + other.positions
         normals = self.normals + other.normals
@@ -91,7 +106,7 @@ class Mesh(object):
             return self.multiply(other)
         return NotImplemented
     def multiply(self, matrix):
-        positions = [matrix * x for x in self.positions]
+        positions = util.vertex_tuples(matrix.transform_points(self.positions))
         normals = list(self.normals)
         uvs = list(self.uvs)
         return Mesh(positions, normals, uvs)
@@ -135,32 +150,119 @@ class Mesh(object):
                 self.positions, self.normals, self.uvs)
         context.position, context.normal, context.uv = self.slices
         context.draw(mode, self.index)
+    def draw_instanced(self, context, transforms, mode=GL_TRIANGLES):
+        '''Draws one copy of the mesh per transform with a single draw call.
+        `transforms` can be a MatrixArray, a list of Matrix objects or a
+        VertexBuffer of model matrices with a divisor. The context's program
+        needs a `mat4 model_matrix` attribute, like
+        InstancedDirectionalLightProgram.
+        '''
+        if not self.vertex_buffer:
+            self.index, self.vertex_buffer, self.slices = index(
+                self.positions, self.normals, self.uvs)
+        if not isinstance(transforms, VertexBuffer):
+            if not isinstance(transforms, MatrixArray):
+                transforms = MatrixArray.from_matrices(transforms)
+            if self.instance_buffer is None:
+                self.instance_buffer = VertexBuffer(divisor=1)
+            self.instance_buffer.set_data(transforms.value)
+            transforms = self.instance_buffer
+        context.position, context.normal, context.uv = self.slices
+        context.model_matrix = transforms
+        context.draw_instanced(mode, transforms.vertex_count, self.index)
+
+class ArrayMesh(Mesh):
+    '''A Mesh that stores its positions, normals and uvs as contiguous
+    float32 NumPy arrays with shapes (N, 3), (N, 3) and (N, 2).
+    '''
+    @staticmethod
+    def load_pickle(path):
+        with open(path, 'rb') as fp:
+            positions, normals, uvs = pickle.load(fp)
+            return ArrayMesh(positions, normals, uvs)
+    @staticmethod
+    def from_mesh(mesh):
+        return ArrayMesh(mesh.positions, mesh.normals, mesh.uvs)
+    def __init__(self, positions=None, normals=None, uvs=None):
+        super(ArrayMesh, self).__init__()
+        self.positions = util.vertex_array(positions, 3)
+        self.normals = util.vertex_array(normals, 3)
+        self.uvs = util.vertex_array(uvs, 2)
+    def to_mesh(self):
+        positions = util.vertex_tuples(self.positions)
+        normals = util.vertex_tuples(self.normals)
+        uvs = util.vertex_tuples(self.uvs)
+        return Mesh(positions, normals, uvs)
+    def __add__(self, other):
+        positions = np.concatenate((self.positions, other.positions))
+        normals = np.concatenate((self.normals, other.normals))
+        uvs = np.concatenate((self.uvs, other.uvs))
+        return ArrayMesh(positions, normals, uvs)
+    def multiply(self, matrix):
+        positions = matrix.transform_points(self.positions)
+        return ArrayMesh(positions, self.normals.copy(), self.uvs.copy())
+    def bounding_box(self):
+        lo = tuple(self.positions.min(axis=0).tolist())
+        hi = tuple(self.positions.max(axis=0).tolist())
+        return lo, hi
+    def center(self):
+        lo, hi = self.bounding_box()
+        c = np.array(hi) - (np.array(hi) - np.array(lo)) / 2.0
+        positions = self.positions - c
+        return ArrayMesh(positions, self.normals.copy(), self.uvs.copy())
+    def smooth_normals(self):
+        if len(self.positions) == 0:
+            return ArrayMesh()
+        _, inverse = np.unique(
+            self.positions, axis=0, return_inverse=True)
+        n = inverse.max() + 1
+        totals = np.zeros((n, 3))
+        for i in xrange(3):
+            totals[:, i] = np.bincount(
+                inverse, weights=self.normals[:, i], minlength=n)
+        normals = totals[inverse]
+        normals /= np.sqrt((normals * normals).sum(axis=1))[:, np.newaxis]
+        return ArrayMesh(self.positions.copy(), normals, self.uvs.copy())
+    def reverse_winding(self):
+        positions = self.positions.reshape((-1, 3, 3))[:, ::-1]
+        normals = -self.normals
+        uvs = self.uvs.reshape((-1, 3, 2))[:, ::-1]
+        return ArrayMesh(positions, normals, uvs)
+    def swap_axes(self, i, j, k):
+        signs = np.array([copysign(1, i), copysign(1, j), copysign(1, k)])
+        axes = [abs(i), abs(j), abs(k)]
+        positions = self.positions[:, axes] * signs
+        normals = self.normals[:, axes] * signs
+        return ArrayMesh(positions, normals, self.uvs.copy())
+    def save_pickle(self, path):
+        self.to_mesh().save_pickle(path)
 
 class VertexBuffer(object):
-    def __init__(self, data=None):
+    def __init__(self, data=None, divisor=0):
         self.handle = glGenBuffers(1)
+        # counts handle swaps, as GL may hand a deleted handle out again
+        self.version = 0
+        self.divisor = divisor
         self.components = 0
         self.vertex_count = 0
         self.vertex_capacity = 0
         self.extend(data)
     def delete(self):
         if self.handle is not None:
-            glDeleteBuffers(1, self.handle)
+            delete_objects(glDeleteBuffers, self.handle)
             self.handle = None
     def extend(self, data):
-        if not data:
+        if data is None or len(data) == 0:
             return
+        count, components, buf = util.pack_vertices(data)
         if self.components:
-            if len(data[0]) != self.components:
+            if components != self.components:
                 raise Exception
         else:
-            self.components = len(data[0])
+            self.components = components
         offset = self.vertex_count * self.components
-        size = len(data) * self.components
-        flat = util.flatten(data)
-        if len(flat) != size:
-            raise Exception
-        self.vertex_count += len(data)
+        size = count * self.components
+        self.vertex_count += count
         if self.vertex_count > self.vertex_capacity:
             old_size = self.components * self.vertex_capacity
             self.vertex_capacity = max(
@@ -175,7 +277,19 @@ class VertexBuffer(object):
             GL_ARRAY_BUFFER,
             sizeof(c_float) * offset,
             sizeof(c_float) * size,
-            util.pack_list('<f', flat))
+            buf)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+    def update(self, first, data):
+        '''Overwrites vertices in place, starting at vertex `first`.'''
+        count, components, buf = util.pack_vertices(data)
+        if components != self.components or first + count > self.vertex_count:
+            raise Exception('data does not fit in the buffer')
+        glBindBuffer(GL_ARRAY_BUFFER, self.handle)
+        glBufferSubData(
+            GL_ARRAY_BUFFER,
+            sizeof(c_float) * first * components,
+            sizeof(c_float) * count * components,
+            buf)
         glBindBuffer(GL_ARRAY_BUFFER, 0)
     def allocate(self, size):
         glBindBuffer(GL_ARRAY_BUFFER, self.handle)
@@ -186,9 +300,30 @@ class VertexBuffer(object):
             GL_DYNAMIC_DRAW)
         glBindBuffer(GL_ARRAY_BUFFER, 0)
     def resize(self, old_size, new_size):
+        if bool(glCopyBufferSubData):
+            self.resize_on_device(old_size, new_size)
+        else:
+            self.resize_on_host(old_size, new_size)
+    def resize_on_device(self, old_size, new_size):
+        # copy into a new buffer object on the GPU and swap the handles
         old_size = sizeof(c_float) * old_size
         new_size = sizeof(c_float) * new_size
-        temp = (ctypes.c_byte * new_size)()
+        handle = glGenBuffers(1)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, handle)
+        glBufferData(GL_COPY_WRITE_BUFFER, new_size, None, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_COPY_READ_BUFFER, self.handle)
+        glCopyBufferSubData(
+            GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER,
+            0, 0, min(old_size, new_size))
+        glBindBuffer(GL_COPY_READ_BUFFER, 0)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+        delete_objects(glDeleteBuffers, self.handle)
+        self.handle = handle
+        self.version += 1
+    def resize_on_host(self, old_size, new_size):
+        old_size = sizeof(c_float) * old_size
+        new_size = sizeof(c_float) * new_size
+        temp = (c_byte * new_size)()
         glBindBuffer(GL_ARRAY_BUFFER, self.handle)
         data = glMapBuffer(GL_ARRAY_BUFFER, GL_READ_ONLY)
         memmove(temp, data, min(old_size, new_size))
@@ -197,25 +332,28 @@ class VertexBuffer(object):
         glBindBuffer(GL_ARRAY_BUFFER, 0)
     def set_data(self, data):
         old_size = self.components * self.vertex_capacity
-        self.components = len(data[0])
-        self.vertex_count = len(data)
-        self.vertex_capacity = len(data)
-        flat = util.flatten(data)
-        size = len(flat)
+        count, components, buf = util.pack_vertices(data)
+        self.components = components
+        self.vertex_count = count
+        self.vertex_capacity = count
+        size = count * components
         glBindBuffer(GL_ARRAY_BUFFER, self.handle)
         if size == old_size:
             glBufferSubData(
                 GL_ARRAY_BUFFER,
                 0,
                 sizeof(c_float) * size,
-                util.pack_list('<f', flat))
+                buf)
         else:
             glBufferData(
                 GL_ARRAY_BUFFER,
                 sizeof(c_float) * size,
-                util.pack_list('<f', flat),
+                buf,
                 GL_DYNAMIC_DRAW)
         glBindBuffer(GL_ARRAY_BUFFER, 0)
+    @property
+    def binding(self):
+        return (self.handle, self.version, self.components, 0, self.divisor)
     def slice(self, components, offset):
         return VertexBufferSlice(self, components, offset)
     def slices(self, *args):
@@ -228,12 +366,141 @@ class VertexBuffer(object):
             else:
                 result.append(None)
         return result
-    def bind(self, location):
+    def bind(self, location, components=None, offset=0):
         glBindBuffer(GL_ARRAY_BUFFER, self.handle)
         glVertexAttribPointer(
-            location, self.components, GL_FLOAT, GL_FALSE,
-            0, c_void_p())
+            location, components or self.components, GL_FLOAT, GL_FALSE,
+            sizeof(c_float) * self.components,
+            c_void_p(sizeof(c_float) * offset))
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+class StreamBuffer(VertexBuffer):
+    '''A ring buffer for vertex data that is rewritten every frame. Each
+    call to write appends to the unused part of one large buffer without
+    waiting on the GPU, and returns the (first, count) range to pass to
+    Context.draw. When the ring is full the storage is orphaned, so draws
+    that are still in flight keep reading the old storage.
+    '''
+    def __init__(self, components, capacity=16384, divisor=0):
+        super(StreamBuffer, self).__init__(divisor=divisor)
+        self.components = components
+        self.vertex_capacity = capacity
+        self.cursor = 0
+        self.layouts = {}
+        self.allocate(components * capacity)
+    def slices(self, *args):
+        # the same slice objects every time, so that the vertex array
+        # objects that contexts cache for them are reused
+        if args not in self.layouts:
+            self.layouts[args] = super(StreamBuffer, self).slices(*args)
+        return self.layouts[args]
+    def orphan(self):
+        self.allocate(self.components * self.vertex_capacity)
+        self.cursor = 0
+    def write(self, data):
+        if data is None or len(data) == 0:
+            return self.cursor, 0
+        count, components, buf = util.pack_vertices(data)
+        if components != self.components:
+            raise Exception
+        if count > self.vertex_capacity:
+            while count > self.vertex_capacity:
+                self.vertex_capacity *= 2
+            self.orphan()
+        elif self.cursor + count > self.vertex_capacity:
+            self.orphan()
+        first = self.cursor
+        offset = sizeof(c_float) * first * components
+        size = sizeof(c_float) * count * components
+        if isinstance(buf, np.ndarray):
+            address = buf.ctypes.data
+        else:
+            address = addressof(buf)
+        glBindBuffer(GL_ARRAY_BUFFER, self.handle)
+        pointer = None
+        if bool(glMapBufferRange):
+            # nothing in flight reads past the cursor, so no sync is needed
+            pointer = glMapBufferRange(
+                GL_ARRAY_BUFFER, offset, size,
+                GL_MAP_WRITE_BIT | GL_MAP_INVALIDATE_RANGE_BIT |
+                GL_MAP_UNSYNCHRONIZED_BIT)
+        if pointer:
+            memmove(pointer, address, size)
+            glUnmapBuffer(GL_ARRAY_BUFFER)
+        else:
+            glBufferSubData(GL_ARRAY_BUFFER, offset, size, buf)
         glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.cursor += count
+        self.vertex_count = self.cursor
+        return first, count
+
+class PagedVertexBuffer(object):
+    '''Vertex data stored in fixed-size pages. Appending fills the last page
+    and then allocates new ones, so existing data is never copied or
+    reallocated. Each page is drawn with its own draw call. For triangles,
+    `page_size` should be a multiple of 3.
+    '''
+    def __init__(self, data=None, page_size=3 * 2 ** 18, divisor=0):
+        self.page_size = page_size
+        self.divisor = divisor
+        self.components = 0
+        self.pages = []
+        # the slices of each page per layout, kept so that the vertex array
+        # objects that contexts cache for them are reused
+        self.layouts = {}
+        self.extend(data)
+    @property
+    def vertex_count(self):
+        return sum(x.vertex_count for x in self.pages)
+    def delete(self):
+        for page in self.pages:
+            page.delete()
+        self.pages = []
+        self.layouts = {}
+    def add_page(self):
+        page = VertexBuffer(divisor=self.divisor)
+        page.components = self.components
+        page.vertex_capacity = self.page_size
+        page.allocate(self.components * self.page_size)
+        self.pages.append(page)
+        return page
+    def extend(self, data):
+        if data is None or len(data) == 0:
+            return
+        data = np.asarray(data, dtype=np.float32)
+        data = data.reshape((len(data), -1))
+        if self.components:
+            if data.shape[1] != self.components:
+                raise Exception
+        else:
+            self.components = data.shape[1]
+        while len(data):
+            page = self.pages[-1] if self.pages else None
+            if page is None or page.vertex_count == self.page_size:
+                page = self.add_page()
+            count = min(len(data), self.page_size - page.vertex_count)
+            page.extend(data[:count])
+            data = data[count:]
+    def draw(self, context, mode=GL_TRIANGLES, attributes=('position',)):
+        '''Draws every page. `attributes` names the context attributes
+        that the interleaved components are assigned to, optionally as
+        (name, components) pairs, e.g. [('position', 3), ('color', 3)].
+        '''
+        attributes = [(x, self.components) if isinstance(x, basestring)
+            else x for x in attributes]
+        for slices in self.slices(*[x[1] for x in attributes]):
+            for (name, _), value in zip(attributes, slices):
+                setattr(context, name, value)
+            context.draw(mode)
+    def slices(self, *args):
+        '''Returns the slices of every page for a layout, like
+        VertexBuffer.slices, building them only for pages added since the
+        last call.
+        '''
+        result = self.layouts.setdefault(args, [])
+        for page in self.pages[len(result):]:
+            result.append(page.slices(*args))
+        return result
 
 class VertexBufferSlice(object):
     def __init__(self, parent, components, offset):
@@ -243,13 +510,15 @@ class VertexBufferSlice(object):
     @property
     def vertex_count(self):
         return self.parent.vertex_count
-    def bind(self, location):
-        glBindBuffer(GL_ARRAY_BUFFER, self.parent.handle)
-        glVertexAttribPointer(
-            location, self.components, GL_FLOAT, GL_FALSE,
-            sizeof(c_float) * self.parent.components,
-            c_void_p(sizeof(c_float) * self.offset))
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
+    @property
+    def divisor(self):
+        return self.parent.divisor
+    @property
+    def binding(self):
+        return self.parent.binding + (self.components, self.offset)
+    def bind(self, location, components=None, offset=0):
+        self.parent.bind(
+            location, components or self.components, self.offset + offset)
 
 class IndexBuffer(object):
     def __init__(self, data=None):
@@ -258,25 +527,37 @@ class IndexBuffer(object):
             self.set_data(data)
     def delete(self):
         if self.handle is not None:
-            glDeleteBuffers(1, self.handle)
+            delete_objects(glDeleteBuffers, self.handle)
             self.handle = None
     def set_data(self, data):
+        data = indexing.index_array(data)
         self.size = len(data)
+        self.item_size = data.itemsize
+        if data.dtype == np.uint16:
+            self.data_type = GL_UNSIGNED_SHORT
+        else:
+            self.data_type = GL_UNSIGNED_INT
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.handle)
         glBufferData(
             GL_ELEMENT_ARRAY_BUFFER,
-            sizeof(c_uint) * self.size,
-            (c_uint * self.size)(*data),
+            data.nbytes,
+            data,
             GL_STATIC_DRAW)
         glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
 
-def index(*args):
-    sizes = [len(x[0]) if x else None for x in args]
-    data = util.interleave(*filter(None, args))
-    unique = list(util.distinct(data))
-    lookup = dict((x, i) for i, x in enumerate(unique))
-    indices = [lookup[x] for x in data]
-    vertex_buffer = VertexBuffer(unique)
+def index(*args, **kwargs):
+    optimize = kwargs.get('optimize', False)
+    arrays = [np.asarray(x, dtype=np.float32) if len(x) else None
+        for x in args]
+    sizes = [x.shape[1] if x is not None else None for x in arrays]
+    arrays = [x for x in arrays if x is not None]
+    # an empty mesh gets empty buffers
+    data = np.hstack(arrays) if arrays else np.zeros((0, 0), np.float32)
+    vertices, indices = indexing.deduplicate(data)
+    if optimize:
+        indices = indexing.optimize_vertex_cache(indices, len(vertices))
+        vertices, indices = indexing.reorder_vertices(vertices, indices)
+    vertex_buffer = VertexBuffer(vertices)
     index_buffer = IndexBuffer(indices)
     return index_buffer, vertex_buffer, vertex_buffer.slices(*sizes)
 
@@ -313,9 +594,22 @@ class Texture(object):
             GL_UNSIGNED_BYTE, data)
         if mipmap:
             glGenerateMipmap(GL_TEXTURE_2D)
+    def update(self, im, position=(0, 0)):
+        '''Replaces a region of the texture with an image. `position` is the
+        region's top left corner, counting from the top like PIL does.
+        '''
+        if isinstance(im, basestring):
+            im = Image.open(im)
+        im = im.convert('RGBA').transpose(Image.FLIP_TOP_BOTTOM)
+        x, y = position
+        w, h = im.size
+        self.bind()
+        glTexSubImage2D(
+            GL_TEXTURE_2D, 0, x, self.size[1] - y - h, w, h, GL_RGBA,
+            GL_UNSIGNED_BYTE, im.tobytes())
     def delete(self):
         if self.handle is not None:
-            glDeleteTextures(1, self.handle)
+            glDeleteTextures([int(self.handle)])
             self.handle = None
     def get_uniform_value(self):
         return self.unit
@@ -324,19 +618,39 @@ class Texture(object):
         glBindTexture(GL_TEXTURE_2D, self.handle)
 
 class Attribute(object):
+    COLUMNS = {GL_FLOAT_MAT2: 2, GL_FLOAT_MAT3: 3, GL_FLOAT_MAT4: 4}
     def __init__(self, location, name, size, data_type):
         self.location = location
         self.name = name
         self.size = size
         self.data_type = data_type
+        # matrix attributes take up one location per column
+        self.columns = Attribute.COLUMNS.get(data_type, 1)
     def bind(self, value):
-        glEnableVertexAttribArray(self.location)
         cache = App.instance.current_window.cache
-        if not cache.set(self.location, value):
-            return
-        value.bind(self.location)
+        rows = value.components // self.columns
+        for i in xrange(self.columns):
+            location = self.location + i
+            glEnableVertexAttribArray(location)
+            key = ('divisor', location)
+            if cache.get(key, 0) != value.divisor:
+                cache.set(key, value.divisor)
+                glVertexAttribDivisor(location, value.divisor)
+            # the binding includes the handle, which changes when a buffer grows
+            if cache.set(location, (value, value.binding, i)):
+                value.bind(location, rows, rows * i)
+    def setup(self, value):
+        # records the binding in the currently bound vertex array object
+        rows = value.components // self.columns
+        for i in xrange(self.columns):
+            location = self.location + i
+            glEnableVertexAttribArray(location)
+            if value.divisor:
+                glVertexAttribDivisor(location, value.divisor)
+            value.bind(location, rows, rows * i)
     def unbind(self):
-        glDisableVertexAttribArray(self.location)
+        for i in xrange(self.columns):
+            glDisableVertexAttribArray(self.location + i)
     def __repr__(self):
         return 'Attribute%s' % str(
             (self.location, self.name, self.size, self.data_type))
@@ -347,84 +661,254 @@ class Uniform(object):
     BOOLS = set([GL_BOOL, GL_BOOL_VEC2, GL_BOOL_VEC3, GL_BOOL_VEC4])
     MATS = set([GL_FLOAT_MAT2, GL_FLOAT_MAT3, GL_FLOAT_MAT4])
     SAMPLERS = set([GL_SAMPLER_2D, GL_SAMPLER_CUBE])
+    COMPONENTS = {
+        GL_FLOAT: 1, GL_FLOAT_VEC2: 2, GL_FLOAT_VEC3: 3, GL_FLOAT_VEC4: 4,
+        GL_INT: 1, GL_INT_VEC2: 2, GL_INT_VEC3: 3, GL_INT_VEC4: 4,
+        GL_BOOL: 1, GL_BOOL_VEC2: 2, GL_BOOL_VEC3: 3, GL_BOOL_VEC4: 4,
+        GL_FLOAT_MAT2: 4, GL_FLOAT_MAT3: 9, GL_FLOAT_MAT4: 16,
+        GL_SAMPLER_2D: 1, GL_SAMPLER_CUBE: 1,
+    }
+    FUNCS = {
+        GL_FLOAT: (glUniform1f, glUniform1fv),
+        GL_FLOAT_VEC2: (glUniform2f, glUniform2fv),
+        GL_FLOAT_VEC3: (glUniform3f, glUniform3fv),
+        GL_FLOAT_VEC4: (glUniform4f, glUniform4fv),
+        GL_INT: (glUniform1i, glUniform1iv),
+        GL_INT_VEC2: (glUniform2i, glUniform2iv),
+        GL_INT_VEC3: (glUniform3i, glUniform3iv),
+        GL_INT_VEC4: (glUniform4i, glUniform4iv),
+        GL_BOOL: (glUniform1i, glUniform1iv),
+        GL_BOOL_VEC2: (glUniform2i, glUniform2iv),
+        GL_BOOL_VEC3: (glUniform3i, glUniform3iv),
+        GL_BOOL_VEC4: (glUniform4i, glUniform4iv),
+        GL_FLOAT_MAT2: (glUniformMatrix2fv, glUniformMatrix2fv),
+        GL_FLOAT_MAT3: (glUniformMatrix3fv, glUniformMatrix3fv),
+        GL_FLOAT_MAT4: (glUniformMatrix4fv, glUniformMatrix4fv),
+        GL_SAMPLER_2D: (glUniform1i, glUniform1iv),
+        GL_SAMPLER_CUBE: (glUniform1i, glUniform1iv),
+    }
     def __init__(self, location, name, size, data_type):
         self.location = location
         self.name = name
         self.size = size
         self.data_type = data_type
+        # the GL functions are looked up once here instead of on every bind
+        self.components = Uniform.COMPONENTS.get(data_type, 1)
+        self.func, self.array_func = Uniform.FUNCS.get(data_type, (None, None))
+        self.matrix = data_type in Uniform.MATS
+        self.buffer = None
+        if self.matrix:
+            self.buffer = (c_float * self.components)()
+        if data_type in Uniform.FLOATS or self.matrix:
+            self.array_type = np.float32
+        else:
+            self.array_type = np.int32
     def bind(self, value):
         if self.size > 1:
             self.bind_array(value)
             return
         if hasattr(value, 'get_uniform_value'):
             value = value.get_uniform_value()
-        try:
-            count = len(value)
-        except Exception:
-            value = [value]
-            count = 1
+        if isinstance(value, np.ndarray):
+            value = value.ravel().tolist()
+        elif not isinstance(value, (tuple, list)):
+            value = (value,)
         cache = App.instance.current_window.current_program.cache
         if not cache.set(self.location, value):
             return
-        if self.data_type in Uniform.MATS:
-            funcs = {
-                4: glUniformMatrix2fv,
-                9: glUniformMatrix3fv,
-                16: glUniformMatrix4fv,
-            }
-            funcs[count](self.location, 1, False, (c_float * count)(*value))
-        elif self.data_type in Uniform.FLOATS:
-            funcs = {
-                1: glUniform1f,
-                2: glUniform2f,
-                3: glUniform3f,
-                4: glUniform4f,
-            }
-            funcs[count](self.location, *value)
-        elif self.data_type in Uniform.INTS or self.data_type in Uniform.BOOLS:
-            funcs = {
-                1: glUniform1i,
-                2: glUniform2i,
-                3: glUniform3i,
-                4: glUniform4i,
-            }
-            funcs[count](self.location, *value)
-        elif self.data_type in Uniform.SAMPLERS:
-            glUniform1i(self.location, *value)
+        if self.func is None:
+            return
+        if self.matrix:
+            self.buffer[:] = value
+            self.func(self.location, 1, False, self.buffer)
+        else:
+            self.func(self.location, *value)
     def bind_array(self, value):
-        first = value[0]
+        if hasattr(value, 'get_uniform_value'):
+            value = value.get_uniform_value()
+        if not isinstance(value, np.ndarray):
+            value = [x.get_uniform_value() if hasattr(x, 'get_uniform_value')
+                else x for x in value]
         size = min(len(value), self.size)
-        value = value[:size]
-        try:
-            count = len(first)
-            value = util.flatten(value)
-        except Exception:
-            count = 1
-        if len(value) != size * count:
-            raise Exception
-        value = (c_float * len(value))(*value)
-        if self.data_type in Uniform.FLOATS:
-            funcs = {
-                1: glUniform1fv,
-                2: glUniform2fv,
-                3: glUniform3fv,
-                4: glUniform4fv,
-            }
-            funcs[count](self.location, size, value)
-        elif self.data_type in Uniform.INTS or self.data_type in Uniform.BOOLS:
-            funcs = {
-                1: glUniform1iv,
-                2: glUniform2iv,
-                3: glUniform3iv,
-                4: glUniform4iv,
-            }
-            funcs[count](self.location, size, value)
-        elif self.data_type in Uniform.SAMPLERS:
-            glUniform1iv(self.location, size, value)
+        if size == 0 or self.array_func is None:
+            return
+        value = np.ascontiguousarray(value[:size], dtype=self.array_type)
+        if self.matrix:
+            self.array_func(self.location, size, False, value)
+        else:
+            self.array_func(self.location, size, value)
     def __repr__(self):
         return 'Uniform%s' % str(
             (self.location, self.name, self.size, self.data_type))
 
+class UniformBlockField(object):
+    TYPES = {
+        'float': (np.float32, 1, 1),
+        'vec2': (np.float32, 1, 2),
+        'vec3': (np.float32, 1, 3),
+        'vec4': (np.float32, 1, 4),
+        'int': (np.int32, 1, 1),
+        'ivec2': (np.int32, 1, 2),
+        'ivec3': (np.int32, 1, 3),
+        'ivec4': (np.int32, 1, 4),
+        'bool': (np.int32, 1, 1),
+        'bvec2': (np.int32, 1, 2),
+        'bvec3': (np.int32, 1, 3),
+        'bvec4': (np.int32, 1, 4),
+        'mat2': (np.float32, 2, 2),
+        'mat3': (np.float32, 3, 3),
+        'mat4': (np.float32, 4, 4),
+    }
+    def __init__(self, name, field_type, count, offset):
+        self.name = name
+        self.dtype, self.columns, self.rows = UniformBlockField.TYPES[
+            field_type]
+        self.count = count
+        # std140: matrix columns and array elements are padded to a vec4,
+        # vec3 is aligned like a vec4 and vec2 is aligned to 8 bytes
+        if count > 1 or self.columns > 1:
+            alignment = self.stride = 16
+        else:
+            alignment = 16 if self.rows > 2 else 4 * self.rows
+            self.stride = 4 * self.rows
+        self.offset = offset + -offset % alignment
+        self.size = self.stride * self.columns * count
+    @property
+    def end(self):
+        return self.offset + self.size
+    def view(self, data):
+        words = data.view(self.dtype)
+        start = self.offset // 4
+        view = words[start:start + self.size // 4]
+        view = view.reshape((self.count, self.columns, self.stride // 4))
+        return view[:, :, :self.rows]
+
+class UniformBlock(object):
+    '''A std140 uniform block backed by a uniform buffer object. Fields are
+    set like Context attributes and only the byte ranges that changed are
+    uploaded, once, the next time a Context using the block draws. A block
+    can be shared by any number of Contexts, so per-frame data like the
+    camera only needs to be set once.
+
+        camera = UniformBlock('Camera', [
+            ('matrix', 'mat4'),
+            ('camera_position', 'vec3'),
+        ])
+        context.Camera = camera
+        camera.matrix = matrix
+
+    The shader declares the same fields in a block with the same name:
+    ``layout(std140) uniform Camera { mat4 matrix; vec3 camera_position; };``
+    '''
+    # binding points given back by deleted blocks, and the next one never
+    # used; there are only GL_MAX_UNIFORM_BUFFER_BINDINGS of them
+    FREE_BINDINGS = []
+    NEXT_BINDING = 0
+    MAX_BINDINGS = None
+    @staticmethod
+    def allocate_binding():
+        if UniformBlock.FREE_BINDINGS:
+            return heapq.heappop(UniformBlock.FREE_BINDINGS)
+        if UniformBlock.MAX_BINDINGS is None:
+            UniformBlock.MAX_BINDINGS = int(
+                glGetIntegerv(GL_MAX_UNIFORM_BUFFER_BINDINGS))
+        binding = UniformBlock.NEXT_BINDING
+        if binding >= UniformBlock.MAX_BINDINGS:
+            raise Exception('all %d uniform buffer binding points are in use'
+                % UniformBlock.MAX_BINDINGS)
+        UniformBlock.NEXT_BINDING += 1
+        return binding
+    @staticmethod
+    def release_binding(binding):
+        # the windows may have the old buffer cached as bound to it
+        if App.instance is not None:
+            for window in App.instance.windows:
+                window.cache.data.pop(('uniform_block', binding), None)
+        heapq.heappush(UniformBlock.FREE_BINDINGS, binding)
+    def __init__(self, name, fields):
+        self._name = name
+        self._fields = []
+        self._lookup = {}
+        offset = 0
+        for field in fields:
+            name, field_type = field[:2]
+            count = field[2] if len(field) > 2 else 1
+            field = UniformBlockField(name, field_type, count, offset)
+            self._lookup[name] = len(self._fields)
+            self._fields.append(field)
+            offset = field.end
+        self._size = offset + -offset % 16
+        self._data = np.zeros(self._size // 4, dtype=np.float32)
+        self._views = [x.view(self._data) for x in self._fields]
+        self._dirty = set()
+        self._binding = UniformBlock.allocate_binding()
+        self._handle = glGenBuffers(1)
+        glBindBuffer(GL_UNIFORM_BUFFER, self._handle)
+        glBufferData(GL_UNIFORM_BUFFER, self._size, self._data, GL_DYNAMIC_DRAW)
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+    def delete(self):
+        if self._handle is not None:
+            delete_objects(glDeleteBuffers, self._handle)
+            self._handle = None
+            UniformBlock.release_binding(self._binding)
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            super(UniformBlock, self).__setattr__(name, value)
+        elif name in self._lookup:
+            self._set(self._lookup[name], value)
+        else:
+            raise AttributeError(name)
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._lookup:
+            raise AttributeError(name)
+        view = self._views[self._lookup[name]]
+        field = self._fields[self._lookup[name]]
+        if field.count == 1:
+            return view[0].ravel().tolist()
+        return view.reshape((field.count, -1)).tolist()
+    def _set(self, index, value):
+        if hasattr(value, 'get_uniform_value'):
+            value = value.get_uniform_value()
+        elif isinstance(value, list):
+            value = [x.get_uniform_value() if hasattr(x, 'get_uniform_value')
+                else x for x in value]
+        view = self._views[index]
+        value = np.asarray(value, dtype=view.dtype).reshape(view.shape)
+        if np.array_equal(view, value):
+            return
+        view[...] = value
+        self._dirty.add(index)
+    def get_size(self):
+        return self._size
+    def get_binding(self):
+        return self._binding
+    def upload(self):
+        '''Uploads the fields that changed since the last upload, merging
+        neighboring fields into a single glBufferSubData call.
+        '''
+        if not self._dirty:
+            return
+        data = self._data.view(np.uint8)
+        ranges = []
+        for index in sorted(self._dirty):
+            field = self._fields[index]
+            if ranges and ranges[-1][2] == index - 1:
+                ranges[-1][1] = field.end
+                ranges[-1][2] = index
+            else:
+                ranges.append([field.offset, field.end, index])
+        glBindBuffer(GL_UNIFORM_BUFFER, self._handle)
+        for start, end, _ in ranges:
+            glBufferSubData(
+                GL_UNIFORM_BUFFER, start, end - start, data[start:end])
+        glBindBuffer(GL_UNIFORM_BUFFER, 0)
+        self._dirty = set()
+    def bind(self):
+        self.upload()
+        cache = App.instance.current_window.cache
+        if cache.set(('uniform_block', self._binding), self._handle):
+            glBindBufferBase(GL_UNIFORM_BUFFER, self._binding, self._handle)
+
 class Program(object):
     def __init__(self, vs, fs):
         if not isinstance(vs, Shader):
@@ -475,20 +959,62 @@ class Program(object):
             if name.endswith('[0]'):
                 name = name[:-3]
             location = glGetUniformLocation(self.handle, name)
+            if location < 0:
+                # members of uniform blocks have no location
+                continue
             uniform = Uniform(location, name, size, data_type)
             result.append(uniform)
         return result
+    def get_uniform_blocks(self):
+        result = {}
+        if not bool(glGetUniformBlockIndex):
+            return result
+        count = glGetProgramiv(self.handle, GL_ACTIVE_UNIFORM_BLOCKS)
+        name = create_string_buffer(256)
+        for index in xrange(count):
+            glGetActiveUniformBlockName(self.handle, index, 256, None, name)
+            result[name.value] = index
+        return result
+    def set_uniform_block(self, index, block):
+        size = c_int()
+        glGetActiveUniformBlockiv(
+            self.handle, index, GL_UNIFORM_BLOCK_DATA_SIZE, byref(size))
+        if size.value != block.get_size():
+            raise Exception('uniform block size mismatch: %d != %d' % (
+                size.value, block.get_size()))
+        glUniformBlockBinding(self.handle, index, block.get_binding())
 
 class Context(object):
+    MIN_SWEEP_SIZE = 16
+    VERTEX_ARRAYS_SUPPORTED = None
     def __init__(self, program):
         self._program = program
         self._attributes = dict((x.name, x) for x in program.get_attributes())
         self._uniforms = dict((x.name, x) for x in program.get_uniforms())
+        self._blocks = program.get_uniform_blocks()
         self._attribute_values = {}
         self._uniform_values = {}
+        self._block_values = {}
+        self._vertex_arrays = {}
+        self._sweep_sizes = {}
         self._program.set_defaults(self)
     def delete(self):
         self._program.delete()
+        # vertex array objects are not shared between contexts, so each
+        # window's are deleted with its own context current
+        app = App.instance
+        windows = app.windows if app else []
+        current = app.current_window if app else None
+        for window, vertex_arrays in self._vertex_arrays.iteritems():
+            # closed windows took their objects with them
+            if not vertex_arrays or window not in windows:
+                continue
+            window.use()
+            delete_objects(glDeleteVertexArrays, *vertex_arrays.values())
+        if current is not None:
+            current.use()
+        self._vertex_arrays = {}
+        self._sweep_sizes = {}
     def __setattr__(self, name, value):
         if name.startswith('_'):
             super(Context, self).__setattr__(name, value)
@@ -496,6 +1022,9 @@ class Context(object):
             self._attribute_values[name] = value
         elif name in self._uniforms:
             self._uniform_values[name] = value
+        elif name in self._blocks:
+            self._program.set_uniform_block(self._blocks[name], value)
+            self._block_values[name] = value
         else:
             super(Context, self).__setattr__(name, value)
     def __getattr__(self, name):
@@ -505,27 +1034,100 @@ class Context(object):
             return self._attribute_values[name]
         elif name in self._uniforms:
             return self._uniform_values[name]
+        elif name in self._blocks:
+            return self._block_values[name]
         else:
             super(Context, self).__getattr__(name)
-    def draw(self, mode=GL_TRIANGLES, index_buffer=None):
+    def draw(self, mode=GL_TRIANGLES, index_buffer=None, first=0, count=None):
+        self._bind(index_buffer)
+        if index_buffer is None:
+            if count is None:
+                count = self._vertex_count() - first
+            glDrawArrays(mode, first, count)
+        else:
+            if count is None:
+                count = index_buffer.size - first
+            offset = first * index_buffer.item_size
+            glDrawElements(
+                mode, count, index_buffer.data_type, c_void_p(offset))
+        self._unbind(index_buffer)
+    def draw_instanced(self, mode, count, index_buffer=None):
+        self._bind(index_buffer)
+        if index_buffer is None:
+            glDrawArraysInstanced(mode, 0, self._vertex_count(), count)
+        else:
+            glDrawElementsInstanced(
+                mode, index_buffer.size, index_buffer.data_type, c_void_p(),
+                count)
+        self._unbind(index_buffer)
+    def _bind(self, index_buffer):
         self._program.use()
         for name, value in self._uniform_values.iteritems():
             if value is not None:
                 self._uniforms[name].bind(value)
+        for value in self._block_values.itervalues():
+            value.bind()
+        if self._vertex_arrays_supported():
+            glBindVertexArray(self._vertex_array(index_buffer))
+            return
         for name, value in self._attribute_values.iteritems():
             if value is not None:
                 self._attributes[name].bind(value)
-        if index_buffer is None:
-            vertex_count = min(x.vertex_count for x in
-                self._attribute_values.itervalues() if x is not None)
-            glDrawArrays(mode, 0, vertex_count)
-        else:
+        if index_buffer is not None:
             glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, index_buffer.handle)
-            glDrawElements(mode, index_buffer.size, GL_UNSIGNED_INT, c_void_p())
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+    def _unbind(self, index_buffer):
+        if self._vertex_arrays_supported():
+            glBindVertexArray(0)
+            return
         for name, value in self._attribute_values.iteritems():
             if value is not None:
                 self._attributes[name].unbind()
+        if index_buffer is not None:
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, 0)
+    def _vertex_arrays_supported(self):
+        if Context.VERTEX_ARRAYS_SUPPORTED is None:
+            Context.VERTEX_ARRAYS_SUPPORTED = bool(glGenVertexArrays)
+        return Context.VERTEX_ARRAYS_SUPPORTED
+    def _vertex_array(self, index_buffer):
+        # vertex array objects are cached per window, keyed on the bound
+        # buffers and their layout, so unchanged bindings cost one call.
+        # Every buffer set drawn is kept, and the objects of buffers that
+        # were deleted or grown are dropped each time the cache doubles.
+        key = [(name, value, value.binding) for name, value in
+            sorted(self._attribute_values.iteritems()) if value is not None]
+        if index_buffer is not None:
+            key.append((None, index_buffer, index_buffer.handle))
+        key = tuple(key)
+        window = App.instance.current_window
+        vertex_arrays = self._vertex_arrays.setdefault(window, {})
+        handle = vertex_arrays.get(key)
+        if handle is None:
+            size = self._sweep_sizes.get(window, Context.MIN_SWEEP_SIZE)
+            if len(vertex_arrays) >= size:
+                self._sweep(vertex_arrays)
+                self._sweep_sizes[window] = max(
+                    Context.MIN_SWEEP_SIZE, len(vertex_arrays) * 2)
+            handle = glGenVertexArrays(1)
+            glBindVertexArray(handle)
+            for name, value, _ in key:
+                if name is None:
+                    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, value.handle)
+                else:
+                    self._attributes[name].setup(value)
+            vertex_arrays[key] = handle
+        return handle
+    def _sweep(self, vertex_arrays):
+        stale = [key for key in vertex_arrays if any(
+            (value.handle if name is None else value.binding) != binding
+            for name, value, binding in key)]
+        if stale:
+            delete_objects(glDeleteVertexArrays,
+                *[vertex_arrays.pop(x) for x in stale])
+    def _vertex_count(self):
+        # per-instance attributes do not limit the number of vertices
+        return min(x.vertex_count for x in
+            self._attribute_values.itervalues()
+            if x is not None and not x.divisor)
 
 class Scene(object):
     def __init__(self, window):
@@ -603,6 +1205,7 @@ class Window(object):
         self.app.add_window(self)
         self.cache = Cache()
         self.current_program = None
+        self.stream_buffers = {}
         self.use()
         self.framebuffer_size = glfw.get_framebuffer_size(self.handle)
         self.configure()
@@ -655,6 +1258,11 @@ class Window(object):
             glfw.set_input_mode(self.handle, glfw.CURSOR, glfw.CURSOR_NORMAL)
     def set_current_program(self, program):
         self.current_program = program
+    def get_stream_buffer(self, components):
+        # one shared ring buffer per vertex format for transient geometry
+        if components not in self.stream_buffers:
+            self.stream_buffers[components] = StreamBuffer(components)
+        return self.stream_buffers[components]
     def use(self):
         glfw.make_context_current(self.handle)
         self.app.set_current_window(self)
@@ -673,11 +1281,11 @@ class Window(object):
             self.app.remove_window(self)
             glfw.destroy_window(self.handle)
             return
-        self.call('update', self.t, self.dt)
+        self.app.timed('update', self.call, 'update', self.t, self.dt)
         self.redraw()
     def redraw(self):
-        self.call('draw')
-        glfw.swap_buffers(self.handle)
+        self.app.timed('draw', self.call, 'draw')
+        self.app.timed('swap_buffers', glfw.swap_buffers, self.handle)
     def save_image(self, path):
         width, height = self.size
         data = (c_ubyte * (width * height * 3))()
@@ -782,6 +1390,8 @@ class App(object):
         self.current_window = None
         self.queue = Queue.Queue()
         self.ticker = Ticker()
+        self.profiler = None
+        self.tracer = None
     def add_window(self, window):
         self.windows.append(window)
     def remove_window(self, window):
@@ -799,11 +1409,28 @@ class App(object):
             self.tick()
         glfw.terminate()
     def tick(self):
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.begin_frame()
         self.ticker.tick()
-        poll_events()
-        self.process_queue()
+        self.timed('poll_events', poll_events)
+        self.timed('process_queue', self.process_queue)
         for window in list(self.windows):
             window.tick()
+        if profiler is not None:
+            profiler.end_frame()
+        if self.tracer is not None:
+            self.tracer.end_frame()
+    def timed(self, name, func, *args):
+        # calls func, timing it as a phase of the frame when profiling
+        profiler = self.profiler
+        if profiler is None:
+            return func(*args)
+        profiler.begin(name)
+        try:
+            return func(*args)
+        finally:
+            profiler.end(name)
 
 def poll_events():
     glfw.poll_events()
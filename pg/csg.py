@@ -1,287 +1,735 @@
+'''Constructive solid geometry using BSP trees.
+
+Polygons are immutable and share their vertices, so operations never need
+to clone their inputs. Each vertex is a flat (x, y, z, nx, ny, nz, u, v)
+tuple and each plane is an (nx, ny, nz, w) tuple. Polygons are processed
+in batches whose positions are packed into NumPy arrays, and trees are
+built and clipped iteratively, so dense meshes no longer hit the recursion
+limit. Chains of single-child nodes, which make up most of the tree of a
+convex shape, are built and clipped a block of planes at a time.
+
+Polygons that lie outside the bounding box of the other operand are never
+clipped. Models keep track of whether they are inverted (unbounded), so
+that this early-out stays correct for complements.
+'''
 from __future__ import division
 from .core import Mesh
-import random
+from collections import OrderedDict
+import multiprocessing
+import numpy as np
 
-class Vector(object):
-    def __init__(self, x, y, z):
-        self.x = x
-        self.y = y
-        self.z = z
-    def get_tuple(self):
-        return (self.x, self.y, self.z)
-    def clone(self):
-        return Vector(self.x, self.y, self.z)
-    def negate(self):
-        return Vector(-self.x, -self.y, -self.z)
-    def add(self, a):
-        return Vector(self.x + a.x, self.y + a.y, self.z + a.z)
-    def subtract(self, a):
-        return Vector(self.x - a.x, self.y - a.y, self.z - a.z)
-    def multiply(self, a):
-        return Vector(self.x * a, self.y * a, self.z * a)
-    def divide(self, a):
-        return Vector(self.x / a, self.y / a, self.z / a)
-    def length(self):
-        return self.dot(self) ** 0.5
-    def dot(self, a):
-        return self.x * a.x + self.y * a.y + self.z * a.z
-    def cross(self, a):
-        return Vector(
-            self.y * a.z - self.z * a.y,
-            self.z * a.x - self.x * a.z,
-            self.x * a.y - self.y * a.x)
-    def normalize(self):
-        return self.divide(self.length());
-    def interpolate(self, a, t):
-        return self.add(a.subtract(self).multiply(t))
+UNION = 'union'
+DIFFERENCE = 'difference'
+INTERSECTION = 'intersection'
+INVERSE = 'inverse'
 
-class Vertex(object):
-    def __init__(self, position, normal, uv):
-        self.position = position
-        self.normal = normal
-        self.uv = uv
-    def clone(self):
-        return Vertex(
-            self.position.clone(), self.normal.clone(), self.uv.clone())
-    def flip(self):
-        self.normal = self.normal.negate()
-    def interpolate(self, a, t):
-        return Vertex(
-            self.position.interpolate(a.position, t),
-            self.normal.interpolate(a.normal, t),
-            self.uv.interpolate(a.uv, t))
+# operations on fewer polygons than this run in-process
+PARALLEL_POLYGONS = 2000
 
-class Plane(object):
-    @staticmethod
-    def from_points(a, b, c):
-        normal = b.subtract(a).cross(c.subtract(a)).normalize()
-        return Plane(normal, normal.dot(a))
-    def __init__(self, normal, w):
-        self.normal = normal
-        self.w = w
-    def clone(self):
-        return Plane(self.normal.clone(), self.w)
-    def flip(self):
-        self.normal = self.normal.negate()
-        self.w = -self.w
-    def split(self, polygon, co_front, co_back, front, back):
-        COPLANAR = 0
-        FRONT = 1
-        BACK = 2
-        BOTH = 3
-        EPS = 1e-5
-        polygon_type = 0
-        vertex_types = []
-        for vertex in polygon.vertices:
-            w = self.normal.dot(vertex.position) - self.w
-            t = COPLANAR
-            if w < -EPS:
-                t = BACK
-            if w > EPS:
-                t = FRONT
-            polygon_type |= t
-            vertex_types.append(t)
-        if polygon_type == COPLANAR:
-            if self.normal.dot(polygon.plane.normal) > 0:
-                co_front.append(polygon)
-            else:
-                co_back.append(polygon)
-        elif polygon_type == FRONT:
-            front.append(polygon)
-        elif polygon_type == BACK:
-            back.append(polygon)
+COPLANAR = 0
+FRONT = 1
+BACK = 2
+SPANNING = 3
+
+EPS = 1e-5
+
+# number of candidate planes and sample polygons scored at each node
+CANDIDATES = 8
+SAMPLES = 64
+SPLIT_COST = 8
+
+# shortest chain of single-child nodes that is clipped as a whole, and the
+# number of distances computed at once when scanning many planes
+MIN_RUN = 8
+BLOCK = 1 << 22
+
+def plane_from_points(a, b, c):
+    ux, uy, uz = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+    vx, vy, vz = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+    nx = uy * vz - uz * vy
+    ny = uz * vx - ux * vz
+    nz = ux * vy - uy * vx
+    d = (nx * nx + ny * ny + nz * nz) ** 0.5
+    if d == 0:
+        return None
+    nx, ny, nz = nx / d, ny / d, nz / d
+    return (nx, ny, nz, nx * a[0] + ny * a[1] + nz * a[2])
+
+def flip_plane(plane):
+    return (-plane[0], -plane[1], -plane[2], -plane[3])
+
+def flip_vertex(v):
+    return (v[0], v[1], v[2], -v[3], -v[4], -v[5], v[6], v[7])
+
+def interpolate(a, b, t):
+    return (
+        a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t,
+        a[2] + (b[2] - a[2]) * t, a[3] + (b[3] - a[3]) * t,
+        a[4] + (b[4] - a[4]) * t, a[5] + (b[5] - a[5]) * t,
+        a[6] + (b[6] - a[6]) * t, a[7] + (b[7] - a[7]) * t)
+
+def split(plane, polygon, co_front, co_back, front, back):
+    '''Splits `polygon` by `plane`, appending it or its pieces to the
+    matching lists. Pieces keep the plane and shared data of the original.
+    '''
+    nx, ny, nz, w = plane
+    vertices = polygon.vertices
+    distances = []
+    polygon_type = COPLANAR
+    for v in vertices:
+        d = nx * v[0] + ny * v[1] + nz * v[2] - w
+        distances.append(d)
+        if d < -EPS:
+            polygon_type |= BACK
+        elif d > EPS:
+            polygon_type |= FRONT
+    if polygon_type == FRONT:
+        front.append(polygon)
+    elif polygon_type == BACK:
+        back.append(polygon)
+    elif polygon_type == COPLANAR:
+        p = polygon.plane
+        if nx * p[0] + ny * p[1] + nz * p[2] > 0:
+            co_front.append(polygon)
         else:
-            f = []
-            b = []
-            for i in xrange(len(polygon.vertices)):
-                j = (i + 1) % len(polygon.vertices)
-                v1 = polygon.vertices[i]
-                v2 = polygon.vertices[j]
-                t1 = vertex_types[i]
-                t2 = vertex_types[j]
-                if t1 != BACK:
-                    f.append(v1)
-                if t1 != FRONT:
-                    if t1 != BACK:
-                        b.append(v1.clone())
-                    else:
-                        b.append(v1)
-                if (t1 | t2) == BOTH:
-                    n = self.w - self.normal.dot(v1.position)
-                    d = self.normal.dot(v2.position.subtract(v1.position))
-                    v = v1.interpolate(v2, n / d)
-                    f.append(v)
-                    b.append(v.clone())
-            if len(f) >= 3:
-                front.append(Polygon(f, polygon.shared))
-            if len(b) >= 3:
-                back.append(Polygon(b, polygon.shared))
+            co_back.append(polygon)
+    else:
+        f = []
+        b = []
+        n = len(vertices)
+        for i in xrange(n):
+            j = (i + 1) % n
+            v1 = vertices[i]
+            d1 = distances[i]
+            d2 = distances[j]
+            if d1 >= -EPS:
+                f.append(v1)
+            if d1 <= EPS:
+                b.append(v1)
+            if (d1 < -EPS and d2 > EPS) or (d1 > EPS and d2 < -EPS):
+                v = interpolate(v1, vertices[j], d1 / (d1 - d2))
+                f.append(v)
+                b.append(v)
+        if len(f) >= 3:
+            front.append(Polygon(f, polygon.shared, polygon.plane))
+        if len(b) >= 3:
+            back.append(Polygon(b, polygon.shared, polygon.plane))
+
+def distance_range(points, planes):
+    '''Returns the minimum and maximum signed distance from the vertices
+    of each polygon in an (n, k, 3) array to each of the (m, 4) planes, as
+    (n, m) arrays.
+    '''
+    normals = planes[:, :3].T
+    w = planes[:, 3]
+    lo = points[:, 0].dot(normals)
+    lo -= w
+    hi = lo.copy()
+    for i in xrange(1, points.shape[1]):
+        d = points[:, i].dot(normals)
+        d -= w
+        np.minimum(lo, d, out=lo)
+        np.maximum(hi, d, out=hi)
+    return lo, hi
+
+def object_array(items):
+    result = np.empty(len(items), dtype=object)
+    result[:] = items
+    return result
+
+def points_array(polygons):
+    if not polygons:
+        return np.zeros((0, 3, 3))
+    k = max(len(x.vertices) for x in polygons)
+    rows = []
+    for polygon in polygons:
+        vertices = polygon.vertices
+        rows.append([v[:3] for v in vertices] +
+            [vertices[-1][:3]] * (k - len(vertices)))
+    return np.array(rows, dtype=np.float64)
+
+def pad(points, k):
+    if points.shape[1] >= k:
+        return points
+    extra = np.repeat(points[:, -1:], k - points.shape[1], axis=1)
+    return np.concatenate((points, extra), axis=1)
 
 class Polygon(object):
-    def __init__(self, vertices, shared):
-        self.vertices = vertices
+    __slots__ = ('vertices', 'shared', 'plane')
+    def __init__(self, vertices, shared=None, plane=None):
+        self.vertices = tuple(vertices)
         self.shared = shared
-        self.plane = Plane.from_points(*[a.position for a in vertices[:3]])
-    def clone(self):
-        vertices = [a.clone() for a in self.vertices]
-        return Polygon(vertices, self.shared)
-    def flip(self):
-        self.vertices.reverse()
-        for vertex in self.vertices:
-            vertex.flip()
-        self.plane.flip()
+        self.plane = plane or plane_from_points(*self.vertices[:3])
+    def __getstate__(self):
+        return (self.vertices, self.shared, self.plane)
+    def __setstate__(self, state):
+        self.vertices, self.shared, self.plane = state
+    def flipped(self):
+        return Polygon(
+            [flip_vertex(v) for v in reversed(self.vertices)],
+            self.shared, flip_plane(self.plane))
+
+class Batch(object):
+    '''A group of polygons with their positions packed into an (n, k, 3)
+    array, padded by repeating the last vertex, so that a whole batch can
+    be classified against a plane with a few NumPy operations.
+    '''
+    __slots__ = ('polygons', 'points')
+    def __init__(self, polygons, points=None):
+        if points is None:
+            points = points_array(polygons)
+            polygons = object_array(polygons)
+        self.polygons = polygons
+        self.points = points
+    @staticmethod
+    def concatenate(batches):
+        batches = [x for x in batches if len(x)]
+        if not batches:
+            return Batch([])
+        if len(batches) == 1:
+            return batches[0]
+        k = max(x.points.shape[1] for x in batches)
+        polygons = np.concatenate([x.polygons for x in batches])
+        points = np.concatenate([pad(x.points, k) for x in batches])
+        return Batch(polygons, points)
+    def __len__(self):
+        return len(self.polygons)
+    def select(self, mask, pieces=None):
+        batch = Batch(self.polygons[mask], self.points[mask])
+        if pieces:
+            batch = Batch.concatenate([batch, Batch(pieces)])
+        return batch
+    def flipped(self):
+        polygons = object_array([x.flipped() for x in self.polygons])
+        return Batch(polygons, self.points)
+    def bounding_box(self):
+        '''Returns the (lo, hi) corners of the batch, or None if empty.'''
+        if not len(self):
+            return None
+        points = self.points.reshape((-1, 3))
+        return points.min(axis=0), points.max(axis=0)
+    def partition(self, box):
+        '''Splits the batch into the polygons that touch `box` and those
+        that don't.
+        '''
+        if box is None:
+            near = np.zeros(len(self), dtype=bool)
+        else:
+            lo = self.points.min(axis=1)
+            hi = self.points.max(axis=1)
+            near = ((lo <= box[1] + EPS) & (hi >= box[0] - EPS)).all(axis=1)
+        return self.select(near), self.select(~near)
+    def split(self, plane):
+        '''Classifies the batch against `plane`. Returns masks of the
+        coplanar polygons facing the same and the opposite way, masks of
+        the polygons in front and behind, and the front and back pieces of
+        the polygons that span the plane.
+        '''
+        lo, hi = distance_range(self.points, np.array([plane]))
+        behind = lo[:, 0] < -EPS
+        ahead = hi[:, 0] > EPS
+        coplanar = ~(behind | ahead)
+        co_front = coplanar.copy()
+        nx, ny, nz, w = plane
+        for i in np.flatnonzero(coplanar):
+            p = self.polygons[i].plane
+            if nx * p[0] + ny * p[1] + nz * p[2] <= 0:
+                co_front[i] = False
+        front_pieces = []
+        back_pieces = []
+        for i in np.flatnonzero(behind & ahead):
+            split(plane, self.polygons[i], None, None,
+                front_pieces, back_pieces)
+        return (co_front, coplanar & ~co_front, ahead & ~behind,
+            behind & ~ahead, front_pieces, back_pieces)
+    def choose_plane(self):
+        '''Picks a splitting plane from a few evenly spaced candidates,
+        preferring planes that split few polygons and balance the two
+        sides of a sample of the batch. Also returns whether the whole
+        sample was behind the chosen plane, which hints that the batch is
+        convex.
+        '''
+        n = len(self)
+        candidates = self.polygons[::max(1, n // CANDIDATES)][:CANDIDATES]
+        if len(candidates) == 1:
+            return candidates[0].plane, False
+        planes = np.array([x.plane for x in candidates])
+        sample = self.points[::max(1, n // SAMPLES)]
+        lo, hi = distance_range(sample, planes)
+        behind = lo < -EPS
+        ahead = hi > EPS
+        spanning = (behind & ahead).sum(axis=0)
+        front = (ahead & ~behind).sum(axis=0)
+        back = (behind & ~ahead).sum(axis=0)
+        score = spanning * SPLIT_COST + abs(front - back)
+        best = np.argmin(score)
+        return candidates[best].plane, front[best] + spanning[best] == 0
+    def convex_planes(self):
+        '''Returns the planes of the batch that have every polygon behind
+        or on them, and a mask of the polygons that lie on those planes.
+        The planes are scanned in blocks, stopping early once few of them
+        qualify.
+        '''
+        keys = OrderedDict.fromkeys(x.plane for x in self.polygons).keys()
+        planes = np.array(keys)
+        points = np.unique(self.points.reshape((-1, 3)), axis=0)
+        size = max(1, BLOCK // len(points))
+        result = []
+        for i in xrange(0, len(planes), size):
+            block = planes[i:i + size]
+            d = points.dot(block[:, :3].T) - block[:, 3]
+            ok = np.flatnonzero(d.max(axis=0) <= EPS)
+            result.extend(keys[i + j] for j in ok)
+            if len(ok) * 4 < len(block):
+                break
+        chained = set(result)
+        coplanar = np.array([x.plane in chained for x in self.polygons])
+        return result, coplanar
+
+class Run(object):
+    '''A chain of BSP nodes that each have a single child, the next node of
+    the chain. Polygons are pushed through a whole run with one matrix
+    product per block of planes instead of one split per node.
+    '''
+    __slots__ = ('nodes', 'planes', 'keep_front', 'tail')
+    def __init__(self, node, nodes):
+        self.nodes = nodes
+        self.planes = np.array([node.planes[i] for i in nodes])
+        self.keep_front = np.array([node.front[i] >= 0 for i in nodes])
+        last = nodes[-1]
+        self.tail = max(node.front[last], node.back[last])
+    def clip(self, start, stop, batch, inverted, result):
+        '''Clips a batch against nodes [start, stop) of the run. Polygons
+        that leave the run whole are emitted or dropped. Returns the
+        polygons that pass every node and the pieces of split polygons
+        that stay in the run.
+        '''
+        planes = self.planes[start:stop]
+        keep_front = self.keep_front[start:stop]
+        lo, hi = distance_range(batch.points, planes)
+        behind = lo < -EPS
+        ahead = hi > EPS
+        normals = np.array([x.plane[:3] for x in batch.polygons])
+        facing = normals.dot(planes[:, :3].T) > 0
+        front = ahead | (~behind & facing)
+        back = behind | (~ahead & ~facing)
+        # polygons stop at the first node where they are not entirely on
+        # the side of the next node
+        leaves = np.where(keep_front, back, front)
+        stopped = leaves.any(axis=1)
+        first = leaves.argmax(axis=1)
+        spanning = stopped & (behind & ahead)[np.arange(len(batch)), first]
+        # polygons that stop whole reach the missing child of the node
+        whole = stopped & ~spanning
+        emit = whole & (keep_front[first] == inverted)
+        if emit.any():
+            result.append(batch.select(emit))
+        pieces = []
+        for p in np.flatnonzero(spanning):
+            n = start + first[p]
+            plane = tuple(self.planes[n])
+            front_pieces = []
+            back_pieces = []
+            split(plane, batch.polygons[p], None, None,
+                front_pieces, back_pieces)
+            if self.keep_front[n]:
+                kept, leaving = front_pieces, back_pieces
+            else:
+                kept, leaving = back_pieces, front_pieces
+            if self.keep_front[n] == inverted and leaving:
+                result.append(Batch(leaving))
+            pieces.extend(kept)
+        return batch.select(~stopped), pieces
 
 class Node(object):
+    '''A BSP tree stored as flat lists of planes and child indices (-1 for
+    no child). Only the planes are kept, which is all that clipping needs.
+    '''
+    __slots__ = ('planes', 'front', 'back', 'runs')
     def __init__(self, polygons=None):
-        self.plane = None
-        self.front = None
-        self.back = None
-        self.polygons = []
-        if polygons:
+        self.planes = []
+        self.front = []
+        self.back = []
+        self.runs = None
+        if polygons is not None and len(polygons):
             self.build(polygons)
-    def clone(self):
-        node = Node()
-        if self.plane:
-            node.plane = self.plane.clone()
-        if self.front:
-            node.front = self.front.clone()
-        if self.back:
-            node.back = self.back.clone()
-        node.polygons = [a.clone() for a in self.polygons]
-        return node
-    def invert(self):
-        for polygon in self.polygons:
-            polygon.flip()
-        self.plane.flip()
-        if self.front:
-            self.front.invert()
-        if self.back:
-            self.back.invert()
-        self.front, self.back = self.back, self.front
-    def clip_polygons(self, polygons):
-        if not self.plane:
-            return list(polygons)
-        front = []
-        back = []
-        for polygon in polygons:
-            self.plane.split(polygon, front, back, front, back)
-        if self.front:
-            front = self.front.clip_polygons(front)
-        if self.back:
-            back = self.back.clip_polygons(back)
-        else:
-            back = []
-        return front + back
-    def clip_to(self, node):
-        self.polygons = node.clip_polygons(self.polygons)
-        if self.front:
-            self.front.clip_to(node)
-        if self.back:
-            self.back.clip_to(node)
-    def get_polygons(self):
-        result = list(self.polygons)
-        if self.front:
-            result.extend(self.front.get_polygons())
-        if self.back:
-            result.extend(self.back.get_polygons())
-        return result
+    def add(self, plane, parent, links):
+        index = len(self.planes)
+        self.planes.append(plane)
+        self.front.append(-1)
+        self.back.append(-1)
+        if parent is not None:
+            links[parent] = index
+        return index
     def build(self, polygons):
-        if not polygons:
-            return
-        self.plane = self.plane or random.choice(polygons).plane.clone()
-        front = []
-        back = []
-        for polygon in polygons:
-            self.plane.split(polygon, self.polygons, self.polygons, front, back)
-        if front:
-            self.front = self.front or Node()
-            self.front.build(front)
-        if back:
-            self.back = self.back or Node()
-            self.back.build(back)
+        if not isinstance(polygons, Batch):
+            polygons = Batch(polygons)
+        self.runs = None
+        stack = [(None, None, polygons)]
+        while stack:
+            parent, links, batch = stack.pop()
+            plane, convex = batch.choose_plane()
+            if convex and len(batch) >= MIN_RUN:
+                # chain every plane that has the whole batch behind it
+                planes, coplanar = batch.convex_planes()
+                if planes:
+                    for plane in planes:
+                        parent = self.add(plane, parent, links)
+                        links = self.back
+                    batch = batch.select(~coplanar)
+                    if len(batch):
+                        stack.append((parent, links, batch))
+                    continue
+            index = self.add(plane, parent, links)
+            _, _, front, back, front_pieces, back_pieces = batch.split(plane)
+            front = batch.select(front, front_pieces)
+            back = batch.select(back, back_pieces)
+            if len(front):
+                stack.append((index, self.front, front))
+            if len(back):
+                stack.append((index, self.back, back))
+    def get_runs(self):
+        '''Returns a dict mapping each node that is part of a run to its
+        (run, offset). Parents always come before their children, so every
+        run is found from its first node.
+        '''
+        if self.runs is not None:
+            return self.runs
+        self.runs = {}
+        single = [(f < 0) != (b < 0) for f, b in zip(self.front, self.back)]
+        for i in xrange(len(self.planes)):
+            if i in self.runs or not single[i]:
+                continue
+            nodes = [i]
+            while True:
+                child = max(self.front[nodes[-1]], self.back[nodes[-1]])
+                if not single[child]:
+                    break
+                nodes.append(child)
+            run = Run(self, nodes)
+            for offset, index in enumerate(nodes):
+                self.runs[index] = (run, offset)
+        return self.runs
+    def clip_run(self, run, offset, batch, inverted, result, stack):
+        '''Pushes a batch through a run starting at `offset`, a block of
+        nodes at a time. Pieces of split polygons are already on the
+        right side of every earlier node of the run, so they are simply
+        clipped against the whole block again.
+        '''
+        i = offset
+        while i < len(run.nodes) and len(batch):
+            m, k = batch.points.shape[:2]
+            j = min(len(run.nodes), i + max(1, BLOCK // (m * k)))
+            rest = []
+            while len(batch):
+                kept, pieces = run.clip(i, j, batch, inverted, result)
+                rest.append(kept)
+                batch = Batch(pieces)
+            batch = Batch.concatenate(rest)
+            i = j
+        if len(batch):
+            stack.append((run.tail, batch))
+    def clip(self, batch, inverted=False):
+        '''Returns the parts of a batch that are outside of the solid. With
+        `inverted`, the tree is treated as its complement.
+        '''
+        if not self.planes:
+            return batch
+        runs = self.get_runs()
+        result = []
+        stack = [(0, batch)]
+        while stack:
+            index, batch = stack.pop()
+            if index in runs:
+                run, offset = runs[index]
+                if len(run.nodes) - offset >= MIN_RUN:
+                    self.clip_run(run, offset, batch, inverted, result, stack)
+                    continue
+            co_front, co_back, front, back, front_pieces, back_pieces = \
+                batch.split(self.planes[index])
+            # a missing front child is outside and a missing back child is
+            # inside, the other way around when inverted
+            sides = [
+                (self.front[index], co_front | front, front_pieces, inverted),
+                (self.back[index], co_back | back, back_pieces, not inverted),
+            ]
+            for child, mask, pieces, drop in sides:
+                if child < 0 and drop:
+                    continue
+                part = batch.select(mask, pieces)
+                if not len(part):
+                    continue
+                if child < 0:
+                    result.append(part)
+                else:
+                    stack.append((child, part))
+        return Batch.concatenate(result)
+    def clip_polygons(self, polygons, inverted=False):
+        return list(self.clip(Batch(polygons), inverted).polygons)
 
-class Model(object):
-    def __init__(self, polygons=None):
-        self.polygons = polygons or []
-    def clone(self):
-        return Model([a.clone() for a in self.polygons])
-    def get_polygons(self):
-        return self.polygons
+class Operand(object):
+    '''CSG operators shared by models and expressions. They build lazy
+    expressions that are only evaluated when their result is needed.
+    '''
     def __or__(self, other):
-        return self.union(other)
+        return Expression(UNION, [self, other])
     def __and__(self, other):
-        return self.intersection(other)
+        return Expression(INTERSECTION, [self, other])
     def __sub__(self, other):
-        return self.difference(other)
+        return Expression(DIFFERENCE, [self, other])
     def __invert__(self):
-        return self.inverse()
+        return Expression(INVERSE, [self])
+
+class Model(Operand):
+    def __init__(self, polygons=None, inverted=False):
+        self.polygons = polygons or []
+        self.inverted = inverted
+    @staticmethod
+    def from_batches(batches, inverted=False):
+        polygons = []
+        for batch in batches:
+            polygons.extend(batch.polygons)
+        return Model(polygons, inverted)
+    def clone(self):
+        return Model(list(self.polygons), self.inverted)
+    def get_polygons(self):
+        return self.polygons
+    def bounding_box(self):
+        '''Returns the (lo, hi) corners of the surface, or None if empty.'''
+        return Batch(self.polygons).bounding_box()
+    def partition(self, other):
+        '''Packs both models into batches. Returns (near_a, far_a, near_b,
+        far_b, a, b) where far polygons lie outside the bounding box of the
+        other model and can skip clipping.
+        '''
+        a = Batch(self.polygons)
+        b = Batch(other.polygons)
+        near_a, far_a = a.partition(b.bounding_box())
+        near_b, far_b = b.partition(a.bounding_box())
+        return near_a, far_a, near_b, far_b, a, b
     def union(self, other):
-        a = Node(self.clone().polygons)
-        b = Node(other.clone().polygons)
-        a.clip_to(b)
-        b.clip_to(a)
-        b.invert()
-        b.clip_to(a)
-        b.invert()
-        a.build(b.get_polygons())
-        return Model(a.get_polygons())
+        near_a, far_a, near_b, far_b, a, b = self.partition(other)
+        result = []
+        # far polygons are outside the other solid unless it is inverted
+        if not other.inverted:
+            result.append(far_a)
+        if not self.inverted:
+            result.append(far_b)
+        if len(near_a):
+            result.append(Node(b).clip(near_a))
+        if len(near_b):
+            a = Node(a)
+            near_b = a.clip(near_b)
+            result.append(a.clip(near_b.flipped()).flipped())
+        return Model.from_batches(result, self.inverted or other.inverted)
     def difference(self, other):
-        a = Node(self.clone().polygons)
-        b = Node(other.clone().polygons)
-        a.invert()
-        a.clip_to(b)
-        b.clip_to(a)
-        b.invert()
-        b.clip_to(a)
-        b.invert()
-        a.build(b.get_polygons())
-        a.invert()
-        return Model(a.get_polygons())
+        near_a, far_a, near_b, far_b, a, b = self.partition(other)
+        result = []
+        if not other.inverted:
+            result.append(far_a)
+        if self.inverted:
+            result.append(far_b.flipped())
+        if len(near_a):
+            result.append(Node(b).clip(near_a.flipped()).flipped())
+        if len(near_b):
+            a = Node(a)
+            near_b = a.clip(near_b, True)
+            result.append(a.clip(near_b.flipped(), True))
+        return Model.from_batches(
+            result, self.inverted and not other.inverted)
     def intersection(self, other):
-        a = Node(self.clone().polygons)
-        b = Node(other.clone().polygons)
-        a.invert()
-        b.clip_to(a)
-        b.invert()
-        a.clip_to(b)
-        b.clip_to(a)
-        a.build(b.get_polygons())
-        a.invert()
-        return Model(a.get_polygons())
+        near_a, far_a, near_b, far_b, a, b = self.partition(other)
+        result = []
+        if other.inverted:
+            result.append(far_a)
+        if self.inverted:
+            result.append(far_b)
+        if len(near_a):
+            result.append(Node(b).clip(near_a.flipped(), True).flipped())
+        if len(near_b):
+            a = Node(a)
+            near_b = a.clip(near_b, True)
+            result.append(a.clip(near_b.flipped(), True).flipped())
+        return Model.from_batches(result, self.inverted and other.inverted)
     def inverse(self):
-        polygons = [a.clone() for a in self.polygons]
-        for polygon in polygons:
-            polygon.flip()
-        return Model(polygons)
+        polygons = [x.flipped() for x in self.polygons]
+        return Model(polygons, not self.inverted)
     def mesh(self):
         positions = []
         normals = []
         uvs = []
         for polygon in self.get_polygons():
-            for i in xrange(2, len(polygon.vertices)):
-                a = polygon.vertices[0]
-                b = polygon.vertices[i - 1]
-                c = polygon.vertices[i]
-                positions.append(a.position.get_tuple())
-                positions.append(b.position.get_tuple())
-                positions.append(c.position.get_tuple())
-                normals.append(a.normal.get_tuple())
-                normals.append(b.normal.get_tuple())
-                normals.append(c.normal.get_tuple())
-                uvs.append(a.uv.get_tuple()[:2])
-                uvs.append(b.uv.get_tuple()[:2])
-                uvs.append(c.uv.get_tuple()[:2])
+            vertices = polygon.vertices
+            a = vertices[0]
+            for i in xrange(2, len(vertices)):
+                for v in (a, vertices[i - 1], vertices[i]):
+                    positions.append(v[0:3])
+                    normals.append(v[3:6])
+                    uvs.append(v[6:8])
         return Mesh(positions, normals, uvs)
 
+class Expression(Operand):
+    '''A lazy CSG operation. Evaluating an expression collects its whole
+    tree, flattens chains of unions and intersections and rebalances them
+    into a tree of pairs, and turns (a - b) - c into a - (b | c). Results
+    are cached on each expression, so shared subtrees are only computed
+    once, and independent operations of the same level are run on a pool
+    of worker processes.
+
+    On platforms that spawn rather than fork worker processes, evaluate
+    large expressions from inside an `if __name__ == '__main__'` block.
+    '''
+    def __init__(self, operation, operands):
+        self.operation = operation
+        self.operands = operands
+        self.result = None
+    @property
+    def polygons(self):
+        return self.evaluate().polygons
+    @property
+    def inverted(self):
+        return self.evaluate().inverted
+    def get_polygons(self):
+        return self.polygons
+    def bounding_box(self):
+        return self.evaluate().bounding_box()
+    def mesh(self):
+        return self.evaluate().mesh()
+    def evaluate(self, processes=None):
+        '''Returns the Model for the expression. `processes` is the
+        number of worker processes, all cores by default. With 1, or when
+        the operations at a level are small, they run in this process.
+        '''
+        if self.result is None:
+            Evaluator(processes).run(self)
+        return self.result
+
+def apply_operation(args):
+    operation, a, b = args
+    if b is None:
+        return getattr(a, operation)()
+    return getattr(a, operation)(b)
+
+class Evaluator(object):
+    '''Turns an expression tree into a list of binary tasks and runs
+    them one level at a time. Operands are either models or the index of
+    the task that produces them.
+    '''
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.tasks = []
+        self.keys = {}
+        self.handles = {}
+        self.expressions = []
+    def run(self, expression):
+        root = self.schedule(expression)
+        results = {}
+        def value(x):
+            return results[x] if isinstance(x, int) else x
+        pool = None
+        pending = range(len(self.tasks))
+        try:
+            while pending:
+                ready = []
+                waiting = []
+                for i in pending:
+                    operation, a, b = self.tasks[i]
+                    if all(not isinstance(x, int) or x in results
+                        for x in (a, b)):
+                        ready.append(i)
+                    else:
+                        waiting.append(i)
+                args = [(operation, value(a), value(b))
+                    for operation, a, b in (self.tasks[i] for i in ready)]
+                size = sum(len(x.polygons) for _, a, b in args
+                    for x in (a, b) if x is not None)
+                if (len(args) > 1 and size >= PARALLEL_POLYGONS and
+                    self.processes > 1):
+                    if pool is None:
+                        pool = multiprocessing.Pool(self.processes)
+                    outputs = pool.map(apply_operation, args)
+                else:
+                    outputs = map(apply_operation, args)
+                results.update(zip(ready, outputs))
+                pending = waiting
+        finally:
+            if pool is not None:
+                pool.terminate()
+        for x, handle in self.expressions:
+            x.result = value(handle)
+        return value(root)
+    def task(self, operation, a, b=None):
+        # identical operations on the same operands share one task
+        key = (operation,
+            a if isinstance(a, int) else id(a),
+            b if isinstance(b, int) or b is None else id(b))
+        if key not in self.keys:
+            self.keys[key] = len(self.tasks)
+            self.tasks.append((operation, a, b))
+        return self.keys[key]
+    def flatten(self, expression, operation):
+        '''Returns the operands of a chain of the same unevaluated
+        operation.
+        '''
+        result = []
+        stack = [expression]
+        while stack:
+            x = stack.pop()
+            if (isinstance(x, Expression) and x.result is None and
+                x.operation == operation):
+                stack.extend(reversed(x.operands))
+            else:
+                result.append(x)
+        return result
+    def balance(self, operation, operands):
+        while len(operands) > 1:
+            pairs = [self.task(operation, operands[i], operands[i + 1])
+                for i in xrange(0, len(operands) - 1, 2)]
+            if len(operands) % 2:
+                pairs.append(operands[-1])
+            operands = pairs
+        return operands[0]
+    def schedule(self, x):
+        if isinstance(x, Model):
+            return x
+        if x.result is not None:
+            return x.result
+        if id(x) in self.handles:
+            return self.handles[id(x)]
+        operation = x.operation
+        if operation == INVERSE:
+            handle = self.task(INVERSE, self.schedule(x.operands[0]))
+        elif operation == DIFFERENCE:
+            # (a - b) - c == a - (b | c)
+            a, b = x.operands
+            subtrahends = [b]
+            while (isinstance(a, Expression) and a.result is None and
+                a.operation == DIFFERENCE):
+                a, b = a.operands
+                subtrahends.append(b)
+            subtrahends = [self.schedule(y)
+                for y in reversed(subtrahends)]
+            handle = self.task(DIFFERENCE, self.schedule(a),
+                self.balance(UNION, subtrahends))
+        else:
+            operands = [self.schedule(y)
+                for y in self.flatten(x, operation)]
+            handle = self.balance(operation, operands)
+        self.handles[id(x)] = handle
+        self.expressions.append((x, handle))
+        return handle
+
 class Solid(Model):
     def __init__(self, shape):
         polygons = []
+        uvs = shape.uvs or [(0, 0)] * len(shape.positions)
         for i in xrange(0, len(shape.positions), 3):
-            positions = shape.positions[i:i+3]
-            normals = shape.normals[i:i+3]
-            uvs = shape.uvs[i:i+3]
-            vertices = [Vertex(Vector(*a), Vector(*b), Vector(c[0], c[1], 0))
-                for a, b, c in zip(positions, normals, uvs)]
-            polygon = Polygon(vertices, None)
-            polygons.append(polygon)
+            vertices = [tuple(a) + tuple(b) + tuple(c[:2]) for a, b, c in zip(
+                shape.positions[i:i+3], shape.normals[i:i+3], uvs[i:i+3])]
+            if len(vertices) < 3:
+                continue
+            plane = plane_from_points(*vertices)
+            if plane is None:
+                continue
+            polygons.append(Polygon(vertices, None, plane))
         super(Solid, self).__init__(polygons)
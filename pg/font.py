@@ -1,17 +1,232 @@
 from OpenGL.GL import *
-from itertools import product
-from math import ceil, log
+from collections import OrderedDict
+from math import ceil
 from PIL import Image, ImageDraw, ImageFont
-from .core import Context, Texture, VertexBuffer, Scene
+from .core import Context, Texture, Scene, VertexBuffer
 from .matrix import Matrix
-from .programs import TextProgram
-from .util import interleave
+from .pack import pot
+from .programs import SDFTextProgram, TextProgram
+import numpy as np
+
+# the two triangles of a glyph quad as (i, j) corners
+CORNERS = np.array(
+    [(0, 0), (0, 1), (1, 0), (0, 1), (1, 1), (1, 0)], dtype=np.float32)
 
 def float_to_byte_color(color):
     return tuple(int(round(x * 255)) for x in color)
 
+def distance_transform(mask, limit):
+    '''Returns the exact euclidean distance from each pixel to the nearest
+    True pixel of a 2D mask, clamped to `limit`. Only features within
+    `limit` pixels can be nearer than that, so each of the two separable
+    passes is a minimum over 2 * limit + 1 shifted copies of the image.
+    '''
+    far = float(limit * limit + 1)
+    # squared distance to the nearest feature in the same row
+    g = np.where(mask, 0, far).astype(np.float32)
+    for k in xrange(1, limit + 1):
+        d = np.where(mask, k * k, far)
+        g[:, k:] = np.minimum(g[:, k:], d[:, :-k])
+        g[:, :-k] = np.minimum(g[:, :-k], d[:, k:])
+    result = g.copy()
+    for k in xrange(1, limit + 1):
+        result[k:] = np.minimum(result[k:], g[:-k] + k * k)
+        result[:-k] = np.minimum(result[:-k], g[k:] + k * k)
+    return np.sqrt(np.minimum(result, limit * limit))
+
+def signed_distance_field(mask, spread):
+    '''Maps the signed distance to the outline of a mask to 0-255, with 128
+    on the outline, more inside and 0 at `spread` pixels outside or more.
+    '''
+    outside = distance_transform(mask, spread) - 0.5
+    inside = distance_transform(~mask, spread) - 0.5
+    distance = np.where(mask, -inside, outside)
+    value = np.clip(0.5 - distance / (2 * spread), 0, 1)
+    return np.round(value * 255).astype(np.uint8)
+
+class Glyph(object):
+    __slots__ = ['char', 'size', 'offset', 'cell', 'span', 'used']
+    def __init__(self, char, size, offset, cell, span):
+        self.char = char
+        self.size = size
+        self.offset = offset
+        self.cell = cell
+        self.span = span
+        self.used = 0
+    @property
+    def advance(self):
+        return self.offset[0] + self.size[0]
+
+class GlyphAtlas(object):
+    '''A texture of square cells holding the glyphs of a font. Glyphs are
+    rasterized on first use and uploaded with glTexSubImage2D, one glyph at
+    a time. Glyphs wider than a cell take several cells of a row. The
+    texture starts small and doubles up to `max_size` pixels per side, then
+    the least recently used glyphs are evicted to make room. `version`
+    changes whenever the texture coordinates of existing glyphs do.
+    '''
+    # extra pixels around each glyph
+    PADDING = 0
+    def __init__(self, unit, font, fg, bg, max_size=2048):
+        self.font = font
+        self.fg = fg
+        self.bg = bg
+        self.max_size = max_size
+        self.padding = self.PADDING
+        ascent, descent = font.getmetrics()
+        self.cell_size = ascent + descent + 2 + 2 * self.padding
+        self.cols = self.rows = max(1, min(
+            pot(self.cell_size * 8), max_size) // self.cell_size)
+        self.owners = [[None] * self.cols for _ in xrange(self.rows)]
+        self.glyphs = OrderedDict()
+        self.metrics = {}
+        self.version = 0
+        # glyphs used since the last call to begin cannot be evicted
+        self.generation = 0
+        self.im = Image.new('RGBA', self.pixel_size, bg)
+        self.texture = Texture(unit, self.im)
+    @property
+    def pixel_size(self):
+        return (pot(self.cols * self.cell_size),
+            pot(self.rows * self.cell_size))
+    def delete(self):
+        self.texture.delete()
+    def begin(self):
+        self.generation += 1
+    def get_metrics(self, char):
+        if char not in self.metrics:
+            self.metrics[char] = (
+                self.font.getsize(char), self.font.getoffset(char))
+        return self.metrics[char]
+    def get(self, char):
+        '''Returns the Glyph for a character, rasterizing it if needed.'''
+        glyph = self.glyphs.pop(char, None)
+        if glyph is None:
+            glyph = self.rasterize(char)
+        self.glyphs[char] = glyph
+        glyph.used = self.generation
+        return glyph
+    def rasterize(self, char):
+        size, offset = self.get_metrics(char)
+        n = self.cell_size
+        width = size[0] - offset[0] + 2 + 2 * self.padding
+        span = max(1, int(ceil(width / float(n))))
+        if span > self.cols and not self.grow():
+            raise Exception('glyph is wider than the atlas')
+        cell = self.allocate(span)
+        while cell is None:
+            if not self.grow():
+                self.evict()
+            cell = self.allocate(span)
+        glyph = Glyph(char, size, offset, cell, span)
+        row, col = cell
+        for i in xrange(span):
+            self.owners[row][col + i] = char
+        im = self.draw_glyph(char, offset, (n * span, n))
+        position = (col * n, row * n)
+        self.im.paste(im, position)
+        self.texture.update(im, position)
+        return glyph
+    def draw_glyph(self, char, offset, size):
+        im = Image.new('RGBA', size, self.bg)
+        draw = ImageDraw.Draw(im)
+        p = 1 + self.padding
+        draw.text((p - offset[0], p - offset[1]), char, self.fg, self.font)
+        return im
+    def allocate(self, span):
+        for row, owners in enumerate(self.owners):
+            count = 0
+            for col, owner in enumerate(owners):
+                count = 0 if owner is not None else count + 1
+                if count == span:
+                    return (row, col - span + 1)
+        return None
+    def grow(self):
+        '''Doubles the smaller side of the texture, returning False if it
+        is already at the maximum size.
+        '''
+        cols, rows = self.cols, self.rows
+        limit = self.max_size // self.cell_size
+        if cols <= rows and cols * 2 <= limit:
+            cols *= 2
+        elif rows * 2 <= limit:
+            rows *= 2
+        elif cols * 2 <= limit:
+            cols *= 2
+        else:
+            return False
+        for owners in self.owners:
+            owners.extend([None] * (cols - self.cols))
+        for _ in xrange(rows - self.rows):
+            self.owners.append([None] * cols)
+        self.cols, self.rows = cols, rows
+        im = Image.new('RGBA', self.pixel_size, self.bg)
+        im.paste(self.im, (0, 0))
+        self.im = im
+        unit = self.texture.unit
+        self.texture.delete()
+        self.texture = Texture(unit, im)
+        self.version += 1
+        return True
+    def evict(self):
+        char, glyph = self.glyphs.popitem(last=False)
+        if glyph.used == self.generation:
+            raise Exception('too many different glyphs for the atlas')
+        row, col = glyph.cell
+        for i in xrange(glyph.span):
+            self.owners[row][col + i] = None
+        self.version += 1
+
+class SDFAtlas(GlyphAtlas):
+    '''A GlyphAtlas of signed distance fields, to be drawn with
+    SDFTextProgram. The alpha of each texel encodes the distance to the
+    glyph outline, up to `SPREAD` pixels away, so one atlas rasterized at a
+    reference size renders sharp text at any size.
+    '''
+    SPREAD = 6
+    PADDING = SPREAD
+    def __init__(self, unit, font, max_size=2048):
+        super(SDFAtlas, self).__init__(
+            unit, font, (255, 255, 255, 255), (255, 255, 255, 0), max_size)
+    def draw_glyph(self, char, offset, size):
+        im = Image.new('L', size, 0)
+        draw = ImageDraw.Draw(im)
+        p = 1 + self.padding
+        draw.text((p - offset[0], p - offset[1]), char, 255, self.font)
+        mask = np.asarray(im) >= 128
+        data = np.empty(mask.shape + (4,), dtype=np.uint8)
+        data[..., :3] = 255
+        data[..., 3] = signed_distance_field(mask, self.SPREAD)
+        return Image.fromarray(data, 'RGBA')
+
+class Run(object):
+    '''A laid out piece of text: an (n * 6, 4) array of x, y, u, v vertices
+    with the top left corner of the text at the origin, the size of the
+    text, and the first vertex of its range in the font's vertex buffer,
+    once uploaded.
+    '''
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.first = None
+    @property
+    def count(self):
+        return len(self.data)
+
 class Font(object):
-    def __init__(self, scene_or_window, unit, name, size, fg=None, bg=None):
+    '''Renders text with a bitmap font. Glyphs are rasterized into a
+    GlyphAtlas as they are first used, so any character the font has can be
+    drawn. Laid out text is kept in a least recently used cache of
+    `cache_size` runs, each with its own range in a vertex buffer, so
+    drawing the same text again costs one draw call.
+
+    With `sdf`, glyphs are rasterized once at `SDF_SIZE` into an SDFAtlas
+    and text can be drawn at any size from it, `size` being the default.
+    The background color is ignored then.
+    '''
+    SDF_SIZE = 48
+    def __init__(self, scene_or_window, unit, name, size, fg=None, bg=None,
+        cache_size=256, max_size=2048, sdf=False):
         window = scene_or_window
         if isinstance(scene_or_window, Scene):
             window = scene_or_window.window
@@ -23,90 +238,232 @@ class Font(object):
             self.bg += (255,)
         self.window = window
         self.kerning = {}
-        self.load(name, size)
-        self.context = Context(TextProgram())
-        self.context.sampler = Texture(unit, self.im)
-    def render(self, text, coord=(0, 0), anchor=(0, 0)):
-        size, positions, uvs = self.generate_vertex_data(text)
+        self.cache_size = cache_size
+        self.runs = OrderedDict()
+        self.vb = VertexBuffer()
+        # vertices in the buffer that belong to evicted runs
+        self.dead = 0
+        self.size = size
+        self.sdf = sdf
+        self.load(name, Font.SDF_SIZE if sdf else size)
+        if sdf:
+            self.atlas = SDFAtlas(unit, self.font, max_size)
+        else:
+            self.atlas = GlyphAtlas(
+                unit, self.font, self.fg, self.bg, max_size)
+        self.context = self.create_context()
+        self.version = self.atlas.version
+        self.context.position, self.context.uv = self.vb.slices(2, 2)
+    @property
+    def texture(self):
+        return self.atlas.texture
+    def delete(self):
+        self.vb.delete()
+        self.atlas.delete()
+    def create_context(self):
+        if not self.sdf:
+            return Context(TextProgram())
+        context = Context(SDFTextProgram())
+        context.color = tuple(x / 255.0 for x in self.fg)
+        return context
+    def get_scale(self, size=None):
+        '''Returns the scale from laid out runs to `size` pixels.'''
+        return float(size or self.size) / self.reference_size
+    def render(self, text, coord=(0, 0), anchor=(0, 0), size=None):
+        self.atlas.begin()
+        run = self.layout(text)
+        if not run.count:
+            return
+        self.upload(run)
         ww, wh = self.window.size
         tx, ty = coord
         ax, ay = anchor
-        tw, th = size
-        matrix = Matrix()
+        scale = self.get_scale(size)
+        tw, th = run.size[0] * scale, run.size[1] * scale
+        matrix = Matrix().scale((scale, scale, 1))
         matrix = matrix.translate((tx - tw * ax, ty - th * ay, 0))
         matrix = matrix.orthographic(0, ww, wh, 0, -1, 1)
         self.context.matrix = matrix
-        vertex_buffer = VertexBuffer(interleave(positions, uvs))
-        self.context.position, self.context.uv = vertex_buffer.slices(2, 2)
+        self.context.sampler = self.texture
         glEnable(GL_BLEND)
         glDisable(GL_DEPTH_TEST)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-        self.context.draw(GL_TRIANGLES)
+        self.context.draw(GL_TRIANGLES, first=run.first, count=run.count)
         glEnable(GL_DEPTH_TEST)
         glDisable(GL_BLEND)
-        vertex_buffer.delete()
+    def layout(self, text):
+        '''Returns the Run for a piece of text from the cache, laying it out
+        on a miss and evicting the least recently used run if needed.
+        '''
+        self.sync()
+        run = self.runs.pop(text, None)
+        if run is None:
+            run = self.generate_run(text)
+            self.sync()
+            if len(self.runs) >= self.cache_size:
+                self.release(self.runs.popitem(last=False)[1])
+        self.runs[text] = run
+        return run
+    def sync(self):
+        '''Drops the cached runs if the atlas moved or evicted glyphs.'''
+        if self.version == self.atlas.version:
+            return
+        for run in self.runs.itervalues():
+            self.release(run)
+        self.runs.clear()
+        self.version = self.atlas.version
+    def upload(self, run):
+        if run.first is not None:
+            return
+        if self.dead > max(self.vb.vertex_count - self.dead, 65536):
+            self.compact()
+        run.first = self.vb.vertex_count
+        self.vb.extend(run.data)
+    def release(self, run):
+        if run.first is not None:
+            self.dead += run.count
+            run.first = None
+    def compact(self):
+        '''Rewrites the vertex buffer with only the runs still cached.'''
+        runs = [x for x in self.runs.itervalues() if x.first is not None]
+        first = 0
+        for run in runs:
+            run.first = first
+            first += run.count
+        data = [x.data for x in runs] or [np.zeros((0, 4), dtype=np.float32)]
+        self.vb.set_data(np.concatenate(data))
+        self.dead = 0
+    def generate_run(self, text):
+        if isinstance(text, str):
+            # byte strings in other encodings, like latin-1, still render
+            text = text.decode('utf-8', 'replace')
+        chars = [c if c >= u' ' else u' ' for c in text]
+        height = self.ascent + self.descent
+        if not chars:
+            return Run(np.zeros((0, 4), dtype=np.float32), (0, height))
+        glyphs = [self.atlas.get(c) for c in chars]
+        kerning = [0] + [self.get_kerning(a, b)
+            for a, b in zip(chars, chars[1:])]
+        advances = np.array([g.advance for g in glyphs], dtype=np.float32)
+        x = np.cumsum(kerning) + np.cumsum(advances) - advances
+        offsets = np.array([g.offset for g in glyphs], dtype=np.float32)
+        cells = np.array([g.cell for g in glyphs], dtype=np.float32)
+        widths = np.array([g.span for g in glyphs], dtype=np.float32)
+        # the atlas may have grown while rasterizing, so texture coordinates
+        # are computed from its final size
+        n = self.atlas.cell_size
+        widths *= n
+        tw, th = self.atlas.texture.size
+        i = CORNERS[:, 0]
+        j = CORNERS[:, 1]
+        data = np.empty((len(chars), 6, 4), dtype=np.float32)
+        p = self.atlas.padding
+        data[..., 0] = (x + offsets[:, 0] - p)[:, None] + i * widths[:, None]
+        data[..., 1] = offsets[:, 1:] - p + j * n
+        data[..., 2] = (cells[:, 1:] * n + i * widths[:, None]) / tw
+        data[..., 3] = 1 - (cells[:, :1] + j) * n / th
+        size = (int(x[-1] + advances[-1]), height)
+        return Run(data.reshape((-1, 4)), size)
     def generate_vertex_data(self, text):
-        positions = []
-        uvs = []
-        data = [
-            (0, 0), (0, 1), (1, 0),
-            (0, 1), (1, 1), (1, 0),
-        ]
-        x = y = 0
-        previous = None
-        for c in text:
-            if c not in self.sizes:
-                c = ' '
-            index = ord(c) - 32
-            row = index / 10
-            col = index % 10
-            u = self.du * col
-            v = self.dv * row
-            sx, sy = self.sizes[c]
-            ox, oy = self.offsets[c]
-            k = self.get_kerning(previous, c) if previous else 0
-            x += k
-            for i, j in data:
-                cx = x + i * self.dx + ox
-                cy = y + j * self.dy + oy
-                positions.append((cx, cy))
-                uvs.append((u + i * self.du, 1 - v - j * self.dv))
-            x += ox + sx
-            previous = c
-        size = (x, self.dy)
-        return size, positions, uvs
+        self.atlas.begin()
+        run = self.generate_run(text)
+        return run.size, run.data[:, :2], run.data[:, 2:]
     def get_kerning(self, c1, c2):
         key = c1 + c2
         if key not in self.kerning:
-            a = self.sizes[c1][0] + self.sizes[c2][0]
+            a = (self.atlas.get_metrics(c1)[0][0] +
+                self.atlas.get_metrics(c2)[0][0])
             b = self.font.getsize(key)[0]
             self.kerning[key] = b - a
         return self.kerning[key]
     def load(self, name, size):
-        font = ImageFont.truetype(name, size)
-        chars = [chr(x) for x in range(32, 127)]
-        sizes = dict((c, font.getsize(c)) for c in chars)
-        offsets = dict((c, font.getoffset(c)) for c in chars)
-        mw = max(sizes[c][0] for c in chars) + 1
-        mh = max(sizes[c][1] for c in chars) + 1
-        rows = 10
-        cols = 10
-        w = mw * cols
-        h = mh * rows
-        w = int(2 ** ceil(log(w) / log(2)))
-        h = int(2 ** ceil(log(h) / log(2)))
-        im = Image.new('RGBA', (w, h), self.bg)
-        draw = ImageDraw.Draw(im)
-        for (row, col), c in zip(product(range(rows), range(cols)), chars):
-            x = col * mw
-            y = row * mh
-            dx, dy = offsets[c]
-            draw.text((x + 1 - dx, y + 1 - dy), c, self.fg, font)
-        self.dx = mw
-        self.dy = mh
-        self.du = float(mw) / w
-        self.dv = float(mh) / h
-        self.sizes = sizes
-        self.offsets = offsets
-        self.im = im
+        self.reference_size = size
+        self.font = ImageFont.truetype(name, size)
+        self.ascent, self.descent = self.font.getmetrics()
+
+class Label(object):
+    ATTRIBUTES = set(['text', 'coord', 'anchor', 'size'])
+    def __init__(self, batch, text, coord=(0, 0), anchor=(0, 0), size=None):
+        self.batch = batch
+        self.text = text
+        self.coord = coord
+        self.anchor = anchor
+        self.size = size
+    def __setattr__(self, name, value):
+        if name in Label.ATTRIBUTES:
+            self.batch.dirty = True
+        super(Label, self).__setattr__(name, value)
+    def remove(self):
+        self.batch.remove(self)
+
+class TextBatch(object):
+    '''Draws many labels of one font with a single draw call. The labels
+    are laid out through the font's run cache and only rebuilt when one of
+    them changes.
+
+    >>> batch = pg.TextBatch(font)
+    >>> label = batch.add('%.1f fps' % fps, (5, 5))
+    >>> batch.draw()
+    '''
+    def __init__(self, font):
         self.font = font
+        self.labels = []
+        self.dirty = False
+        self.count = 0
+        self.version = None
+        self.vb = VertexBuffer()
+        self.context = font.create_context()
+        self.context.position, self.context.uv = self.vb.slices(2, 2)
+    def delete(self):
+        self.vb.delete()
+    def add(self, text, coord=(0, 0), anchor=(0, 0), size=None):
+        label = Label(self, text, coord, anchor, size)
+        self.labels.append(label)
+        return label
+    def remove(self, label):
+        self.labels.remove(label)
+        self.dirty = True
+    def generate_vertex_data(self):
+        atlas = self.font.atlas
+        atlas.begin()
+        # laying out a label may grow the atlas or evict glyphs of labels
+        # already laid out, so repeat until the atlas stops changing
+        while True:
+            version = atlas.version
+            runs = [self.font.layout(x.text) for x in self.labels]
+            if atlas.version == version:
+                break
+        self.version = version
+        if not any(x.count for x in runs):
+            return np.zeros((0, 4), dtype=np.float32)
+        scales = np.array(
+            [self.font.get_scale(x.size) for x in self.labels],
+            dtype=np.float32)
+        offsets = np.array([
+            (x.coord[0] - run.size[0] * s * x.anchor[0],
+            x.coord[1] - run.size[1] * s * x.anchor[1])
+            for x, run, s in zip(self.labels, runs, scales)],
+            dtype=np.float32)
+        counts = [x.count for x in runs]
+        data = np.concatenate([x.data for x in runs])
+        data[:, :2] *= np.repeat(scales, counts)[:, None]
+        data[:, :2] += np.repeat(offsets, counts, axis=0)
+        return data
+    def draw(self):
+        if self.dirty or self.version != self.font.atlas.version:
+            data = self.generate_vertex_data()
+            self.count = len(data)
+            if self.count:
+                self.vb.set_data(data)
+            self.dirty = False
+        if not self.count:
+            return
+        ww, wh = self.font.window.size
+        self.context.matrix = Matrix().orthographic(0, ww, wh, 0, -1, 1)
+        self.context.sampler = self.font.texture
+        glEnable(GL_BLEND)
+        glDisable(GL_DEPTH_TEST)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        self.context.draw(GL_TRIANGLES, count=self.count)
+        glEnable(GL_DEPTH_TEST)
+        glDisable(GL_BLEND)
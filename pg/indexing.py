@@ -0,0 +1,161 @@
+from __future__ import division
+
+import numpy as np
+
+CACHE_DECAY_POWER = 1.5
+LAST_TRIANGLE_SCORE = 0.75
+VALENCE_BOOST_SCALE = 2.0
+VALENCE_BOOST_POWER = 0.5
+
+HASH_PRIME = np.uint64(1099511628211)
+
+def index_type(vertex_count):
+    '''Returns the narrowest unsigned integer type that can index
+    `vertex_count` vertices.
+    '''
+    if vertex_count <= 2 ** 16:
+        return np.uint16
+    return np.uint32
+
+def index_array(indices):
+    '''Converts `indices` into a uint16 or uint32 NumPy array, picking the
+    narrowest type that fits. Arrays that are already uint16 or uint32 are
+    returned as-is.
+    '''
+    indices = np.asarray(indices)
+    if indices.dtype in (np.uint16, np.uint32):
+        return np.ascontiguousarray(indices)
+    count = int(indices.max()) + 1 if len(indices) else 0
+    return np.ascontiguousarray(indices, dtype=index_type(count))
+
+def deduplicate(data):
+    '''Finds the distinct rows of the 2-dimensional array `data`. Returns a
+    (vertices, indices) tuple where `vertices` holds the distinct rows in the
+    order that they first appear and `vertices[indices]` reproduces `data`.
+    Rows are hashed and sorted, so this runs in O(n log n) without building
+    any Python objects per vertex.
+
+        >>> data = np.array([(0, 0), (1, 0), (0, 0), (2, 0)])
+        >>> vertices, indices = deduplicate(data)
+        >>> vertices.tolist()
+        [[0.0, 0.0], [1.0, 0.0], [2.0, 0.0]]
+        >>> indices.tolist()
+        [0, 1, 0, 2]
+    '''
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    if len(data) == 0:
+        return data, np.zeros(0, dtype=np.uint16)
+    data = data.reshape((len(data), -1))
+    # rows are compared bitwise, so turn -0.0 into 0.0 first
+    data = data + np.float32(0)
+    words = data.view(np.uint32)
+    # FNV-style hash of each row, sorted so that equal rows are adjacent
+    keys = np.zeros(len(data), dtype=np.uint64)
+    for i in xrange(words.shape[1]):
+        keys ^= words[:, i]
+        keys *= HASH_PRIME
+    order = np.argsort(keys)
+    rows = words[order]
+    starts = np.empty(len(data), dtype=bool)
+    starts[0] = True
+    np.any(rows[1:] != rows[:-1], axis=1, out=starts[1:])
+    groups = np.cumsum(starts) - 1
+    first = np.minimum.reduceat(order, np.flatnonzero(starts))
+    # number the distinct rows in the order that they first appear
+    ranks = np.empty(len(first), dtype=np.int64)
+    ranks[np.argsort(first)] = np.arange(len(first))
+    indices = np.empty(len(data), dtype=index_type(len(first)))
+    indices[order] = ranks[groups]
+    return data[np.sort(first)], indices
+
+def reorder_vertices(vertices, indices):
+    '''Renumbers vertices in the order that `indices` first references
+    them, improving locality of vertex fetches. Unreferenced vertices are
+    dropped. Returns a new (vertices, indices) tuple.
+    '''
+    indices = np.asarray(indices)
+    used, first = np.unique(indices, return_index=True)
+    order = used[np.argsort(first)]
+    remap = np.zeros(len(vertices), dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    indices = remap[indices].astype(index_type(len(order)))
+    return vertices[order], indices
+
+def _vertex_score(position, remaining, cache_size):
+    if remaining == 0:
+        return -1.0
+    score = 0.0
+    if position >= 0:
+        if position < 3:
+            score = LAST_TRIANGLE_SCORE
+        else:
+            scale = 1.0 / (cache_size - 3)
+            score = (1.0 - (position - 3) * scale) ** CACHE_DECAY_POWER
+    score += VALENCE_BOOST_SCALE * remaining ** -VALENCE_BOOST_POWER
+    return score
+
+def optimize_vertex_cache(indices, vertex_count=None, cache_size=32):
+    '''Reorders the triangles in `indices` for better post-transform vertex
+    cache utilization using Tom Forsyth's linear-speed algorithm. Returns a
+    new index array with the same type as `indices`.
+    '''
+    indices = np.asarray(indices)
+    dtype = indices.dtype
+    if len(indices) == 0:
+        return indices
+    if vertex_count is None:
+        vertex_count = int(indices.max()) + 1
+    triangle_count = len(indices) // 3
+    triangles = indices[:triangle_count * 3].reshape((-1, 3)).tolist()
+    # build vertex => triangle adjacency
+    flat = indices[:triangle_count * 3].astype(np.int64)
+    counts = np.bincount(flat, minlength=vertex_count)
+    offsets = np.concatenate(([0], np.cumsum(counts))).tolist()
+    adjacent = (np.argsort(flat, kind='mergesort') // 3).tolist()
+    vertex_triangles = [adjacent[offsets[i]:offsets[i + 1]]
+        for i in xrange(vertex_count)]
+    remaining = counts.tolist()
+    cache_position = [-1] * vertex_count
+    vertex_scores = [_vertex_score(-1, x, cache_size) for x in remaining]
+    triangle_scores = [sum(vertex_scores[v] for v in t) for t in triangles]
+    emitted = [False] * triangle_count
+    cache = []
+    result = []
+    cursor = 0
+    best = max(xrange(triangle_count), key=triangle_scores.__getitem__)
+    for _ in xrange(triangle_count):
+        if best < 0:
+            while emitted[cursor]:
+                cursor += 1
+            best = cursor
+        triangle = triangles[best]
+        emitted[best] = True
+        result.append(triangle)
+        for v in triangle:
+            remaining[v] -= 1
+            vertex_triangles[v].remove(best)
+        # move the triangle's vertices to the front of the cache
+        new_cache = list(triangle)
+        new_cache.extend(v for v in cache if v not in triangle)
+        for v in new_cache[cache_size:]:
+            cache_position[v] = -1
+        cache = new_cache[:cache_size]
+        touched = set(new_cache)
+        for i, v in enumerate(cache):
+            cache_position[v] = i
+        for v in touched:
+            vertex_scores[v] = _vertex_score(
+                cache_position[v], remaining[v], cache_size)
+        # rescore the triangles that use the affected vertices
+        best = -1
+        best_score = -1.0
+        for v in touched:
+            for t in vertex_triangles[v]:
+                a, b, c = triangles[t]
+                score = vertex_scores[a] + vertex_scores[b] + vertex_scores[c]
+                triangle_scores[t] = score
+                if score > best_score:
+                    best = t
+                    best_score = score
+    result = np.array(result, dtype=dtype).ravel()
+    return np.concatenate((result, indices[triangle_count * 3:]))
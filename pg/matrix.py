@@ -2,6 +2,7 @@ from __future__ import division
 
 from math import sin, cos, tan, pi
 from .util import normalize
+import numpy as np
 
 class Matrix(object):
     def __init__(self, value=None):
@@ -265,3 +266,133 @@ class Matrix(object):
             1,
         ])
         return matrix * self
+    def transform_points(self, points):
+        return MatrixArray(self.value).transform_points(points)
+    def transform_vectors(self, vectors):
+        return MatrixArray(self.value).transform_vectors(vectors)
+    def transform_normals(self, normals):
+        return MatrixArray(self.value).transform_normals(normals)
+
+class MatrixArray(object):
+    '''Holds N 4x4 matrices in one contiguous (N, 16) float32 NumPy array,
+    using the same column-major layout as Matrix.value. Operations apply to
+    every matrix at once, and arguments can either be shared by all of the
+    matrices or given per matrix.
+
+        >>> m = MatrixArray.identity(2).translate([(1, 0, 0), (0, 2, 0)])
+        >>> m.transform_points((0, 0, 0)).tolist()
+        [[1.0, 0.0, 0.0], [0.0, 2.0, 0.0]]
+    '''
+    @staticmethod
+    def identity(count):
+        value = np.zeros((count, 4, 4), dtype=np.float32)
+        value[:] = np.eye(4)
+        return MatrixArray(value)
+    @staticmethod
+    def from_matrices(matrices):
+        return MatrixArray([x.value for x in matrices])
+    def __init__(self, value):
+        value = np.ascontiguousarray(value, dtype=np.float32)
+        self.value = value.reshape((-1, 16))
+    def get_uniform_value(self):
+        return self.value
+    def __len__(self):
+        return len(self.value)
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+    def __getitem__(self, index):
+        if isinstance(index, (int, long, np.integer)):
+            return Matrix(self.value[index].tolist())
+        return MatrixArray(self.value[index])
+    def __setitem__(self, index, matrix):
+        if isinstance(matrix, (Matrix, MatrixArray)):
+            matrix = matrix.value
+        self.value[index] = matrix
+    def __repr__(self):
+        return '\n\n'.join(repr(x) for x in self)
+    @property
+    def matrices(self):
+        # (N, 4, 4) view where [n, c, r] holds column c, row r
+        return self.value.reshape((-1, 4, 4))
+    def __mul__(self, other):
+        if isinstance(other, (Matrix, MatrixArray)):
+            return self.matrix_multiply(other)
+        return NotImplemented
+    def __rmul__(self, other):
+        if isinstance(other, Matrix):
+            return MatrixArray(other.value).matrix_multiply(self)
+        return NotImplemented
+    def matrix_multiply(self, other):
+        if isinstance(other, Matrix):
+            other = MatrixArray(other.value)
+        # column-major storage holds the transposes, so the order flips
+        return MatrixArray(np.matmul(other.matrices, self.matrices))
+    def transpose(self):
+        return MatrixArray(self.matrices.transpose((0, 2, 1)))
+    def determinant(self):
+        return np.linalg.det(self.matrices.astype(np.float64))
+    def inverse(self):
+        return MatrixArray(np.linalg.inv(self.matrices.astype(np.float64)))
+    def transform(self, points, w):
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+        h = np.empty((len(points), 1, 4))
+        h[:, 0, :3] = points
+        h[:, 0, 3] = w
+        return np.matmul(h, self.matrices)[:, 0, :3]
+    def transform_points(self, points):
+        '''Transforms (N, 3) points by their matching matrices. A single
+        point or a single matrix is applied to all of the others.
+        '''
+        return self.transform(points, 1)
+    def transform_vectors(self, vectors):
+        return self.transform(vectors, 0)
+    def transform_normals(self, normals):
+        normals = np.asarray(normals, dtype=np.float64).reshape((-1, 1, 3))
+        m = self.matrices[:, :3, :3].astype(np.float64)
+        normals = np.matmul(normals, np.linalg.inv(m).transpose((0, 2, 1)))
+        normals = normals[:, 0]
+        d = np.sqrt((normals * normals).sum(axis=1))
+        d[d == 0] = 1
+        return normals / d[:, np.newaxis]
+    def translate(self, value):
+        value = np.asarray(value, dtype=np.float32)
+        matrices = np.zeros((len(value) if value.ndim == 2 else 1, 4, 4))
+        matrices[:] = np.eye(4)
+        matrices[:, 3, :3] = value
+        return MatrixArray(matrices) * self
+    def scale(self, value):
+        value = np.asarray(value, dtype=np.float32).reshape((-1, 3))
+        matrices = np.zeros((len(value), 4, 4))
+        matrices[:, 0, 0] = value[:, 0]
+        matrices[:, 1, 1] = value[:, 1]
+        matrices[:, 2, 2] = value[:, 2]
+        matrices[:, 3, 3] = 1
+        return MatrixArray(matrices) * self
+    def rotate(self, vector, angle):
+        vector = np.asarray(vector, dtype=np.float64).reshape((-1, 3))
+        vector = vector / np.sqrt((vector * vector).sum(axis=1))[:, np.newaxis]
+        x, y, z = vector[:, 0], vector[:, 1], vector[:, 2]
+        angle = np.asarray(angle, dtype=np.float64)
+        s = np.sin(angle)
+        c = np.cos(angle)
+        m = 1 - c
+        count = max(len(vector), angle.size)
+        matrices = np.zeros((count, 4, 4))
+        matrices[:, 0, 0] = m * x * x + c
+        matrices[:, 0, 1] = m * x * y - z * s
+        matrices[:, 0, 2] = m * z * x + y * s
+        matrices[:, 1, 0] = m * x * y + z * s
+        matrices[:, 1, 1] = m * y * y + c
+        matrices[:, 1, 2] = m * y * z - x * s
+        matrices[:, 2, 0] = m * z * x - y * s
+        matrices[:, 2, 1] = m * y * z + x * s
+        matrices[:, 2, 2] = m * z * z + c
+        matrices[:, 3, 3] = 1
+        return MatrixArray(matrices) * self
+    def frustum(self, left, right, bottom, top, near, far):
+        return Matrix().frustum(left, right, bottom, top, near, far) * self
+    def perspective(self, fov, aspect, near, far):
+        return Matrix().perspective(fov, aspect, near, far) * self
+    def orthographic(self, left, right, bottom, top, near, far):
+        return Matrix().orthographic(left, right, bottom, top, near, far) * self
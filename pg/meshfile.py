@@ -0,0 +1,254 @@
+'''A compact, versioned binary container for meshes.
+
+A mesh file starts with a header and a table describing each stream,
+followed by the raw stream data. Every stream is a typed 1- or
+2-dimensional array (positions, normals, uvs, an optional index buffer or
+any custom data) stored little-endian and aligned to 16 bytes, so that
+uncompressed streams can be memory-mapped and handed straight to OpenGL.
+Streams can optionally be compressed with zlib or lz4.
+
+Convert STL, OBJ or pickled meshes from the command line with:
+
+    python -m pg.meshfile input.stl output.mesh --index --compress zlib
+'''
+from .core import ArrayMesh, IndexBuffer, Mesh, VertexBuffer
+from . import indexing
+from . import util
+import argparse
+import numpy as np
+import os
+import struct
+import zlib
+
+try:
+    import lz4.block as lz4
+except ImportError:
+    lz4 = None
+
+MAGIC = 'PGMESH\x00\x00'
+VERSION = 1
+ALIGNMENT = 16
+
+HEADER = struct.Struct('<8sII')
+STREAM = struct.Struct('<16s4sIIQQQ')
+
+NONE = 0
+ZLIB = 1
+LZ4 = 2
+
+COMPRESSION = {
+    None: NONE,
+    'zlib': ZLIB,
+    'lz4': LZ4,
+}
+
+DTYPES = set(['<f4', '<u2', '<u4', '|u1'])
+
+class Stream(object):
+    def __init__(self, name, dtype, components, compression,
+        offset, stored_size, raw_size):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.components = components
+        self.compression = compression
+        self.offset = offset
+        self.stored_size = stored_size
+        self.raw_size = raw_size
+    @property
+    def count(self):
+        return self.raw_size // (self.dtype.itemsize * self.components)
+    @property
+    def shape(self):
+        if self.components == 1:
+            return (self.count,)
+        return (self.count, self.components)
+
+def compress(data, compression):
+    if compression == ZLIB:
+        return zlib.compress(data)
+    if compression == LZ4:
+        if lz4 is None:
+            raise Exception('lz4 is not installed')
+        return lz4.compress(data, store_size=False)
+    return data
+
+def decompress(data, compression, raw_size):
+    if compression == ZLIB:
+        return zlib.decompress(data)
+    if compression == LZ4:
+        if lz4 is None:
+            raise Exception('lz4 is not installed')
+        return lz4.decompress(data, uncompressed_size=raw_size)
+    return data
+
+def write_streams(path, streams, compression=None):
+    '''Writes a list of (name, array) streams to a mesh file. `compression`
+    can be None, 'zlib' or 'lz4'.
+    '''
+    compression = COMPRESSION[compression]
+    entries = []
+    blobs = []
+    offset = HEADER.size + STREAM.size * len(streams)
+    for name, array in streams:
+        array = np.asarray(array)
+        dtype = array.dtype.newbyteorder('<').str
+        if dtype not in DTYPES:
+            raise Exception('unsupported stream type: %s' % dtype)
+        array = np.ascontiguousarray(array, dtype=dtype)
+        components = array.shape[1] if array.ndim == 2 else 1
+        raw = array.tobytes()
+        data = compress(raw, compression)
+        offset += -offset % ALIGNMENT
+        entries.append(STREAM.pack(name, dtype, components, compression,
+            offset, len(data), len(raw)))
+        blobs.append((offset, data))
+        offset += len(data)
+    with open(path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, len(streams)))
+        for entry in entries:
+            fp.write(entry)
+        for offset, data in blobs:
+            fp.write('\x00' * (offset - fp.tell()))
+            fp.write(data)
+
+def mesh_streams(mesh, index=False):
+    '''Returns the streams for `mesh`. With `index`, duplicate vertices are
+    merged and an index stream is added.
+    '''
+    arrays = [
+        ('position', util.vertex_array(mesh.positions, 3)),
+        ('normal', util.vertex_array(mesh.normals, 3)),
+        ('uv', util.vertex_array(mesh.uvs, 2)),
+    ]
+    arrays = [(name, x) for name, x in arrays if len(x)]
+    if not index:
+        return arrays
+    vertices, indices = indexing.deduplicate(np.hstack([x for _, x in arrays]))
+    result = []
+    column = 0
+    for name, x in arrays:
+        components = x.shape[1]
+        result.append((name, vertices[:, column:column + components]))
+        column += components
+    result.append(('index', indices))
+    return result
+
+def save_mesh(self, path, index=False, compression=None):
+    write_streams(path, mesh_streams(self, index), compression)
+
+Mesh.save_mesh = save_mesh
+
+def read_exactly(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise Exception('truncated mesh file')
+    return data
+
+class MeshFile(object):
+    def __init__(self, path):
+        self.path = path
+        self.streams = {}
+        self.names = []
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fp:
+            magic, version, count = HEADER.unpack(
+                read_exactly(fp, HEADER.size))
+            if magic != MAGIC:
+                raise Exception('not a mesh file')
+            if version > VERSION:
+                raise Exception('unsupported mesh file version: %d' % version)
+            for _ in xrange(count):
+                name, dtype, components, compression, offset, \
+                    stored_size, raw_size = STREAM.unpack(
+                    read_exactly(fp, STREAM.size))
+                if offset + stored_size > size:
+                    raise Exception('truncated mesh file')
+                name = name.rstrip('\x00')
+                self.streams[name] = Stream(name, dtype.rstrip('\x00'),
+                    components, compression, offset, stored_size, raw_size)
+                self.names.append(name)
+    def __contains__(self, name):
+        return name in self.streams
+    def read(self, name):
+        '''Returns the stream as a NumPy array. Uncompressed streams are
+        memory-mapped.
+        '''
+        stream = self.streams[name]
+        if stream.count == 0:
+            return np.zeros(stream.shape, dtype=stream.dtype)
+        if stream.compression == NONE:
+            return np.memmap(self.path, dtype=stream.dtype, mode='r',
+                offset=stream.offset, shape=stream.shape)
+        with open(self.path, 'rb') as fp:
+            fp.seek(stream.offset)
+            data = fp.read(stream.stored_size)
+        data = decompress(data, stream.compression, stream.raw_size)
+        return np.frombuffer(data, dtype=stream.dtype).reshape(stream.shape)
+    def write(self, name, array):
+        '''Overwrites an uncompressed stream in place with an array of the
+        same type and size.
+        '''
+        stream = self.streams[name]
+        data = np.ascontiguousarray(array, dtype=stream.dtype).tobytes()
+        if stream.compression != NONE or len(data) != stream.raw_size:
+            raise Exception('stream cannot be updated in place')
+        with open(self.path, 'r+b') as fp:
+            fp.seek(stream.offset)
+            fp.write(data)
+    def mesh(self):
+        '''Returns an ArrayMesh with the file's positions, normals and uvs.
+        Indexed files are expanded back into one row per triangle vertex.
+        '''
+        names = ['position', 'normal', 'uv']
+        arrays = [self.read(x) if x in self else None for x in names]
+        if 'index' in self:
+            indices = self.read('index')
+            arrays = [x[indices] if x is not None else None for x in arrays]
+        return ArrayMesh(*arrays)
+    def upload(self):
+        '''Uploads the streams straight from the file into GPU buffers.
+        Returns an (index_buffer, slices) tuple, where `slices` holds a
+        VertexBuffer (or None) for the position, normal and uv attributes,
+        ready to be assigned to a Context.
+        '''
+        names = ['position', 'normal', 'uv']
+        slices = [VertexBuffer(self.read(x)) if x in self else None
+            for x in names]
+        index_buffer = None
+        if 'index' in self:
+            index_buffer = IndexBuffer(self.read('index'))
+        return index_buffer, slices
+
+def load_mesh(path):
+    return MeshFile(path).mesh()
+
+def load_any(path):
+    '''Loads a mesh from an STL, OBJ, pickle or mesh file.'''
+    from .obj import load_obj
+    from .stl import load_stl
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.stl':
+        return load_stl(path)
+    if ext == '.obj':
+        return load_obj(path, cache=False)
+    if ext in ('.pickle', '.pkl'):
+        return Mesh.load_pickle(path)
+    return load_mesh(path)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Converts STL, OBJ and pickled meshes to mesh files.')
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--index', action='store_true',
+        help='merge duplicate vertices and store an index buffer')
+    parser.add_argument('--compress', choices=['zlib', 'lz4'],
+        help='compress each stream')
+    args = parser.parse_args(args)
+    mesh = load_any(args.input)
+    mesh.save_mesh(args.output, args.index, args.compress)
+    print '%s: %d vertices, %d bytes' % (
+        args.output, len(mesh.positions), os.path.getsize(args.output))
+
+if __name__ == '__main__':
+    main()
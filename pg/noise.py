@@ -1,8 +1,17 @@
 from math import floor
+import multiprocessing
+import numpy as np
 import random
 
 F2 = (3 ** 0.5 - 1) * 0.5
 G2 = (3 - 3 ** 0.5) / 6.0
+F3 = 1 / 3.0
+G3 = 1 / 6.0
+F4 = (5 ** 0.5 - 1) / 4.0
+G4 = (5 - 5 ** 0.5) / 20.0
+
+# number of points evaluated at once by the grid functions
+CHUNK = 1 << 16
 
 GRAD = [
     (1, 1, 0), (-1, 1, 0), (1, -1, 0), (-1, -1, 0),
@@ -11,6 +20,20 @@ GRAD = [
     (1, 1, 0), (0, -1, 1), (-1, 1, 0), (0, -1, -1),
 ]
 
+GRAD4 = [
+    (0, 1, 1, 1), (0, 1, 1, -1), (0, 1, -1, 1), (0, 1, -1, -1),
+    (0, -1, 1, 1), (0, -1, 1, -1), (0, -1, -1, 1), (0, -1, -1, -1),
+    (1, 0, 1, 1), (1, 0, 1, -1), (1, 0, -1, 1), (1, 0, -1, -1),
+    (-1, 0, 1, 1), (-1, 0, 1, -1), (-1, 0, -1, 1), (-1, 0, -1, -1),
+    (1, 1, 0, 1), (1, 1, 0, -1), (1, -1, 0, 1), (1, -1, 0, -1),
+    (-1, 1, 0, 1), (-1, 1, 0, -1), (-1, -1, 0, 1), (-1, -1, 0, -1),
+    (1, 1, 1, 0), (1, 1, -1, 0), (1, -1, 1, 0), (1, -1, -1, 0),
+    (-1, 1, 1, 0), (-1, 1, -1, 0), (-1, -1, 1, 0), (-1, -1, -1, 0),
+]
+
+GRAD_ARRAY = np.array(GRAD)
+GRAD4_ARRAY = np.array(GRAD4)
+
 PERM = [
     151, 160, 137,  91,  90,  15, 131,  13,
     201,  95,  96,  53, 194, 233,   7, 225,
@@ -46,6 +69,28 @@ PERM = [
     128, 195,  78,  66, 215,  61, 156, 180,
 ]
 
+
+def fractal(func, coords, octaves, persistence, lacunarity):
+    '''Sums `octaves` layers of noise, each at `lacunarity` times the
+    frequency and `persistence` times the amplitude of the last. Works on
+    scalars and NumPy arrays alike.
+    '''
+    frequency = 1.0
+    amplitude = 1.0
+    maximum = 1.0
+    total = func(*coords)
+    for _ in xrange(octaves - 1):
+        frequency *= lacunarity
+        amplitude *= persistence
+        maximum += amplitude
+        total += func(*[x * frequency for x in coords]) * amplitude
+    return total / maximum
+
+def grid_tile(args):
+    noise, method, axes, octaves, persistence, lacunarity = args
+    points = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1)
+    return getattr(noise, method)(points, octaves, persistence, lacunarity)
+
 class Noise(object):
     def __init__(self, seed=None):
         self.seed(seed)
@@ -54,6 +99,7 @@ class Noise(object):
         if seed is not None:
             random.Random(seed).shuffle(perm)
         self.perm = perm + perm
+        self.perm_array = np.array(self.perm)
     def _simplex2(self, x, y):
         perm = self.perm
         s = (x + y) * F2
@@ -84,19 +130,215 @@ class Noise(object):
             gx, gy, _ = GRAD[perm[i + 1 + perm[j + 1]] % 12]
             noise += f * f * f * f * (gx * x2 + gy * y2)
         return noise * 70
+    def _simplex2_array(self, x, y):
+        # same arithmetic as _simplex2, in the same order, one array at a time
+        perm = self.perm_array
+        s = (x + y) * F2
+        i = np.floor(x + s)
+        j = np.floor(y + s)
+        t = (i + j) * G2
+        x0 = x - (i - t)
+        y0 = y - (j - t)
+        i1 = (x0 > y0).astype(np.int64)
+        j1 = (x0 <= y0).astype(np.int64)
+        x1 = x0 - i1 + G2
+        y1 = y0 - j1 + G2
+        x2 = x0 + G2 * 2 - 1
+        y2 = y0 + G2 * 2 - 1
+        i = i.astype(np.int64) % 256
+        j = j.astype(np.int64) % 256
+        corners = [
+            (x0, y0, perm[i + perm[j]]),
+            (x1, y1, perm[i + i1 + perm[j + j1]]),
+            (x2, y2, perm[i + 1 + perm[j + 1]]),
+        ]
+        noise = np.zeros(np.shape(x0))
+        for x, y, h in corners:
+            f = 0.5 - x * x - y * y
+            g = GRAD_ARRAY[h % 12]
+            value = f * f * f * f * (g[..., 0] * x + g[..., 1] * y)
+            noise += np.where(f > 0, value, 0)
+        return noise * 70
+    def _simplex(self, coords, skew, unskew, grad):
+        '''Simplex noise in any number of dimensions for one point, with
+        the corners of the simplex ordered by rank.
+        '''
+        perm = self.perm
+        n = len(coords)
+        s = sum(coords) * skew
+        cells = [floor(x + s) for x in coords]
+        t = sum(cells) * unskew
+        d = [x - (i - t) for x, i in zip(coords, cells)]
+        ranks = [0] * n
+        for a in xrange(n):
+            for b in xrange(a + 1, n):
+                if d[a] > d[b]:
+                    ranks[a] += 1
+                else:
+                    ranks[b] += 1
+        cells = [int(i) % 256 for i in cells]
+        noise = 0.0
+        for corner in xrange(n + 1):
+            offsets = [int(r >= n - corner) for r in ranks]
+            p = [x - o + corner * unskew for x, o in zip(d, offsets)]
+            f = 0.6 - sum(x * x for x in p)
+            if f > 0:
+                h = 0
+                for i, o in reversed(zip(cells, offsets)):
+                    h = perm[i + o + h]
+                g = grad[h % len(grad)]
+                noise += f * f * f * f * sum(a * b for a, b in zip(g, p))
+        return noise
+    def _simplex_array(self, coords, skew, unskew, grad):
+        # same arithmetic as _simplex, in the same order, one array at a time
+        perm = self.perm_array
+        n = len(coords)
+        s = sum(coords) * skew
+        cells = [np.floor(x + s) for x in coords]
+        t = sum(cells) * unskew
+        d = [x - (i - t) for x, i in zip(coords, cells)]
+        ranks = [0] * n
+        for a in xrange(n):
+            for b in xrange(a + 1, n):
+                greater = d[a] > d[b]
+                ranks[a] = ranks[a] + greater
+                ranks[b] = ranks[b] + ~greater
+        cells = [i.astype(np.int64) % 256 for i in cells]
+        noise = np.zeros(np.shape(d[0]))
+        for corner in xrange(n + 1):
+            offsets = [(r >= n - corner).astype(np.int64) for r in ranks]
+            p = [x - o + corner * unskew for x, o in zip(d, offsets)]
+            f = 0.6 - sum(x * x for x in p)
+            h = 0
+            for i, o in reversed(zip(cells, offsets)):
+                h = perm[i + o + h]
+            g = grad[h % len(grad)]
+            value = sum(g[..., k] * x for k, x in enumerate(p))
+            noise += np.where(f > 0, f * f * f * f * value, 0)
+        return noise
+    def _simplex3(self, x, y, z):
+        return self._simplex((x, y, z), F3, G3, GRAD[:12]) * 32
+    def _simplex3_array(self, x, y, z):
+        return self._simplex_array((x, y, z), F3, G3, GRAD_ARRAY[:12]) * 32
+    def _simplex4(self, x, y, z, w):
+        return self._simplex((x, y, z, w), F4, G4, GRAD4) * 27
+    def _simplex4_array(self, x, y, z, w):
+        return self._simplex_array((x, y, z, w), F4, G4, GRAD4_ARRAY) * 27
+    def _array(self, func, points, dimensions, octaves, persistence,
+        lacunarity):
+        points = np.asarray(points, dtype=np.float64)
+        if points.shape[-1] != dimensions:
+            raise Exception('points must have %d components' % dimensions)
+        coords = [points[..., i] for i in xrange(dimensions)]
+        return fractal(func, coords, octaves, persistence, lacunarity)
+    def _grid(self, method, axes, octaves, persistence, lacunarity,
+        processes):
+        '''Evaluates `method` over the grid spanned by `axes` in tiles of
+        about CHUNK points, spread over `processes` worker processes (all
+        cores by default).
+        '''
+        axes = [np.asarray(x, dtype=np.float64).ravel() for x in axes]
+        inner = int(np.prod([len(x) for x in axes[1:]]))
+        rows = max(1, CHUNK // max(1, inner))
+        tasks = [(self, method, [axes[0][i:i + rows]] + axes[1:],
+            octaves, persistence, lacunarity)
+            for i in xrange(0, len(axes[0]), rows)]
+        if not tasks:
+            return np.zeros([len(x) for x in axes])
+        processes = processes or multiprocessing.cpu_count()
+        if len(tasks) > 1 and processes > 1:
+            pool = multiprocessing.Pool(min(processes, len(tasks)))
+            try:
+                tiles = pool.map(grid_tile, tasks)
+            finally:
+                pool.terminate()
+        else:
+            tiles = map(grid_tile, tasks)
+        return np.concatenate(tiles)
     def simplex2(self, x, y, octaves=1, persistence=0.5, lacunarity=2.0):
-        frequency = 1.0
-        amplitude = 1.0
-        maximum = 1.0
-        total = self._simplex2(x, y)
-        for _ in xrange(octaves - 1):
-            frequency *= lacunarity
-            amplitude *= persistence
-            maximum += amplitude
-            total += self._simplex2(x * frequency, y * frequency) * amplitude
-        return total / maximum
+        return fractal(self._simplex2, (x, y),
+            octaves, persistence, lacunarity)
+    def simplex2_array(
+        self, points, octaves=1, persistence=0.5, lacunarity=2.0):
+        '''Returns simplex2 for an (..., 2) array of points.'''
+        return self._array(self._simplex2_array, points, 2,
+            octaves, persistence, lacunarity)
+    def simplex2_grid(
+        self, xs, ys, octaves=1, persistence=0.5, lacunarity=2.0,
+        processes=None):
+        '''Returns an array where result[i, j] is simplex2(xs[i], ys[j]).
+
+        >>> Noise().simplex2_grid([0.5, 1.5], [0.25, 0.75, 1.25]).shape
+        (2, 3)
+        '''
+        return self._grid('simplex2_array', (xs, ys),
+            octaves, persistence, lacunarity, processes)
+    def simplex3(self, x, y, z, octaves=1, persistence=0.5, lacunarity=2.0):
+        return fractal(self._simplex3, (x, y, z),
+            octaves, persistence, lacunarity)
+    def simplex3_array(
+        self, points, octaves=1, persistence=0.5, lacunarity=2.0):
+        '''Returns simplex3 for an (..., 3) array of points.'''
+        return self._array(self._simplex3_array, points, 3,
+            octaves, persistence, lacunarity)
+    def simplex3_grid(
+        self, xs, ys, zs, octaves=1, persistence=0.5, lacunarity=2.0,
+        processes=None):
+        '''Returns an array where result[i, j, k] is
+        simplex3(xs[i], ys[j], zs[k]).
+        '''
+        return self._grid('simplex3_array', (xs, ys, zs),
+            octaves, persistence, lacunarity, processes)
+    def simplex4(
+        self, x, y, z, w, octaves=1, persistence=0.5, lacunarity=2.0):
+        return fractal(self._simplex4, (x, y, z, w),
+            octaves, persistence, lacunarity)
+    def simplex4_array(
+        self, points, octaves=1, persistence=0.5, lacunarity=2.0):
+        '''Returns simplex4 for an (..., 4) array of points.'''
+        return self._array(self._simplex4_array, points, 4,
+            octaves, persistence, lacunarity)
+    def simplex4_grid(
+        self, xs, ys, zs, ws, octaves=1, persistence=0.5, lacunarity=2.0,
+        processes=None):
+        '''Returns an array where result[i, j, k, l] is
+        simplex4(xs[i], ys[j], zs[k], ws[l]). Animated volumes can pass a
+        single time value in `ws`.
+        '''
+        return self._grid('simplex4_array', (xs, ys, zs, ws),
+            octaves, persistence, lacunarity, processes)
 
 _instance = Noise()
 
 def simplex2(x, y, octaves=1, persistence=0.5, lacunarity=2.0):
     return _instance.simplex2(x, y, octaves, persistence, lacunarity)
+
+def simplex2_array(points, octaves=1, persistence=0.5, lacunarity=2.0):
+    return _instance.simplex2_array(points, octaves, persistence, lacunarity)
+
+def simplex2_grid(xs, ys, octaves=1, persistence=0.5, lacunarity=2.0,
+    processes=None):
+    return _instance.simplex2_grid(
+        xs, ys, octaves, persistence, lacunarity, processes)
+
+def simplex3(x, y, z, octaves=1, persistence=0.5, lacunarity=2.0):
+    return _instance.simplex3(x, y, z, octaves, persistence, lacunarity)
+
+def simplex3_array(points, octaves=1, persistence=0.5, lacunarity=2.0):
+    return _instance.simplex3_array(points, octaves, persistence, lacunarity)
+
+def simplex3_grid(xs, ys, zs, octaves=1, persistence=0.5, lacunarity=2.0,
+    processes=None):
+    return _instance.simplex3_grid(
+        xs, ys, zs, octaves, persistence, lacunarity, processes)
+
+def simplex4(x, y, z, w, octaves=1, persistence=0.5, lacunarity=2.0):
+    return _instance.simplex4(x, y, z, w, octaves, persistence, lacunarity)
+
+def simplex4_array(points, octaves=1, persistence=0.5, lacunarity=2.0):
+    return _instance.simplex4_array(points, octaves, persistence, lacunarity)
+
+def simplex4_grid(xs, ys, zs, ws, octaves=1, persistence=0.5,
+    lacunarity=2.0, processes=None):
+    return _instance.simplex4_grid(
+        xs, ys, zs, ws, octaves, persistence, lacunarity, processes)
@@ -1,56 +1,237 @@
-from .core import Mesh
-from .util import normal_from_points
+from .core import ArrayMesh, Mesh
+from .meshfile import MeshFile, write_streams
+from .util import vertex_tuples
 from itertools import izip_longest
+import hashlib
+import numpy as np
 import os
+import re
+import struct
+
+# the arguments of each line, without any trailing comment
+LINE_RE = {
+    'v': re.compile(r'^[ \t]*v[ \t]+([^\n\r#]*)', re.M),
+    'vt': re.compile(r'^[ \t]*vt[ \t]+([^\n\r#]*)', re.M),
+    'vn': re.compile(r'^[ \t]*vn[ \t]+([^\n\r#]*)', re.M),
+    'f': re.compile(r'^[ \t]*f[ \t]+([^\n\r#]*)', re.M),
+}
+KEYWORD_RE = re.compile(r'^[ \t]*(vt|vn|v|f)[ \t]', re.M)
+
+CACHE_EXTENSION = '.cache'
+# bumped when the parser changes, so that older caches are rebuilt
+CACHE_VERSION = 2
+CACHE_KEY = struct.Struct('<IQd20s')
+
+def parse_rows(lines):
+    '''Parses whitespace separated numbers from all lines at once. Returns
+    the flat values (with a NaN after each line) and the start index and
+    number of values for each line.
+    '''
+    values = np.fromstring(' nan '.join(lines) + ' nan', sep=' ')
+    ends = np.flatnonzero(np.isnan(values))
+    if len(ends) != len(lines):
+        # fromstring stops at the first token that is not a number, and
+        # nan tokens add markers, so parse line by line instead
+        rows = [[float(x) for x in line.split()] + [np.nan] for line in lines]
+        values = np.array([x for row in rows for x in row])
+        ends = np.cumsum([len(x) for x in rows]) - 1
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    return values, starts, ends - starts
+
+def parse_vectors(lines, components):
+    '''Parses `components` numbers from each line into an (N, components)
+    array. Missing components are zero and extra ones are ignored.
+    '''
+    if not lines:
+        return np.zeros((0, components))
+    values, starts, counts = parse_rows(lines)
+    if (counts == counts[0]).all() and counts[0] >= components:
+        data = np.delete(values, starts + counts).reshape((len(lines), -1))
+        return data[:, :components]
+    result = np.zeros((len(lines), components))
+    for i in xrange(components):
+        mask = counts > i
+        result[mask, i] = values[starts[mask] + i]
+    return result
+
+def uniform_corners(text, width):
+    '''Returns True if every corner in the face text has `width` indices,
+    none of them empty. v//vn corners must already be written as v/0/vn.
+    '''
+    data = np.frombuffer(text, dtype=np.uint8)
+    if width > 3 or not len(data):
+        return False
+    space = (data == ord(' ')) | (data == ord('\t')) | (data == ord('\n'))
+    separator = space | (data == ord('/'))
+    slash = np.flatnonzero(data == ord('/'))
+    # every slash sits between two indices
+    if len(slash) and (slash[0] == 0 or slash[-1] == len(data) - 1 or
+        separator[slash - 1].any() or separator[slash + 1].any()):
+        return False
+    starts = ~space
+    starts[1:] &= space[:-1]
+    corner = np.cumsum(starts)
+    slashes = np.bincount(corner[slash], minlength=corner[-1] + 1)[1:]
+    return (slashes == width - 1).all()
+
+def parse_faces(lines):
+    '''Parses face lines into an (N, 3) integer array of v/vt/vn indices
+    (zero when missing) and the number of corners in each face.
+    '''
+    text = '\n'.join(lines)
+    first = text.split(None, 1)[:1]
+    width = first[0].count('/') + 1 if first else 1
+    text = text.replace('//', '/0/')
+    if uniform_corners(text, width):
+        text = text.replace('/', ' ')
+        values, starts, counts = parse_rows(text.split('\n'))
+        data = np.delete(values, starts + counts).reshape((-1, width))
+        corners = np.zeros((len(data), 3), dtype=np.int64)
+        corners[:, :width] = data
+        return corners, counts // width
+    # mixed corner formats, fall back to splitting each token
+    rows = []
+    sizes = []
+    for line in lines:
+        args = line.split()
+        for arg in args:
+            row = (arg + '//').split('/')[:3]
+            rows.append([int(x) if x else 0 for x in row])
+        sizes.append(len(args))
+    return np.array(rows, dtype=np.int64), np.array(sizes)
+
+def resolve_indices(indices, counts):
+    '''Converts 1-based and negative (relative) OBJ indices into 0-based
+    indices. `counts` holds the number of elements defined before each
+    index. Missing indices become -1.
+    '''
+    return np.where(indices > 0, indices - 1,
+        np.where(indices < 0, counts + indices, -1))
+
+def parse_obj_arrays(data):
+    '''Parses OBJ source text into (positions, normals, uvs) float32
+    arrays with one row per triangle vertex.
+    '''
+    lines = dict((k, v.findall(data)) for k, v in LINE_RE.items())
+    lu_v = parse_vectors(lines['v'], 3)
+    lu_vt = parse_vectors(lines['vt'], 2)
+    lu_vn = parse_vectors(lines['vn'], 3)
+    if not lines['f']:
+        empty = np.zeros((0, 3), dtype=np.float32)
+        return empty, empty, np.zeros((0, 2), dtype=np.float32)
+    corners, sizes = parse_faces(lines['f'])
+    # number of v, vt and vn defined before each face, for negative indices
+    before = [len(lu_v), len(lu_vt), len(lu_vn)]
+    if (corners < 0).any():
+        keywords = np.array(KEYWORD_RE.findall(data))
+        faces = keywords == 'f'
+        before = [np.repeat(np.cumsum(keywords == k)[faces], sizes)
+            for k in ['v', 'vt', 'vn']]
+    v, vt, vn = [resolve_indices(corners[:, i], before[i]) for i in xrange(3)]
+    # triangulate each face as a fan around its first corner
+    starts = np.cumsum(sizes) - sizes
+    fans = np.maximum(sizes - 2, 0)
+    face = np.repeat(np.arange(len(sizes)), fans)
+    offset = np.arange(fans.sum()) - np.repeat(np.cumsum(fans) - fans, fans)
+    a = starts[face]
+    triangles = np.column_stack((a, a + offset + 1, a + offset + 2))
+    # drop degenerate triangles like normal_from_points would
+    p = lu_v[v[triangles]]
+    n = np.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+    d = np.sqrt((n * n).sum(axis=1))
+    valid = d > 0
+    triangles = triangles[valid]
+    n = n[valid] / d[valid][:, np.newaxis]
+    corners = triangles.ravel()
+    positions = p[valid].reshape((-1, 3)).astype(np.float32)
+    normals = np.repeat(n, 3, axis=0)
+    has_normal = vn[corners] >= 0
+    normals[has_normal] = lu_vn[vn[corners][has_normal]]
+    uv_index = vt[corners]
+    if (uv_index >= 0).any():
+        uvs = np.zeros((len(corners), 2))
+        uvs[uv_index >= 0] = lu_vt[uv_index[uv_index >= 0]]
+    else:
+        uvs = np.zeros((0, 2))
+    return positions, normals.astype(np.float32), uvs.astype(np.float32)
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        while True:
+            data = fp.read(1 << 20)
+            if not data:
+                break
+            digest.update(data)
+    return digest.digest()
+
+def read_cache(path, cache_path):
+    '''Returns memory-mapped (positions, normals, uvs) arrays from the
+    cache file, or None if it is missing or stale. The cache is a mesh file
+    keyed on the parser version and the size, modification time and SHA-1
+    of the source file.
+    '''
+    try:
+        cache = MeshFile(cache_path)
+        key = cache.read('source').tobytes()
+        version, size, mtime, digest = CACHE_KEY.unpack(key)
+    except Exception:
+        return None
+    stat = os.stat(path)
+    if version != CACHE_VERSION or size != stat.st_size:
+        return None
+    if mtime != stat.st_mtime:
+        if digest != file_digest(path):
+            return None
+        cache.write('source', cache_key(stat, digest))
+    result = [cache.read(x) for x in ('position', 'normal')]
+    if 'uv' in cache:
+        result.append(cache.read('uv'))
+    else:
+        result.append(np.zeros((0, 2), dtype=np.float32))
+    return tuple(result)
+
+def cache_key(stat, digest):
+    key = CACHE_KEY.pack(CACHE_VERSION, stat.st_size, stat.st_mtime, digest)
+    return np.frombuffer(key, dtype=np.uint8)
+
+def write_cache(path, cache_path, positions, normals, uvs):
+    key = cache_key(os.stat(path), file_digest(path))
+    streams = [('position', positions), ('normal', normals)]
+    if len(uvs):
+        streams.append(('uv', uvs))
+    streams.append(('source', key))
+    try:
+        write_streams(cache_path, streams)
+    except (IOError, OSError):
+        pass
+
+def load_obj_arrays(path, cache=True):
+    '''Loads (positions, normals, uvs) arrays from an OBJ file. When `cache`
+    is set, a binary copy of the parsed mesh is written next to the source
+    file and memory-mapped on later loads.
+    '''
+    cache_path = path + CACHE_EXTENSION
+    if cache:
+        result = read_cache(path, cache_path)
+        if result is not None:
+            return result
+    with open(path, 'r') as fp:
+        positions, normals, uvs = parse_obj_arrays(fp.read())
+    if cache:
+        write_cache(path, cache_path, positions, normals, uvs)
+    return positions, normals, uvs
+
+def load_obj(path, cache=True):
+    '''Loads an OBJ file into an ArrayMesh.'''
+    return ArrayMesh(*load_obj_arrays(path, cache))
 
 def parse_obj(path):
     if os.path.exists(path):
         with open(path, 'r') as fp:
             path = fp.read()
-    lines = path.split('\n')
-    lu_v = []
-    lu_vt = []
-    lu_vn = []
-    positions = []
-    normals = []
-    uvs = []
-    for line in lines:
-        line = line.strip()
-        if not line or line.startswith('#'):
-            continue
-        args = line.split()
-        keyword = args[0]
-        args = args[1:]
-        if keyword == 'v':
-            v = tuple(map(float, args))
-            lu_v.append(v)
-        elif keyword == 'vt':
-            vt = tuple(map(float, args))
-            lu_vt.append(vt)
-        elif keyword == 'vn':
-            vn = tuple(map(float, args))
-            lu_vn.append(vn)
-        elif keyword == 'f':
-            data = [(x + '//').split('/')[:3] for x in args]
-            data = [[(int(x) - 1) if x.isdigit() else None for x in row]
-                for row in data]
-            a = data[0]
-            for b, c in zip(data[1:], data[2:]):
-                try:
-                    n = normal_from_points(*[lu_v[x[0]] for x in [a, b, c]])
-                except ZeroDivisionError:
-                    continue
-                for vertex in [a, b, c]:
-                    v, vt, vn = vertex
-                    if v is not None:
-                        positions.append(lu_v[v])
-                    if vt is not None:
-                        uvs.append(lu_vt[vt])
-                    if vn is not None:
-                        normals.append(lu_vn[vn])
-                    else:
-                        normals.append(n)
-    return positions, normals, uvs
+    positions, normals, uvs = parse_obj_arrays(path)
+    return vertex_tuples(positions), vertex_tuples(normals), vertex_tuples(uvs)
 
 def save_obj(self, path):
     lines = []
@@ -82,9 +263,12 @@ def save_obj(self, path):
 Mesh.save_obj = save_obj
 
 class OBJ(Mesh):
-    def __init__(self, path):
+    def __init__(self, path, cache=True):
         super(OBJ, self).__init__()
-        positions, normals, uvs = parse_obj(path)
-        self.positions = positions
-        self.normals = normals
-        self.uvs = uvs
+        if os.path.exists(path):
+            positions, normals, uvs = load_obj_arrays(path, cache)
+        else:
+            positions, normals, uvs = parse_obj_arrays(path)
+        self.positions = vertex_tuples(positions)
+        self.normals = vertex_tuples(normals)
+        self.uvs = vertex_tuples(uvs)
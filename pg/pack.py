@@ -1,28 +1,8 @@
 from math import ceil, log
+import numpy as np
 
-class Node(object):
-    def __init__(self, x, y, w, h):
-        self.x = x
-        self.y = y
-        self.w = w
-        self.h = h
-        self.right = None
-        self.down = None
-    def insert(self, w, h):
-        if self.right:
-            result = self.right.insert(w, h)
-            if result:
-                return result
-            result = self.down.insert(w, h)
-            if result:
-                return result
-            return None
-        elif w <= self.w and h <= self.h:
-            self.right = Node(self.x + w, self.y, self.w - w, h)
-            self.down = Node(self.x, self.y + h, self.w, self.h - h)
-            return (self.x, self.y, w, h)
-        else:
-            return None
+NO_FIT = np.iinfo(np.int64).max
+EMPTY = np.zeros((0, 4), dtype=np.int64)
 
 def pot(x):
     return 2 ** int(ceil(log(x) / log(2)))
@@ -37,29 +17,208 @@ def estimate_size(sizes):
     h2 = pot(float(a) / w2)
     return (max(w1, w2), max(h1, h2))
 
-def try_pack(tw, th, items):
-    result = []
-    node = Node(0, 0, tw, th)
-    for index, (w, h) in items:
-        position = node.insert(w, h)
-        if position is None:
+def covering(rects, others):
+    '''Returns a mask whose [i, j] entry tells whether others[j] contains
+    rects[i].
+    '''
+    a = rects[:, None, :]
+    b = others[None, :, :]
+    return ((b[..., 0] <= a[..., 0]) & (b[..., 1] <= a[..., 1]) &
+        (b[..., 0] + b[..., 2] >= a[..., 0] + a[..., 2]) &
+        (b[..., 1] + b[..., 3] >= a[..., 1] + a[..., 3]))
+
+def prune(kept, created):
+    '''Returns the free rectangles left after dropping the newly created
+    ones that lie inside any other. `kept` must not contain each other.
+    '''
+    created = np.array(created, dtype=np.int64).reshape(-1, 4)
+    inner = covering(created, created)
+    equal = inner & inner.T
+    drop = (covering(created, kept).any(axis=1) |
+        (inner & ~equal).any(axis=1) | np.tril(equal, -1).any(axis=1))
+    return np.vstack((kept, created[~drop]))
+
+def best_fit(free, w, h):
+    '''Returns the index and the key of the free rectangle that leaves the
+    shortest side, then the longest side, after placing a w x h rectangle.
+    '''
+    dw = free[:, 2] - w
+    dh = free[:, 3] - h
+    key = (np.minimum(dw, dh) << 32) + np.maximum(dw, dh)
+    key[(dw < 0) | (dh < 0)] = NO_FIT
+    index = int(np.argmin(key))
+    return index, key[index]
+
+class MaxRects(object):
+    '''A bin that packs rectangles with the MaxRects algorithm, keeping
+    every maximal free rectangle and placing each new rectangle with the
+    best short side fit. With `rotate`, rectangles may be turned 90
+    degrees. Free rectangles are kept in an (n, 4) array of x, y, w, h.
+    '''
+    def __init__(self, width, height, rotate=False):
+        self.width = width
+        self.height = height
+        self.rotate = rotate
+        self.set_free(np.array([[0, 0, width, height]], dtype=np.int64))
+        self.used = 0
+        self.extent = (0, 0)
+        self.fixed = False
+    def set_free(self, free):
+        self.free = free
+        # the free sizes not dominated by any other, to tell quickly
+        # whether a rectangle fits at all
+        sizes = free[np.lexsort((-free[:, 3], -free[:, 2])), 2:]
+        tallest = np.maximum.accumulate(sizes[:, 1])
+        keep = np.ones(len(sizes), dtype=bool)
+        keep[1:] = sizes[1:, 1] > tallest[:-1]
+        self.sizes = sizes[keep].tolist()
+    def occupancy(self):
+        return float(self.used) / (self.width * self.height)
+    def find(self, w, h):
+        '''Returns (x, y, w, h, rotated) for the best spot or None.'''
+        if not any((w <= fw and h <= fh) or (self.rotate and h <= fw and
+            w <= fh) for fw, fh in self.sizes):
+            return None
+        index, key = best_fit(self.free, w, h)
+        rotated = False
+        if self.rotate and w != h:
+            other, other_key = best_fit(self.free, h, w)
+            if other_key < key:
+                index, key, rotated = other, other_key, True
+                w, h = h, w
+        if key == NO_FIT:
             return None
-        result.append((index, position))
-    result.sort()
-    result = [x[1] for x in result]
-    return result
+        x, y = self.free[index, :2]
+        return (int(x), int(y), w, h, rotated)
+    def insert(self, w, h):
+        result = self.find(w, h)
+        if result is not None:
+            self.place(result[:4])
+        return result
+    def place(self, rect):
+        x, y, w, h = rect
+        free = self.free
+        hit = ((free[:, 0] < x + w) & (free[:, 0] + free[:, 2] > x) &
+            (free[:, 1] < y + h) & (free[:, 1] + free[:, 3] > y))
+        created = []
+        for fx, fy, fw, fh in free[hit].tolist():
+            if x > fx:
+                created.append((fx, fy, x - fx, fh))
+            if x + w < fx + fw:
+                created.append((x + w, fy, fx + fw - x - w, fh))
+            if y > fy:
+                created.append((fx, fy, fw, y - fy))
+            if y + h < fy + fh:
+                created.append((fx, y + h, fw, fy + fh - y - h))
+        self.set_free(prune(free[~hit], created))
+        self.used += w * h
+        self.extent = (max(self.extent[0], x + w), max(self.extent[1], y + h))
+    def grow(self, width, height):
+        '''Enlarges the bin without moving any placed rectangle.'''
+        free = self.free.copy()
+        right = free[:, 0] + free[:, 2] == self.width
+        bottom = free[:, 1] + free[:, 3] == self.height
+        free[right, 2] = width - free[right, 0]
+        free[bottom, 3] = height - free[bottom, 1]
+        free = free.tolist()
+        if width > self.width:
+            free.append((self.width, 0, width - self.width, height))
+        if height > self.height:
+            free.append((0, self.height, width, height - self.height))
+        self.width, self.height = width, height
+        self.set_free(prune(EMPTY, free))
+    def trim(self):
+        '''Shrinks the bin to the extent of the placed rectangles.'''
+        width, height = self.extent
+        free = self.free.copy()
+        free[:, 2] = np.minimum(free[:, 0] + free[:, 2], width) - free[:, 0]
+        free[:, 3] = np.minimum(free[:, 1] + free[:, 3], height) - free[:, 1]
+        free = free[(free[:, 2] > 0) & (free[:, 3] > 0)]
+        self.width, self.height = width, height
+        self.set_free(prune(EMPTY, free))
 
-def pack(sizes):
-    items = enumerate(sizes)
-    items = sorted(items, key=lambda x: max(x[1]), reverse=True)
-    tw, th = estimate_size(sizes)
-    while True:
-        result = try_pack(tw, th, items)
-        if result:
-            tw = max(x + w for x, y, w, h in result)
-            th = max(y + h for x, y, w, h in result)
-            return (tw, th), result
-        if tw <= th:
-            tw *= 2
+class Packer(object):
+    '''Packs rectangles onto pages of at most `max_size` pixels per side.
+    Pages start small and double in size as needed. Once a page is fixed,
+    it keeps its size and only its free space is used, so more rectangles
+    can be inserted later without moving the ones already placed.
+    '''
+    def __init__(self, max_size=None, rotate=False):
+        self.max_size = max_size
+        self.rotate = rotate
+        self.pages = []
+    def occupancy(self):
+        area = sum(page.width * page.height for page in self.pages)
+        return float(sum(page.used for page in self.pages)) / area
+    def fits(self, w, h):
+        if self.max_size is None:
+            return True
+        m = self.max_size
+        return w <= m and h <= m
+    def grow(self, page):
+        '''Doubles the smaller side of a page, returning False if the page
+        cannot grow.
+        '''
+        m = self.max_size
+        w, h = page.width, page.height
+        if page.fixed:
+            return False
+        if m is None:
+            if w <= h:
+                w *= 2
+            else:
+                h *= 2
+        elif w >= m and h >= m:
+            return False
+        elif (w <= h and w < m) or h >= m:
+            w = min(w * 2, m)
         else:
-            th *= 2
+            h = min(h * 2, m)
+        page.grow(w, h)
+        return True
+    def insert(self, w, h, hint=None):
+        '''Returns (page, x, y, w, h, rotated) for a new rectangle. `hint`
+        is a function returning the initial size of a new page, if one is
+        needed.
+        '''
+        if not self.fits(w, h):
+            raise Exception('rectangle does not fit on a page')
+        for index, page in enumerate(self.pages):
+            result = page.insert(w, h)
+            while result is None and self.grow(page):
+                result = page.insert(w, h)
+            if result is not None:
+                return (index,) + result
+        hint = hint() if hint else (pot(w), pot(h))
+        if self.max_size is not None:
+            hint = tuple(min(x, self.max_size) for x in hint)
+        page = MaxRects(hint[0], hint[1], self.rotate)
+        self.pages.append(page)
+        result = page.insert(w, h)
+        while result is None and self.grow(page):
+            result = page.insert(w, h)
+        return (len(self.pages) - 1,) + result
+    def pack(self, sizes):
+        '''Inserts rectangles, largest first, and returns their placements
+        in the original order.
+        '''
+        items = sorted(enumerate(sizes),
+            key=lambda x: (max(x[1]), x[1][0] * x[1][1]), reverse=True)
+        result = [None] * len(items)
+        for i, (index, (w, h)) in enumerate(items):
+            hint = lambda: estimate_size([size for _, size in items[i:]])
+            result[index] = self.insert(w, h, hint)
+        return result
+    def fix(self):
+        '''Trims the pages that are not fixed yet and fixes them.'''
+        for page in self.pages:
+            if not page.fixed:
+                page.trim()
+                page.fixed = True
+
+def pack(sizes):
+    packer = Packer()
+    result = packer.pack(sizes)
+    packer.fix()
+    page = packer.pages[0]
+    return (page.width, page.height), [x[1:5] for x in result]
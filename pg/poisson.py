@@ -1,52 +1,250 @@
-from math import pi, sin, cos, hypot, floor
+'''Poisson-disc sampling with Bridson's algorithm.
+
+Samples live in a dense background grid whose cells are small enough to
+hold at most one sample, so a candidate only needs to look at a fixed set
+of nearby cells. Active samples are picked at random and removed by
+swapping with the last one, which keeps the whole algorithm linear in the
+number of samples. Boxes can be 2D or 3D, the minimum distance can vary
+with position, and very large boxes can be split into tiles that are
+sampled in parallel.
+'''
+from math import ceil, cos, pi, sin
+import itertools
+import multiprocessing
 import random
 
 class Grid(object):
-    def __init__(self, r):
+    def __init__(self, lo, hi, r, max_radius=None, radius=None):
+        self.lo = lo
+        self.hi = hi
         self.r = r
-        self.size = r / 2 ** 0.5
-        self.cells = {}
-    def points(self):
-        return self.cells.values()
-    def normalize(self, x, y):
-        i = int(floor(x / self.size))
-        j = int(floor(y / self.size))
-        return (i, j)
-    def nearby(self, x, y):
-        result = []
-        i, j = self.normalize(x, y)
-        for p in xrange(i - 2, i + 3):
-            for q in xrange(j - 2, j + 3):
-                if (p, q) in self.cells:
-                    result.append(self.cells[(p, q)])
+        self.max_radius = max(r, max_radius or r)
+        self.radius = radius
+        self.dimensions = len(lo)
+        self.size = r / self.dimensions ** 0.5
+        # margin of cells around the box for samples from neighboring tiles
+        self.pad = int(ceil(self.max_radius / self.size))
+        self.origin = [a - self.pad * self.size for a in lo]
+        self.shape = [int(ceil((b - a) / self.size)) + 1 + 2 * self.pad
+            for a, b in zip(lo, hi)]
+        self.strides = []
+        count = 1
+        for n in reversed(self.shape):
+            self.strides.insert(0, count)
+            count *= n
+        self.cells = [-1] * count
+        self.points = []
+        self.radii = []
+        # cells that can hold a sample closer than max_radius to any point
+        # of the center cell
+        self.offsets = []
+        limit = (self.max_radius / self.size) ** 2
+        for delta in itertools.product(
+            xrange(-self.pad, self.pad + 1), repeat=self.dimensions):
+            if sum(max(abs(x) - 1, 0) ** 2 for x in delta) < limit:
+                self.offsets.append(
+                    sum(x * s for x, s in zip(delta, self.strides)))
+    def index(self, point):
+        '''Returns the cell of a point, or -1 if it is outside the grid.'''
+        result = 0
+        for x, a, n, s in zip(point, self.origin, self.shape, self.strides):
+            i = (x - a) / self.size
+            if i < 0 or i >= n:
+                return -1
+            result += int(i) * s
         return result
-    def insert(self, x, y):
-        for bx, by in self.nearby(x, y):
-            if hypot(x - bx, y - by) < self.r:
+    def local_radius(self, point):
+        if self.radius is None:
+            return self.r
+        return min(max(self.radius(*point), self.r), self.max_radius)
+    def contains(self, point):
+        for x, a, b in zip(point, self.lo, self.hi):
+            if x < a or x > b:
                 return False
-        i, j = self.normalize(x, y)
-        self.cells[(i, j)] = (x, y)
         return True
-
-def poisson_disc(x1, y1, x2, y2, r, n):
-    x = x1 + (x2 - x1) / 2.0
-    y = y1 + (y2 - y1) / 2.0
-    active = [(x, y)]
-    grid = Grid(r)
-    grid.insert(x, y)
-    while active:
-        ax, ay = random.choice(active)
-        for i in xrange(n):
-            a = random.random() * 2 * pi
-            d = random.random() * r + r
-            x = ax + cos(a) * d
-            y = ay + sin(a) * d
-            if x < x1 or y < y1 or x > x2 or y > y2:
-                continue
-            if not grid.insert(x, y):
-                continue
-            active.append((x, y))
-            break
+    def fits(self, point, r):
+        '''Returns the cell of a point inside the box if no sample is closer
+        to it than the larger of their two radii, or -1 otherwise.
+        '''
+        cells = self.cells
+        points = self.points
+        radii = self.radii
+        variable = self.radius is not None
+        rr = r * r
+        size = self.size
+        if self.dimensions == 2:
+            x, y = point
+            ox, oy = self.origin
+            sx, sy = self.strides
+            c = int((x - ox) / size) * sx + int((y - oy) / size) * sy
+            for offset in self.offsets:
+                q = cells[c + offset]
+                if q >= 0:
+                    qx, qy = points[q]
+                    dx = x - qx
+                    dy = y - qy
+                    if variable:
+                        m = max(r, radii[q])
+                        rr = m * m
+                    if dx * dx + dy * dy < rr:
+                        return -1
         else:
-            active.remove((ax, ay))
-    return grid.points()
+            x, y, z = point
+            ox, oy, oz = self.origin
+            sx, sy, sz = self.strides
+            c = (int((x - ox) / size) * sx + int((y - oy) / size) * sy +
+                int((z - oz) / size) * sz)
+            for offset in self.offsets:
+                q = cells[c + offset]
+                if q >= 0:
+                    qx, qy, qz = points[q]
+                    dx = x - qx
+                    dy = y - qy
+                    dz = z - qz
+                    if variable:
+                        m = max(r, radii[q])
+                        rr = m * m
+                    if dx * dx + dy * dy + dz * dz < rr:
+                        return -1
+        return c
+    def insert(self, point, r, cell=None):
+        if cell is None:
+            cell = self.index(point)
+        if cell < 0:
+            return -1
+        self.cells[cell] = len(self.points)
+        self.points.append(point)
+        self.radii.append(r)
+        return cell
+    def candidate(self, point, r, rng):
+        '''Returns a random point at a distance between r and 2r.'''
+        d = r + rng.random() * r
+        a = rng.random() * 2 * pi
+        if self.dimensions == 2:
+            return (point[0] + cos(a) * d, point[1] + sin(a) * d)
+        z = rng.random() * 2 - 1
+        s = (1 - z * z) ** 0.5 * d
+        return (point[0] + cos(a) * s, point[1] + sin(a) * s, point[2] + z * d)
+    def fill(self, active, n, rng):
+        '''Runs Bridson's algorithm from the samples in `active`, trying up
+        to `n` candidates around each one.
+        '''
+        points = self.points
+        radii = self.radii
+        while active:
+            k = int(rng.random() * len(active))
+            point = points[active[k]]
+            r = radii[active[k]]
+            for _ in xrange(n):
+                candidate = self.candidate(point, r, rng)
+                if not self.contains(candidate):
+                    continue
+                local = self.local_radius(candidate)
+                cell = self.fits(candidate, local)
+                if cell < 0:
+                    continue
+                active.append(len(points))
+                self.insert(candidate, local, cell)
+                break
+            else:
+                active[k] = active[-1]
+                active.pop()
+
+def sample_tile(args):
+    '''Samples one tile, seeded with the nearby samples of tiles that were
+    already done. Returns the new samples and their radii.
+    '''
+    lo, hi, r, n, seed, radius, max_radius, seeds = args
+    rng = random.Random(seed)
+    grid = Grid(lo, hi, r, max_radius, radius)
+    active = []
+    for point, local in seeds:
+        if grid.insert(point, local) >= 0:
+            active.append(len(grid.points) - 1)
+    start = len(grid.points)
+    if not active:
+        point = tuple(a + rng.random() * (b - a) for a, b in zip(lo, hi))
+        grid.insert(point, grid.local_radius(point))
+        active.append(start)
+    grid.fill(active, n, rng)
+    return grid.points[start:], grid.radii[start:]
+
+def poisson_sample(lo, hi, r, n=32, seed=None, radius=None, max_radius=None,
+    tile_size=None, processes=None):
+    '''Returns a list of points in the 2D or 3D box from `lo` to `hi` that
+    are no closer than `r` to each other.
+
+    `n` is the number of candidates tried around each sample and `seed`
+    makes the result reproducible. `radius` can be a function of a
+    point's coordinates that returns the local minimum distance. Its
+    results are clamped between `r` and `max_radius`, which defaults to
+    4 * r.
+
+    With `tile_size`, the box is split into tiles that are sampled in
+    2 ** dimensions phases, so that tiles of the same phase never touch
+    and can run on `processes` worker processes (all cores by default).
+    Tiled results only depend on the seed, not on the number of
+    processes.
+    '''
+    lo = tuple(float(x) for x in lo)
+    hi = tuple(float(x) for x in hi)
+    if len(lo) not in (2, 3) or len(hi) != len(lo):
+        raise Exception('only 2D and 3D boxes are supported')
+    if radius is not None:
+        max_radius = max_radius or 4 * r
+    max_radius = max(r, max_radius or r)
+    rng = random.Random(seed)
+    if tile_size is None:
+        grid = Grid(lo, hi, r, max_radius, radius)
+        center = tuple((a + b) / 2 for a, b in zip(lo, hi))
+        grid.insert(center, grid.local_radius(center))
+        grid.fill([0], n, rng)
+        return grid.points
+    tile_size = max(tile_size, 2 * max_radius)
+    counts = [max(1, int(ceil((b - a) / tile_size))) for a, b in zip(lo, hi)]
+    sizes = [(b - a) / c for a, b, c in zip(lo, hi, counts)]
+    tiles = list(itertools.product(*[xrange(c) for c in counts]))
+    seeds = dict((tile, rng.getrandbits(32)) for tile in tiles)
+    done = {}
+    processes = processes or multiprocessing.cpu_count()
+    pool = None
+    try:
+        for phase in itertools.product((0, 1), repeat=len(lo)):
+            batch = [t for t in tiles
+                if all(i % 2 == p for i, p in zip(t, phase))]
+            tasks = []
+            for tile in batch:
+                a = tuple(x + i * s for x, i, s in zip(lo, tile, sizes))
+                b = tuple(x + s for x, s in zip(a, sizes))
+                near = []
+                for delta in itertools.product((-1, 0, 1), repeat=len(lo)):
+                    other = tuple(i + d for i, d in zip(tile, delta))
+                    for point, local in done.get(other, ()):
+                        if all(x > p - max_radius and x < q + max_radius
+                            for x, p, q in zip(point, a, b)):
+                            near.append((point, local))
+                tasks.append((a, b, r, n, seeds[tile], radius, max_radius,
+                    near))
+            if len(tasks) > 1 and processes > 1:
+                if pool is None:
+                    pool = multiprocessing.Pool(processes)
+                results = pool.map(sample_tile, tasks)
+            else:
+                results = map(sample_tile, tasks)
+            for tile, (points, radii) in zip(batch, results):
+                done[tile] = zip(points, radii)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    result = []
+    for tile in tiles:
+        result.extend(point for point, _ in done[tile])
+    return result
+
+def poisson_disc(x1, y1, x2, y2, r, n=32, seed=None, radius=None,
+    max_radius=None, tile_size=None, processes=None):
+    '''Returns a list of (x, y) points in the rectangle that are no closer
+    than `r` to each other. See poisson_sample for the other arguments.
+    '''
+    return poisson_sample((x1, y1), (x2, y2), r, n, seed, radius,
+        max_radius, tile_size, processes)
@@ -0,0 +1,277 @@
+'''Frame profiling.
+
+A Profiler times each phase of App.tick and Window.tick (poll_events,
+process_queue, update, draw and swap_buffers), any named CPU sections and,
+where timer queries are supported, named GPU sections. It keeps the last
+`frames` frames in a ring buffer for percentiles and can save them as a
+Chrome trace, to be opened in chrome://tracing or Perfetto.
+
+    profiler = pg.Profiler()
+    profiler.start()
+    ...
+    with profiler.gpu_section('shadows'):
+        draw_shadows()
+    ...
+    print profiler.report()
+    profiler.save_trace('trace.json')
+'''
+from .core import App, delete_objects
+from .font import TextBatch
+from collections import deque
+from contextlib import contextmanager
+from ctypes import byref, c_int, c_uint64
+from OpenGL.GL import *
+import json
+import numpy as np
+import time
+
+PERCENTILES = (50, 95, 99)
+
+def current_window():
+    return App.instance.current_window if App.instance else None
+
+class Frame(object):
+    '''The timings of one frame. `phases` and `gpu` map names to their
+    total seconds in the frame. `events` are (name, start, duration, track)
+    tuples, track 0 being the CPU and 1 the GPU. GPU timings arrive a frame
+    or more after the frame ends.
+    '''
+    def __init__(self, index, start):
+        self.index = index
+        self.start = start
+        self.duration = 0
+        self.phases = {}
+        self.gpu = {}
+        self.events = []
+        self.pending = 0
+    def add(self, totals, name, start, duration, track):
+        totals[name] = totals.get(name, 0) + duration
+        self.events.append((name, start, duration, track))
+
+class Profiler(object):
+    '''Records the timings of the last `frames` frames once started. With
+    `gpu`, gpu_section() also measures GPU time with GL_TIME_ELAPSED
+    queries, when the driver supports them.
+    '''
+    def __init__(self, frames=300, gpu=True):
+        self.history = deque(maxlen=frames)
+        self.frame = None
+        self.count = 0
+        self.stack = []
+        # timer queries are read back only once their results are available,
+        # at least one frame later, so the CPU never waits on the GPU. Query
+        # objects are not shared between contexts, so the free and pending
+        # queries are kept per window.
+        self.gpu = gpu and bool(glGetQueryObjectui64v)
+        self.queries = {}
+        self.pending = {}
+        self.gpu_section_active = False
+    def start(self, app=None):
+        (app or App.instance).profiler = self
+    def stop(self, app=None):
+        app = app or App.instance
+        if app.profiler is self:
+            app.profiler = None
+    def delete(self):
+        windows = App.instance.windows if App.instance else []
+        current = current_window()
+        for window in set(self.queries) | set(self.pending):
+            queries = self.queries.get(window, []) + [
+                x[3] for x in self.pending.get(window, [])]
+            if not queries or window not in windows + [None]:
+                continue
+            if window is not None:
+                window.use()
+            delete_objects(glDeleteQueries, *queries)
+        if current is not None:
+            current.use()
+        self.queries = {}
+        self.pending = {}
+    def begin_frame(self):
+        self.frame = Frame(self.count, time.time())
+        self.count += 1
+    def end_frame(self):
+        frame = self.frame
+        if frame is None:
+            return
+        frame.duration = time.time() - frame.start
+        self.history.append(frame)
+        self.frame = None
+        self.collect()
+    def begin(self, name):
+        self.stack.append((name, time.time()))
+    def end(self, name):
+        top, start = self.stack.pop()
+        if top != name:
+            raise Exception('profiler section %r ended inside %r' % (
+                name, top))
+        if self.frame is not None:
+            duration = time.time() - start
+            self.frame.add(self.frame.phases, name, start, duration, 0)
+    @contextmanager
+    def section(self, name):
+        '''Times a block of code on the CPU.'''
+        self.begin(name)
+        try:
+            yield
+        finally:
+            self.end(name)
+    @contextmanager
+    def gpu_section(self, name):
+        '''Times a block of code on the CPU and the GL commands it issues on
+        the GPU. GPU sections cannot be nested.
+        '''
+        if not self.gpu or self.frame is None or self.gpu_section_active:
+            with self.section(name):
+                yield
+            return
+        window = current_window()
+        queries = self.queries.setdefault(window, [])
+        query = queries.pop() if queries else glGenQueries(1)
+        start = time.time()
+        self.gpu_section_active = True
+        glBeginQuery(GL_TIME_ELAPSED, query)
+        try:
+            with self.section(name):
+                yield
+        finally:
+            glEndQuery(GL_TIME_ELAPSED)
+            self.gpu_section_active = False
+            self.frame.pending += 1
+            pending = self.pending.setdefault(window, deque())
+            pending.append((self.frame, name, start, query))
+    def collect(self):
+        '''Reads back the results of finished timer queries, in order, with
+        the context of the window that issued them current.
+        '''
+        windows = App.instance.windows if App.instance else []
+        current = current_window()
+        for window, pending in self.pending.items():
+            if window not in windows + [None]:
+                # a closed window took its queries with it
+                for frame, _, _, _ in pending:
+                    frame.pending -= 1
+                del self.pending[window]
+                self.queries.pop(window, None)
+                continue
+            if not pending:
+                continue
+            if window is not None and window is not current_window():
+                window.use()
+            self.collect_queries(pending, self.queries.setdefault(window, []))
+        if current is not None and current is not current_window():
+            current.use()
+    def collect_queries(self, pending, queries):
+        available = c_int()
+        elapsed = c_uint64()
+        while pending:
+            frame, name, start, query = pending[0]
+            glGetQueryObjectiv(
+                query, GL_QUERY_RESULT_AVAILABLE, byref(available))
+            if not available.value:
+                break
+            glGetQueryObjectui64v(query, GL_QUERY_RESULT, byref(elapsed))
+            pending.popleft()
+            queries.append(query)
+            frame.add(frame.gpu, name, start, elapsed.value * 1e-9, 1)
+            frame.pending -= 1
+    def frames(self):
+        '''Returns the recorded frames whose GPU timings are complete.'''
+        return [x for x in self.history if not x.pending]
+    def samples(self):
+        '''Returns a dict mapping "frame", each phase and each GPU section,
+        prefixed with "gpu:", to an array of per frame seconds.
+        '''
+        frames = self.frames()
+        names = set()
+        gpu_names = set()
+        for frame in frames:
+            names.update(frame.phases)
+            gpu_names.update(frame.gpu)
+        result = {}
+        result['frame'] = np.array([x.duration for x in frames])
+        for name in names:
+            result[name] = np.array([x.phases.get(name, 0) for x in frames])
+        for name in gpu_names:
+            result['gpu:' + name] = np.array(
+                [x.gpu.get(name, 0) for x in frames])
+        return result
+    def percentiles(self, percentiles=PERCENTILES):
+        '''Returns a dict mapping the names of samples() to their
+        percentiles, in seconds.
+        '''
+        result = {}
+        for name, values in self.samples().iteritems():
+            if len(values):
+                result[name] = tuple(np.percentile(values, percentiles))
+        return result
+    def report(self, percentiles=PERCENTILES):
+        '''Returns a table of percentiles in milliseconds, slowest first.'''
+        stats = self.percentiles(percentiles)
+        rows = sorted(stats.iteritems(), key=lambda x: x[1][-1], reverse=True)
+        header = '%-20s' % 'ms' + ''.join('%9s' % ('p%d' % x)
+            for x in percentiles)
+        lines = [header]
+        for name, values in rows:
+            lines.append('%-20s' % name[:20] +
+                ''.join('%9.2f' % (x * 1000) for x in values))
+        return '\n'.join(lines)
+    def trace_events(self):
+        events = []
+        for track, name in enumerate(['CPU', 'GPU']):
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': track,
+                'args': {'name': name},
+            })
+        for frame in self.history:
+            events.append({
+                'name': 'frame', 'ph': 'X', 'pid': 0, 'tid': 0,
+                'ts': frame.start * 1e6, 'dur': frame.duration * 1e6,
+                'args': {'index': frame.index},
+            })
+            for name, start, duration, track in frame.events:
+                events.append({
+                    'name': name, 'ph': 'X', 'pid': 0, 'tid': track,
+                    'ts': start * 1e6, 'dur': duration * 1e6,
+                })
+        return events
+    def save_trace(self, path):
+        '''Saves the recorded frames as a Chrome trace JSON file. GPU
+        sections are shown on their own track, starting when they were
+        issued by the CPU.
+        '''
+        with open(path, 'w') as fp:
+            json.dump({'traceEvents': self.trace_events()}, fp)
+
+class ProfilerOverlay(object):
+    '''Draws the profiler's percentiles as text, refreshed every `interval`
+    seconds. Call draw() at the end of the window's draw().
+    '''
+    def __init__(self, profiler, font, coord=(10, 10), interval=0.5):
+        self.profiler = profiler
+        self.batch = TextBatch(font)
+        self.coord = coord
+        self.interval = interval
+        self.line_height = (font.ascent + font.descent) * font.get_scale()
+        self.labels = []
+        self.last_update = None
+    def delete(self):
+        self.batch.delete()
+    def update(self):
+        lines = self.profiler.report().split('\n')
+        while len(self.labels) < len(lines):
+            x, y = self.coord
+            y += self.line_height * len(self.labels)
+            self.labels.append(self.batch.add('', (x, y)))
+        for label, line in zip(self.labels, lines):
+            if label.text != line:
+                label.text = line
+        for label in self.labels[len(lines):]:
+            if label.text:
+                label.text = ''
+    def draw(self):
+        now = time.time()
+        if self.last_update is None or now - self.last_update >= self.interval:
+            self.update()
+            self.last_update = now
+        self.batch.draw()
@@ -175,6 +175,97 @@ class DirectionalLightProgram(BaseProgram):
         context.use_texture = False
         context.use_color = False
 
+class InstancedDirectionalLightProgram(DirectionalLightProgram):
+    '''Like DirectionalLightProgram, but the model matrix is a per-instance
+    attribute so that many copies of a mesh can be drawn with one call to
+    ``Context.draw_instanced`` or ``Mesh.draw_instanced``. Normals are
+    transformed by the model matrix directly, so instance transforms should
+    only use uniform scaling. ``color`` can also be given per instance by
+    using a vertex buffer with a divisor.
+
+    :param matrix: the view-projection matrix, required
+    :param model_matrix: vertex buffer containing one model matrix per instance, required
+    :param position: vertex buffer containing vertex positions, required
+    :param normal: vertex buffer containing vertex normals, required
+    :param camera_position: the camera position in world space, required
+
+    The remaining parameters are the same as DirectionalLightProgram.
+    '''
+    VS = '''
+    #version 120
+
+    uniform mat4 matrix;
+
+    attribute mat4 model_matrix;
+    attribute vec4 position;
+    attribute vec3 normal;
+    attribute vec2 uv;
+    attribute vec3 color;
+
+    varying vec3 frag_position;
+    varying vec3 frag_normal;
+    varying vec2 frag_uv;
+    varying vec3 frag_color;
+
+    void main() {
+        vec4 world_position = model_matrix * position;
+        gl_Position = matrix * world_position;
+        frag_position = vec3(world_position);
+        frag_normal = normalize(mat3(model_matrix) * normal);
+        frag_uv = uv;
+        frag_color = color;
+    }
+    '''
+    def set_defaults(self, context):
+        context.light_direction = normalize((1, 1, 1))
+        context.object_color = (0.4, 0.6, 0.8)
+        context.ambient_color = (0.3, 0.3, 0.3)
+        context.light_color = (0.7, 0.7, 0.7)
+        context.specular_power = 32.0
+        context.specular_multiplier = 1.0
+        context.use_texture = False
+        context.use_color = False
+
+class SpriteProgram(TextureProgram):
+    '''Like TextureProgram, but expands one record per sprite into a quad in
+    the vertex shader. Used by ``pg.SpriteBatch`` with one instance per
+    sprite.
+
+    :param matrix: the model-view-projection matrix, required
+    :param corner: vertex buffer containing the six (0 or 1, 0 or 1) corners of a quad, required
+    :param center: per-instance (x, y, z) of the sprite, required
+    :param transform: per-instance (rotation, scale, anchor x, anchor y), required
+    :param size: per-instance size in pixels, required
+    :param coords: per-instance (u1, v1, u2, v2) texture coordinates, required
+    :param rotated: per-instance 1 if the frame is stored rotated, required
+    :param sampler: texture to use, required
+    '''
+    VS = '''
+    #version 120
+
+    uniform mat4 matrix;
+
+    attribute vec2 corner;
+    attribute vec3 center;
+    attribute vec4 transform;
+    attribute vec2 size;
+    attribute vec4 coords;
+    attribute float rotated;
+
+    varying vec2 frag_uv;
+
+    void main() {
+        vec2 offset = (corner - transform.zw) * size * transform.y;
+        float s = sin(transform.x);
+        float c = cos(transform.x);
+        vec2 position = center.xy + vec2(
+            offset.x * c - offset.y * s, offset.x * s + offset.y * c);
+        gl_Position = matrix * vec4(position, center.z, 1.0);
+        vec2 t = rotated > 0.5 ? vec2(1.0 - corner.y, corner.x) : corner;
+        frag_uv = mix(coords.xy, coords.zw, t);
+    }
+    '''
+
 # TODO: same as TextureProgram? consolidate?
 class TextProgram(BaseProgram):
     '''Renders 2D text using a font texture. Used by the built-in ``pg.Font``.
@@ -216,3 +307,35 @@ class TextProgram(BaseProgram):
     '''
     def set_defaults(self, context):
         pass
+
+class SDFTextProgram(TextProgram):
+    '''Renders 2D text using a signed distance field font texture, whose
+    alpha is 0.5 on the glyph outlines. Stays sharp at any scale. Used by
+    ``pg.Font`` with ``sdf=True``.
+
+    :param matrix: the model-view-projection matrix, required
+    :param position: vertex buffer containing vertex positions, required
+    :param uv: vertex buffer containing vertex texture coordinates, required
+    :param sampler: distance field texture to use, required
+    :param color: the text color (default: white)
+    '''
+    FS = '''
+    #version 120
+
+    uniform sampler2D sampler;
+    uniform vec4 color;
+
+    varying vec2 frag_uv;
+
+    void main() {
+        float d = texture2D(sampler, frag_uv).a;
+        float w = max(fwidth(d), 1e-4);
+        float a = smoothstep(0.5 - w, 0.5 + w, d);
+        if (a == 0) {
+            discard;
+        }
+        gl_FragColor = vec4(color.rgb, color.a * a);
+    }
+    '''
+    def set_defaults(self, context):
+        context.color = (1.0, 1.0, 1.0, 1.0)
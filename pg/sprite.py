@@ -1,25 +1,32 @@
-from .core import VertexBuffer, Texture, Context, App
+from .core import Texture, VertexBuffer, Context, App
 from .matrix import Matrix
-from .pack import pack
-from .programs import TextureProgram
+from .meshfile import MeshFile, lz4, write_streams
+from .pack import MaxRects, Packer
+from .programs import SpriteProgram, TextureProgram
 from .util import interleave
 from math import sin, cos
 from OpenGL.GL import *
 from PIL import Image
+import hashlib
+import json
+import numpy as np
 import os
 
-def load_directory(path):
-    names = []
-    images = []
+ATLAS_EXTENSION = '.atlas'
+ATLAS_VERSION = 2
+ATLAS_COMPRESSION = 'lz4' if lz4 else 'zlib'
+
+def list_directory(path):
     extensions = set(['.png', '.jpg'])
+    result = []
     for name in os.listdir(path):
         base, ext = os.path.splitext(name)
-        if ext.lower() not in extensions:
-            continue
-        im = Image.open(os.path.join(path, name))
-        names.append(base)
-        images.append(im)
-    return names, images
+        if ext.lower() in extensions:
+            result.append(os.path.join(path, name))
+    return result
+
+def load_directory(path):
+    return load_images(list_directory(path))
 
 def load_images(paths):
     names = []
@@ -31,34 +38,212 @@ def load_images(paths):
         images.append(im)
     return names, images
 
-class SpriteBatch(object):
-    def __init__(self, sheet):
+def atlas_key(paths, max_size, rotate):
+    '''Returns a SHA-1 of the names, sizes and modification times of the
+    images and of the packing options, as an array of bytes.
+    '''
+    entries = []
+    for path in sorted(paths):
+        stat = os.stat(path)
+        entries.append((os.path.basename(path), stat.st_size, stat.st_mtime))
+    data = repr((ATLAS_VERSION, SpriteSheet.PADDING, max_size, rotate, entries))
+    return np.frombuffer(hashlib.sha1(data).digest(), dtype=np.uint8)
+
+def encode_name(name):
+    '''Returns a JSON-safe (text, is_unicode) pair for a frame name.'''
+    if isinstance(name, unicode):
+        return (name, True)
+    return (name.decode('latin-1'), False)
+
+# columns of a sprite record
+FIELDS = {
+    'position': slice(0, 2),
+    'z': 2,
+    'rotation': 3,
+    'scale': 4,
+    'anchor': slice(5, 7),
+}
+RECORD_SIZE = 14
+
+# the two triangles of a quad as (i, j) corners
+CORNERS = np.array(
+    [(0, 0), (1, 0), (0, 1), (1, 0), (1, 1), (0, 1)], dtype=np.float32)
+
+def sprite_quads(records):
+    '''Expands (n, 14) sprite records into (n * 6, 5) vertices with
+    x, y, z, u, v components, the same as Sprite.get_vertex_data.
+    '''
+    r = records[:, None, :]
+    i = CORNERS[:, 0]
+    j = CORNERS[:, 1]
+    x = (i - r[..., 5]) * r[..., 7] * r[..., 4]
+    y = (j - r[..., 6]) * r[..., 8] * r[..., 4]
+    s = np.sin(r[..., 3])
+    c = np.cos(r[..., 3])
+    rotated = r[..., 13] > 0.5
+    tu = np.where(rotated, 1 - j, i)
+    tv = np.where(rotated, i, j)
+    result = np.empty((len(records), 6, 5), dtype=np.float32)
+    result[..., 0] = r[..., 0] + x * c - y * s
+    result[..., 1] = r[..., 1] + x * s + y * c
+    result[..., 2] = r[..., 2]
+    result[..., 3] = r[..., 9] + (r[..., 11] - r[..., 9]) * tu
+    result[..., 4] = r[..., 10] + (r[..., 12] - r[..., 10]) * tv
+    return result.reshape((-1, 5))
+
+class SpriteLayer(object):
+    '''The sprites of a batch that use one page of the sheet. Sprite state
+    is kept in an (n, 14) array of records with position, z, rotation,
+    scale, anchor, frame size, frame coords and a rotated flag, one row per
+    slot. Only the slots of changed sprites are uploaded, coalesced into
+    ranges, either as records for instanced drawing or as quads generated
+    in one vectorized pass.
+    '''
+    # clean slots bridged to merge two dirty ranges into one upload
+    GAP = 16
+    def __init__(self, page, instanced):
+        self.page = page
+        self.instanced = instanced
         self.sprites = []
-        self.minz = -10000
-        self.maxz = 10000
-        self.vb = VertexBuffer()
-        self.context = Context(TextureProgram())
-        self.context.sampler = sheet
-        self.context.position, self.context.uv = self.vb.slices(3, 2)
+        self.dirty = set()
+        self.records = np.zeros((0, RECORD_SIZE), dtype=np.float32)
+        self.capacity = 0
+        if instanced:
+            self.vb = VertexBuffer(divisor=1)
+            self.slices = self.vb.slices(3, 4, 2, 4, 1)
+        else:
+            self.vb = VertexBuffer()
+            self.slices = self.vb.slices(3, 2)
     def delete(self):
         self.vb.delete()
     def append(self, sprite):
+        count = len(self.sprites)
+        if count == len(self.records):
+            records = np.zeros((max(16, count * 2), RECORD_SIZE),
+                dtype=np.float32)
+            records[:count] = self.records
+            self.records = records
+        sprite.layer = self
+        sprite.slot = count
         self.sprites.append(sprite)
-    def get_vertex_data(self):
+        for name in FIELDS:
+            self.update(sprite, name)
+        self.update(sprite, 'frame')
+    def update(self, sprite, name):
+        row = self.records[sprite.slot]
+        if name == 'frame':
+            frame = sprite.frame
+            row[7:9] = frame.size
+            row[9:13] = frame.coords
+            row[13] = frame.rotated
+        else:
+            row[FIELDS[name]] = getattr(sprite, name)
+        self.dirty.add(sprite.slot)
+    def remove(self, sprite):
+        '''Removes a sprite by moving the last sprite into its slot.'''
+        last = self.sprites.pop()
+        self.dirty.discard(len(self.sprites))
+        if last is not sprite:
+            self.sprites[sprite.slot] = last
+            self.records[sprite.slot] = self.records[len(self.sprites)]
+            last.slot = sprite.slot
+            self.dirty.add(last.slot)
+        sprite.layer = sprite.slot = None
+    def ranges(self):
+        '''Returns the dirty slots as sorted (start, stop) ranges.'''
         result = []
-        for sprite in self.sprites:
-            result.extend(sprite.get_vertex_data())
+        for slot in sorted(self.dirty):
+            if result and slot - result[-1][1] <= SpriteLayer.GAP:
+                result[-1][1] = slot + 1
+            else:
+                result.append([slot, slot + 1])
+        return result
+    def vertices(self, start, stop):
+        records = self.records[start:stop]
+        return records if self.instanced else sprite_quads(records)
+    def upload(self):
+        if not self.dirty:
+            return
+        if len(self.sprites) > self.capacity:
+            self.capacity = len(self.records)
+            self.vb.set_data(self.vertices(0, self.capacity))
+        else:
+            size = 1 if self.instanced else 6
+            for start, stop in self.ranges():
+                self.vb.update(start * size, self.vertices(start, stop))
+        self.dirty = set()
+
+class SpriteBatch(object):
+    '''Draws many sprites of a sheet with one draw call per page. With
+    `instanced`, each sprite is uploaded as one record that SpriteProgram
+    expands into a quad. Otherwise the quads are built on the CPU. It
+    defaults to instancing when the driver supports it.
+    '''
+    def __init__(self, sheet, instanced=None):
+        if instanced is None:
+            instanced = bool(glDrawArraysInstanced)
+        self.minz = -10000
+        self.maxz = 10000
+        self.layers = {}
+        self.sheet = sheet
+        self.instanced = instanced
+        if instanced:
+            self.corners = VertexBuffer(CORNERS)
+            self.context = Context(SpriteProgram())
+            self.context.corner = self.corners
+        else:
+            self.context = Context(TextureProgram())
+    @property
+    def sprites(self):
+        result = []
+        for page in sorted(self.layers):
+            result.extend(self.layers[page].sprites)
         return result
+    def __len__(self):
+        return sum(len(x.sprites) for x in self.layers.itervalues())
+    def delete(self):
+        for layer in self.layers.itervalues():
+            layer.delete()
+        self.layers = {}
+        if self.instanced:
+            self.corners.delete()
+    def append(self, sprite):
+        if sprite.batch is not None:
+            sprite.batch.remove(sprite)
+        page = sprite.frame.page
+        if page not in self.layers:
+            self.layers[page] = SpriteLayer(page, self.instanced)
+        self.layers[page].append(sprite)
+        sprite.batch = self
+    def remove(self, sprite):
+        sprite.layer.remove(sprite)
+        sprite.batch = None
+    def invalidate(self, sprite, name):
+        if sprite.layer.page != sprite.frame.page:
+            self.append(sprite)
+        else:
+            sprite.layer.update(sprite, name)
     def draw(self, matrix=None):
-        dirty = not all(x.vertex_data for x in self.sprites)
         w, h = App.instance.current_window.size
         self.context.matrix = matrix or Matrix().orthographic(
             0, w, 0, h, self.minz, self.maxz)
-        if dirty:
-            self.vb.set_data(self.get_vertex_data())
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-        self.context.draw()
+        for page in sorted(self.layers):
+            layer = self.layers[page]
+            count = len(layer.sprites)
+            if not count:
+                continue
+            layer.upload()
+            self.context.sampler = self.sheet.textures[page]
+            if self.instanced:
+                (self.context.center, self.context.transform,
+                    self.context.size, self.context.coords,
+                    self.context.rotated) = layer.slices
+                self.context.draw_instanced(GL_TRIANGLES, count)
+            else:
+                self.context.position, self.context.uv = layer.slices
+                self.context.draw(count=count * 6)
         glDisable(GL_BLEND)
 
 class Sprite(object):
@@ -71,6 +256,9 @@ class Sprite(object):
         'z',
     ])
     def __init__(self, frame, batch=None):
+        self.batch = None
+        self.layer = None
+        self.slot = None
         self.vertex_data = None
         self.frame = frame
         self.anchor = (0.5, 0.5)
@@ -78,12 +266,14 @@ class Sprite(object):
         self.rotation = 0
         self.scale = 1
         self.z = 0
-        if batch:
+        if batch is not None:
             batch.append(self)
     def __setattr__(self, name, value):
+        super(Sprite, self).__setattr__(name, value)
         if name in Sprite.ATTRIBUTES:
             self.vertex_data = None
-        super(Sprite, self).__setattr__(name, value)
+            if self.batch is not None:
+                self.batch.invalidate(self, name)
     def get_vertex_data(self):
         if self.vertex_data:
             return self.vertex_data
@@ -97,57 +287,165 @@ class Sprite(object):
         coords = self.frame.coords
         u = (coords[0], coords[2])
         v = (coords[1], coords[3])
+        rotated = self.frame.rotated
         points = [(0, 0), (1, 0), (0, 1), (1, 1)]
         data = []
         for i, j in points:
             x, y = (i - ax) * fw * s, (j - ay) * fh * s
             x, y = px + x * rc - y * rs, py + x * rs + y * rc
-            data.append((x, y, z, u[i], v[j]))
+            if rotated:
+                # stored turned 90 degrees counterclockwise in the sheet
+                data.append((x, y, z, u[1 - j], v[i]))
+            else:
+                data.append((x, y, z, u[i], v[j]))
         indexes = [0, 1, 2, 1, 3, 2]
         self.vertex_data = [data[i] for i in indexes]
         return self.vertex_data
     def draw(self, context):
-        vb = VertexBuffer(self.get_vertex_data())
-        context.position, context.uv = vb.slices(3, 2)
+        stream = App.instance.current_window.get_stream_buffer(5)
+        first, count = stream.write(self.get_vertex_data())
+        context.position, context.uv = stream.slices(3, 2)
         glEnable(GL_BLEND)
         glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-        context.draw()
+        context.draw(first=first, count=count)
         glDisable(GL_BLEND)
-        vb.delete()
 
 class SpriteFrame(object):
-    def __init__(self, name, size, coords):
+    def __init__(self, name, size, coords, page=0, rotated=False):
         self.name = name
         self.size = size
         self.coords = coords
+        self.page = page
+        self.rotated = rotated
     def __call__(self, *args, **kwargs):
         return Sprite(self, *args, **kwargs)
 
 class SpriteSheet(object):
-    def __init__(self, unit, arg):
+    '''Packs images into one or more texture pages of at most `max_size`
+    pixels per side. Page i is bound to texture unit `unit + i`. With
+    `rotate`, images may be stored turned by 90 degrees to pack tighter.
+
+    Sheets built from a directory are cached by default in a `<dir>.atlas`
+    file written next to the directory. Pass `cache=False` to turn this off.
+    '''
+    PADDING = 1
+    def __init__(self, unit, arg, max_size=4096, rotate=False, cache=True):
+        '''When `arg` is a directory and `cache` is set, the packed pages and
+        frames are saved next to it and restored on later runs, as long as
+        the names, sizes and modification times of its images are the same.
+        `cache` can also be the path of the cache file.
+        '''
         if isinstance(arg, basestring):
             if os.path.isdir(arg):
-                names, images = load_directory(arg)
+                paths = list_directory(arg)
             else:
-                names, images = load_images([arg])
+                paths = [arg]
         else:
-            names, images = load_images(arg)
-        p = 1
-        sizes = [x.size for x in images]
-        sizes = [(w + p * 2, h + p * 2) for w, h in sizes]
-        size, positions = pack(sizes)
-        im = Image.new('RGBA', size)
-        tw, th = size
+            paths = list(arg)
+        if cache is True:
+            cache = None
+            if isinstance(arg, basestring) and os.path.isdir(arg):
+                cache = os.path.normpath(arg) + ATLAS_EXTENSION
+        self.unit = unit
+        self.packer = Packer(max_size, rotate)
+        self.images = []
+        self.textures = []
         self.lookup = {}
-        for name, image, (x, y, w, h) in zip(names, images, positions):
+        if cache:
+            key = atlas_key(paths, max_size, rotate)
+            if self.read_cache(cache, key):
+                return
+        self.add_images(*load_images(paths))
+        if cache:
+            self.write_cache(cache, key)
+    @property
+    def texture(self):
+        return self.textures[0]
+    def add(self, name, image):
+        '''Adds one image to the sheet and returns its frame.'''
+        self.add_images([name], [image])
+        return self.lookup[name]
+    def add_images(self, names, images):
+        '''Adds images to the sheet without moving the frames that are
+        already packed. New images go into the free space of existing pages
+        or onto new pages, and only the changed regions are uploaded.
+        '''
+        p = SpriteSheet.PADDING
+        images = [Image.open(x) if isinstance(x, basestring) else x
+            for x in images]
+        sizes = [(w + p * 2, h + p * 2) for w, h in (x.size for x in images)]
+        old_pages = len(self.packer.pages)
+        placements = self.packer.pack(sizes)
+        self.packer.fix()
+        for page in self.packer.pages[old_pages:]:
+            self.images.append(Image.new('RGBA', (page.width, page.height)))
+        for name, image, placement in zip(names, images, placements):
+            page, x, y, w, h, rotated = placement
+            if rotated:
+                image = image.transpose(Image.ROTATE_90)
+            self.images[page].paste(image, (x + p, y + p))
+            if page < old_pages:
+                self.textures[page].update(image, (x + p, y + p))
+            tw, th = self.images[page].size
             u1 = (x + p) / float(tw - 1)
             u2 = (x + w - p) / float(tw - 1)
             v2 = 1 - (y + p) / float(th - 1)
             v1 = 1 - (y + h - p) / float(th - 1)
-            im.paste(image, (x + p, y + p))
-            frame = SpriteFrame(name, (w, h), (u1, v1, u2, v2))
-            self.lookup[name] = frame
-        self.texture = Texture(unit, im)
+            self.lookup[name] = SpriteFrame(
+                name, image.size[::-1] if rotated else image.size,
+                (u1, v1, u2, v2), page, rotated)
+        for page in xrange(old_pages, len(self.images)):
+            self.textures.append(
+                Texture(self.unit + page, self.images[page]))
+    def read_cache(self, path, key):
+        '''Restores the pages and frames from a cache file. Returns False if
+        the file is missing or was written for other images.
+        '''
+        try:
+            cache = MeshFile(path)
+            if not np.array_equal(cache.read('key'), key):
+                return False
+            table = json.loads(cache.read('table').tobytes())
+            for index, (size, used, extent) in enumerate(table['pages']):
+                page = MaxRects(size[0], size[1], self.packer.rotate)
+                page.set_free(cache.read('free%d' % index).astype(np.int64))
+                page.used = used
+                page.extent = tuple(extent)
+                page.fixed = True
+                im = Image.frombuffer('RGBA', tuple(size),
+                    cache.read('page%d' % index).tobytes(), 'raw', 'RGBA', 0, 1)
+                self.packer.pages.append(page)
+                self.images.append(im)
+        except Exception:
+            self.packer.pages = []
+            self.images = []
+            return False
+        for (name, text), size, coords, page, rotated in table['frames']:
+            if not text:
+                name = name.encode('latin-1')
+            self.lookup[name] = SpriteFrame(
+                name, tuple(size), tuple(coords), page, rotated)
+        for page, im in enumerate(self.images):
+            self.textures.append(Texture(self.unit + page, im))
+        return True
+    def write_cache(self, path, key):
+        pages = []
+        streams = [('key', key)]
+        for index, (page, im) in enumerate(zip(self.packer.pages, self.images)):
+            pages.append((im.size, page.used, page.extent))
+            data = np.frombuffer(im.tobytes(), dtype=np.uint8)
+            streams.append(('page%d' % index, data.reshape((-1, 4))))
+            streams.append(('free%d' % index, page.free.astype(np.uint32)))
+        # byte string names need not be valid UTF-8, so they are stored as
+        # latin-1, which maps every byte to one character and back
+        frames = [(encode_name(x.name), x.size, x.coords, x.page, x.rotated)
+            for x in self.lookup.itervalues()]
+        table = json.dumps({'pages': pages, 'frames': frames})
+        streams.append(('table', np.frombuffer(table, dtype=np.uint8)))
+        try:
+            write_streams(path, streams, ATLAS_COMPRESSION)
+        except (IOError, OSError):
+            pass
     def get_uniform_value(self):
         return self.texture.unit
     def get(self, name):
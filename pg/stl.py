@@ -1,9 +1,16 @@
-from .core import Mesh
-from .util import normal_from_points
+from .core import ArrayMesh, Mesh
+from .util import normal_from_points, vertex_tuples
 from itertools import izip_longest
+import numpy as np
 import os
 import struct
 
+STL_DTYPE = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attribute', '<u2'),
+])
+
 def parse_ascii_stl(data):
     if os.path.exists(data):
         with open(data, 'r') as fp:
@@ -27,26 +34,89 @@ def parse_ascii_stl(data):
         normals.extend([n, n, n])
     return positions, normals, uvs
 
-def parse_binary_stl(data):
-    if os.path.exists(data):
+def is_path(data):
+    return '\x00' not in data and os.path.exists(data)
+
+def read_header(data):
+    if is_path(data):
         with open(data, 'rb') as fp:
-            data = fp.read()
-    positions = []
-    normals = []
-    uvs = []
-    count = struct.unpack('<I', data[80:84])[0]
-    for i in xrange(count):
-        index = 84 + i * 50
-        n, v1, v2, v3 = [struct.unpack('<fff', data[i:i+12]) for i in
-            xrange(index, index + 48, 12)]
-        if not any(n):
-            try:
-                n = normal_from_points(v1, v2, v3)
-            except ZeroDivisionError:
-                continue
-        positions.extend([v1, v2, v3])
-        normals.extend([n, n, n])
-    return positions, normals, uvs
+            return fp.read(84)
+    return data[:84]
+
+def is_ascii_stl(data):
+    return read_header(data).lstrip().startswith('solid')
+
+def read_binary_stl(data):
+    '''Returns the triangle records of a binary STL as a NumPy array with
+    the `STL_DTYPE` record type. Files are memory-mapped, not read. Bytes
+    after the last record, which some exporters add, are ignored.
+    '''
+    header = read_header(data)
+    size = os.path.getsize(data) if is_path(data) else len(data)
+    if len(header) < 84:
+        raise Exception('invalid binary STL')
+    count = struct.unpack('<I', header[80:84])[0]
+    if size < 84 + count * STL_DTYPE.itemsize:
+        raise Exception('invalid binary STL')
+    if count == 0:
+        return np.zeros(0, dtype=STL_DTYPE)
+    if is_path(data):
+        return np.memmap(
+            data, dtype=STL_DTYPE, mode='r', offset=84, shape=(count,))
+    return np.frombuffer(data, dtype=STL_DTYPE, count=count, offset=84)
+
+def triangle_arrays(records):
+    '''Converts STL triangle records into (positions, normals) arrays with
+    one row per vertex. Zero normals are recomputed from the vertices and
+    degenerate triangles without a normal are dropped.
+    '''
+    vertices = np.array(records['vertices'], dtype=np.float32)
+    normals = np.array(records['normal'], dtype=np.float32)
+    missing = np.flatnonzero(~normals.any(axis=1))
+    if len(missing):
+        v = vertices[missing]
+        n = np.cross(v[:, 1] - v[:, 0], v[:, 2] - v[:, 0])
+        d = np.sqrt((n * n).sum(axis=1))
+        valid = d > 0
+        normals[missing[valid]] = n[valid] / d[valid][:, np.newaxis]
+        keep = np.ones(len(vertices), dtype=bool)
+        keep[missing[~valid]] = False
+        vertices = vertices[keep]
+        normals = normals[keep]
+    positions = vertices.reshape((-1, 3))
+    normals = np.repeat(normals, 3, axis=0)
+    return positions, normals
+
+def load_binary_stl(data):
+    return triangle_arrays(read_binary_stl(data))
+
+def iter_binary_stl(data, chunk_size=65536):
+    '''Yields (positions, normals) arrays for up to `chunk_size` triangles
+    at a time, so that large files can be streamed into a VertexBuffer:
+
+        vb = VertexBuffer()
+        for positions, normals in iter_binary_stl(path):
+            vb.extend(positions)
+    '''
+    records = read_binary_stl(data)
+    for i in xrange(0, len(records), chunk_size):
+        yield triangle_arrays(records[i:i+chunk_size])
+
+def parse_binary_stl(data):
+    positions, normals = load_binary_stl(data)
+    return vertex_tuples(positions), vertex_tuples(normals), []
+
+def load_stl(path):
+    '''Loads an STL file into an ArrayMesh. Files are read as binary STLs
+    unless they are not valid ones and start with "solid".
+    '''
+    try:
+        positions, normals = load_binary_stl(path)
+    except Exception:
+        if not is_ascii_stl(path):
+            raise
+        positions, normals, uvs = parse_ascii_stl(path)
+    return ArrayMesh(positions, normals)
 
 def save_binary_stl(self, path):
     p = self.positions
@@ -73,6 +143,8 @@ class STL(Mesh):
         try:
             positions, normals, uvs = parse_binary_stl(path)
         except Exception:
+            if not is_ascii_stl(path):
+                raise
             positions, normals, uvs = parse_ascii_stl(path)
         self.positions = positions
         self.normals = normals
@@ -0,0 +1,314 @@
+'''GL call instrumentation.
+
+A GLTracer wraps every GL function that pg modules call and counts the
+calls per frame. It flags calls that set state to the value it already has
+(binding the bound program, buffer, texture or vertex array, enabling an
+enabled capability, uploading an unchanged uniform) and sums draw calls,
+vertices and bytes uploaded. It only wraps Python functions, so it works
+with any driver, including software ones like Mesa llvmpipe, and can
+assert call budgets in tests:
+
+    tracer = pg.GLTracer()
+    tracer.start()
+    window.redraw()
+    tracer.end_frame()
+    tracer.assert_budget(draw_calls=3, redundant=0, glUseProgram=2)
+    tracer.stop()
+
+While started, App.tick ends a frame on every tick. Calls made from code
+that imports the GL functions itself, rather than using pg.glFoo, are not
+seen.
+'''
+from .core import App, Uniform
+from collections import defaultdict
+import gc
+import numpy as np
+import OpenGL.GL
+import sys
+
+def handles(value):
+    return [int(x) for x in np.ravel(value).tolist()]
+
+def key_value(value):
+    # a hashable copy of a uniform value, which may be a ctypes or numpy
+    # array that is changed in place later
+    if isinstance(value, (int, long, float)):
+        return value
+    return tuple(np.ravel(value).tolist())
+
+class Frame(object):
+    '''The GL calls of one frame. `calls` and `redundant` map function
+    names to counts.
+    '''
+    def __init__(self, index):
+        self.index = index
+        self.calls = defaultdict(int)
+        self.redundant = defaultdict(int)
+        self.draw_calls = 0
+        self.vertices = 0
+        self.bytes_uploaded = 0
+    @property
+    def total_calls(self):
+        return sum(self.calls.itervalues())
+    @property
+    def total_redundant(self):
+        return sum(self.redundant.itervalues())
+    def report(self):
+        lines = ['frame %d: %d calls, %d redundant, %d draw calls, '
+            '%d vertices, %d bytes uploaded' % (self.index, self.total_calls,
+            self.total_redundant, self.draw_calls, self.vertices,
+            self.bytes_uploaded)]
+        for name, count in sorted(self.calls.iteritems(),
+            key=lambda x: (-x[1], x[0])):
+            line = '%8d %s' % (count, name)
+            if self.redundant.get(name):
+                line += ' (%d redundant)' % self.redundant[name]
+            lines.append(line)
+        return '\n'.join(lines)
+
+class GLTracer(object):
+    '''Counts the GL calls of the last `frames` frames once started.'''
+    def __init__(self, frames=300):
+        self.frames = []
+        self.max_frames = frames
+        self.frame = Frame(0)
+        # the state set by the calls seen so far, per window
+        self.states = {}
+        self.wrappers = {}
+        self.patched = []
+        self.original_funcs = None
+        self.app = None
+        self.handlers = {
+            'glUseProgram': self.on_use_program,
+            'glActiveTexture': self.on_active_texture,
+            'glBindTexture': self.on_bind_texture,
+            'glBindBuffer': self.on_bind_buffer,
+            'glBindBufferBase': self.on_bind_buffer_base,
+            'glBindVertexArray': self.on_bind_vertex_array,
+            'glEnable': self.on_enable,
+            'glDisable': self.on_disable,
+            'glEnableVertexAttribArray': self.on_enable_attrib,
+            'glDisableVertexAttribArray': self.on_disable_attrib,
+            'glVertexAttribDivisor': self.on_divisor,
+            'glBlendFunc': self.on_blend_func,
+            'glDeleteBuffers': self.on_delete_buffers,
+            'glDeleteTextures': self.on_delete_textures,
+            'glDeleteVertexArrays': self.on_delete_vertex_arrays,
+            'glDeleteProgram': self.on_delete_program,
+            'glBufferData': self.on_buffer_data,
+            'glBufferSubData': self.on_buffer_sub_data,
+            'glTexImage2D': self.on_tex_image,
+            'glTexSubImage2D': self.on_tex_image,
+            'glDrawArrays': self.on_draw_arrays,
+            'glDrawElements': self.on_draw_elements,
+            'glDrawArraysInstanced': self.on_draw_arrays_instanced,
+            'glDrawElementsInstanced': self.on_draw_elements_instanced,
+        }
+    # patching
+    def start(self, app=None):
+        '''Wraps the GL functions in the pg modules and, if there is an
+        App, ends a frame on every App.tick.
+        '''
+        if self.original_funcs is not None:
+            return
+        for module in self.modules():
+            for name, value in vars(module).items():
+                wrapper = self.wrap(name, value)
+                if wrapper is not None:
+                    setattr(module, name, wrapper)
+                    self.patched.append((module, name, value))
+        # uniforms look up their functions once, when they are created
+        self.original_funcs = Uniform.FUNCS
+        Uniform.FUNCS = dict((key, tuple(self.wrap_any(x) for x in value))
+            for key, value in self.original_funcs.iteritems())
+        for obj in gc.get_objects():
+            if isinstance(obj, Uniform):
+                obj.func = self.wrap_any(obj.func)
+                obj.array_func = self.wrap_any(obj.array_func)
+        self.app = app or App.instance
+        if self.app is not None:
+            self.app.tracer = self
+    def stop(self):
+        '''Restores the original GL functions.'''
+        for module, name, value in reversed(self.patched):
+            setattr(module, name, value)
+        self.patched = []
+        if self.original_funcs is None:
+            return
+        Uniform.FUNCS = self.original_funcs
+        self.original_funcs = None
+        for obj in gc.get_objects():
+            if isinstance(obj, Uniform):
+                obj.func = self.unwrap(obj.func)
+                obj.array_func = self.unwrap(obj.array_func)
+        if self.app is not None and self.app.tracer is self:
+            self.app.tracer = None
+        self.app = None
+    def modules(self):
+        return [module for name, module in sys.modules.items()
+            if module is not None and (name == 'pg' or name.startswith('pg.'))
+            and module is not sys.modules[__name__]]
+    def wrap(self, name, value):
+        # only GL functions that the driver provides are wrapped, so that
+        # checks like bool(glGenVertexArrays) still work
+        if not name.startswith('gl') or not callable(value):
+            return None
+        if getattr(OpenGL.GL, name, None) is not value or not bool(value):
+            return None
+        return self.wrap_any(value)
+    def wrap_any(self, func):
+        if func is None or getattr(func, 'traced', False):
+            return func
+        if func in self.wrappers:
+            return self.wrappers[func]
+        name = func.__name__
+        handler = self.handlers.get(name)
+        if handler is None and name.startswith('glUniform') and (
+            'Block' not in name):
+            handler = lambda frame, args: self.on_uniform(frame, name, args)
+        def wrapper(*args, **kwargs):
+            frame = self.frame
+            frame.calls[name] += 1
+            if handler is not None:
+                handler(frame, args)
+            return func(*args, **kwargs)
+        wrapper.__name__ = name
+        wrapper.traced = True
+        wrapper.original = func
+        self.wrappers[func] = wrapper
+        return wrapper
+    def unwrap(self, func):
+        return getattr(func, 'original', func)
+    # frames
+    def end_frame(self):
+        '''Ends the current frame and returns it.'''
+        frame = self.frame
+        self.frames.append(frame)
+        del self.frames[:-self.max_frames]
+        self.frame = Frame(frame.index + 1)
+        return frame
+    def last_frame(self):
+        return self.frames[-1] if self.frames else self.frame
+    def assert_budget(self, frame=None, calls=None, redundant=None,
+        draw_calls=None, vertices=None, bytes_uploaded=None, **functions):
+        '''Raises an AssertionError if the last ended frame, or `frame`,
+        exceeds any of the given limits. Keyword arguments named after GL
+        functions limit the calls to those functions.
+        '''
+        frame = frame or self.last_frame()
+        limits = [
+            ('calls', frame.total_calls, calls),
+            ('redundant calls', frame.total_redundant, redundant),
+            ('draw calls', frame.draw_calls, draw_calls),
+            ('vertices', frame.vertices, vertices),
+            ('bytes uploaded', frame.bytes_uploaded, bytes_uploaded),
+        ]
+        for name, limit in sorted(functions.iteritems()):
+            limits.append((name, frame.calls.get(name, 0), limit))
+        errors = ['%s: %d > %d' % (name, value, limit)
+            for name, value, limit in limits
+            if limit is not None and value > limit]
+        if errors:
+            raise AssertionError('GL budget exceeded in frame %d: %s\n%s' % (
+                frame.index, ', '.join(errors), frame.report()))
+    # state tracking
+    def state(self):
+        window = App.instance.current_window if App.instance else None
+        return self.states.setdefault(window, {})
+    def set(self, frame, name, key, value):
+        state = self.state()
+        if key in state and state[key] == value:
+            frame.redundant[name] += 1
+        state[key] = value
+    def on_use_program(self, frame, args):
+        self.set(frame, 'glUseProgram', 'program', int(args[0]))
+    def on_active_texture(self, frame, args):
+        self.set(frame, 'glActiveTexture', 'active_texture', int(args[0]))
+    def on_bind_texture(self, frame, args):
+        unit = self.state().get('active_texture')
+        key = ('texture', unit, int(args[0]))
+        self.set(frame, 'glBindTexture', key, int(args[1]))
+    def on_bind_buffer(self, frame, args):
+        target = int(args[0])
+        key = ('buffer', target)
+        if target == OpenGL.GL.GL_ELEMENT_ARRAY_BUFFER:
+            # the element array binding belongs to the vertex array object
+            key += (self.state().get('vertex_array', 0),)
+        self.set(frame, 'glBindBuffer', key, int(args[1]))
+    def on_bind_buffer_base(self, frame, args):
+        key = ('buffer_base', int(args[0]), int(args[1]))
+        self.set(frame, 'glBindBufferBase', key, int(args[2]))
+    def on_bind_vertex_array(self, frame, args):
+        self.set(frame, 'glBindVertexArray', 'vertex_array', int(args[0]))
+    def on_enable(self, frame, args):
+        self.set(frame, 'glEnable', ('enable', int(args[0])), True)
+    def on_disable(self, frame, args):
+        self.set(frame, 'glDisable', ('enable', int(args[0])), False)
+    def attrib_key(self, name, location):
+        vertex_array = self.state().get('vertex_array', 0)
+        return (name, vertex_array, int(location))
+    def on_enable_attrib(self, frame, args):
+        key = self.attrib_key('attrib_array', args[0])
+        self.set(frame, 'glEnableVertexAttribArray', key, True)
+    def on_disable_attrib(self, frame, args):
+        key = self.attrib_key('attrib_array', args[0])
+        self.set(frame, 'glDisableVertexAttribArray', key, False)
+    def on_divisor(self, frame, args):
+        key = self.attrib_key('divisor', args[0])
+        self.set(frame, 'glVertexAttribDivisor', key, int(args[1]))
+    def on_blend_func(self, frame, args):
+        self.set(frame, 'glBlendFunc', 'blend_func', tuple(args))
+    def on_uniform(self, frame, name, args):
+        program = self.state().get('program')
+        key = ('uniform', program, int(args[0]))
+        self.set(frame, name, key, tuple(key_value(x) for x in args[1:]))
+    def forget(self, match):
+        for state in self.states.itervalues():
+            for key in [x for x in state if match(x, state[x])]:
+                del state[key]
+    def on_delete_buffers(self, frame, args):
+        deleted = set(handles(args[1]))
+        self.forget(lambda key, value: key[0] in ('buffer', 'buffer_base')
+            and value in deleted)
+    def on_delete_textures(self, frame, args):
+        # PyOpenGL's glDeleteTextures takes the array alone
+        deleted = set(handles(args[-1]))
+        self.forget(lambda key, value: key[0] == 'texture'
+            and value in deleted)
+    def on_delete_vertex_arrays(self, frame, args):
+        deleted = set(handles(args[1]))
+        def match(key, value):
+            if key == 'vertex_array':
+                return value in deleted
+            if key[0] in ('attrib_array', 'divisor'):
+                return key[1] in deleted
+            return key[0] == 'buffer' and len(key) == 3 and key[2] in deleted
+        self.forget(match)
+    def on_delete_program(self, frame, args):
+        program = int(args[0])
+        self.forget(lambda key, value: (key == 'program' and
+            value == program) or (key[0] == 'uniform' and key[1] == program))
+    # uploads and draws
+    def on_buffer_data(self, frame, args):
+        if len(args) == 4 and args[2] is not None:
+            frame.bytes_uploaded += int(args[1])
+    def on_buffer_sub_data(self, frame, args):
+        frame.bytes_uploaded += int(args[2])
+    def on_tex_image(self, frame, args):
+        data = args[-1]
+        if isinstance(data, str):
+            frame.bytes_uploaded += len(data)
+        elif data is not None:
+            frame.bytes_uploaded += np.asarray(data).nbytes
+    def on_draw_arrays(self, frame, args):
+        frame.draw_calls += 1
+        frame.vertices += int(args[2])
+    def on_draw_elements(self, frame, args):
+        frame.draw_calls += 1
+        frame.vertices += int(args[1])
+    def on_draw_arrays_instanced(self, frame, args):
+        frame.draw_calls += 1
+        frame.vertices += int(args[2]) * int(args[3])
+    def on_draw_elements_instanced(self, frame, args):
+        frame.draw_calls += 1
+        frame.vertices += int(args[1]) * int(args[4])
@@ -1,5 +1,6 @@
 from collections import defaultdict
 from ctypes import create_string_buffer
+import numpy as np
 import struct
 
 def hex_color(value):
@@ -193,3 +194,35 @@ def pack_list(fmt, data):
     '''
     func = struct.Struct(fmt).pack
     return create_string_buffer(''.join([func(x) for x in data]))
+
+def pack_vertices(data):
+    '''Converts vertex data into a buffer suitable for uploading to OpenGL.
+
+    `data` can be a list of tuples or a 2-dimensional NumPy array. Returns
+    a (vertex_count, components, buffer) tuple. C-contiguous float32 arrays
+    are returned as-is, without copying.
+    '''
+    if isinstance(data, np.ndarray):
+        data = np.ascontiguousarray(data, dtype=np.float32)
+        if data.ndim == 1:
+            data = data.reshape((-1, 1))
+        return data.shape[0], data.shape[1], data
+    components = len(data[0])
+    flat = flatten(data)
+    if len(flat) != len(data) * components:
+        raise Exception
+    return len(data), components, pack_list('<f', flat)
+
+def vertex_array(data, components):
+    '''Converts `data` into a contiguous float32 NumPy array with shape
+    (N, components). `None` and empty sequences produce an empty array.
+    '''
+    if data is None or len(data) == 0:
+        return np.zeros((0, components), dtype=np.float32)
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    return data.reshape((-1, components))
+
+def vertex_tuples(array):
+    '''Converts a 2-dimensional NumPy array into a list of tuples.
+    '''
+    return map(tuple, array.tolist())
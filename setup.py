@@ -10,6 +10,7 @@ setup(
     url='https://github.com/fogleman/pg',
     packages=['pg'],
     install_requires=[
+        'numpy',
         'Pillow',
         'PyOpenGL',
     ],
@@ -0,0 +1,23 @@
+from pg.bvh import BVH
+import numpy as np
+import pg
+import unittest
+
+class BVHTest(unittest.TestCase):
+    def test_raycast(self):
+        bvh = BVH([(0, 0, 0), (1, 0, 0), (0, 0, 1)])
+        self.assertEqual(bvh.raycast((0.25, 1, 0.25), (0, -1, 0)), (1.0, 0))
+        self.assertEqual(bvh.height(0.25, 0.25), 0.0)
+        self.assertIsNone(bvh.raycast((2, 1, 2), (0, -1, 0)))
+    def test_empty(self):
+        for mesh in [[], np.zeros((0, 3)), pg.Mesh()]:
+            bvh = BVH(mesh)
+            self.assertIsNone(bvh.raycast((0, 1, 0), (0, -1, 0)))
+            self.assertFalse(bvh.any_hit((0, 1, 0), (0, -1, 0)))
+            self.assertIsNone(bvh.height(0, 0))
+            t, index = bvh.intersect(np.zeros((2, 3)), np.ones((2, 3)))
+            self.assertTrue(np.isinf(t).all())
+            self.assertEqual(index.tolist(), [-1, -1])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+from OpenGL.GL import (GL_VERTEX_ATTRIB_ARRAY_BUFFER_BINDING,
+    glGetVertexAttribiv, glIsVertexArray)
+from ctypes import byref, c_int
+from tests.util import GLTestCase
+import pg
+import unittest
+
+COUNT = 20
+
+class ContextTest(GLTestCase):
+    def setUp(self):
+        super(ContextTest, self).setUp()
+        self.context = pg.Context(pg.SolidColorProgram())
+        self.context.matrix = pg.Matrix()
+        self.tracer = pg.GLTracer()
+        self.tracer.start()
+    def tearDown(self):
+        self.tracer.stop()
+        self.context.delete()
+        super(ContextTest, self).tearDown()
+    def vertex_arrays(self):
+        return self.context._vertex_arrays.get(self.window, {}).values()
+    def bound_buffer(self):
+        location = self.context._attributes['position'].location
+        result = c_int()
+        self.context._bind(None)
+        glGetVertexAttribiv(
+            location, GL_VERTEX_ATTRIB_ARRAY_BUFFER_BINDING, byref(result))
+        self.context._unbind(None)
+        return result.value
+    def test_many_meshes(self):
+        spheres = [pg.Sphere(1, 0.5, (i, 0, 0)) for i in xrange(COUNT)]
+        for sphere in spheres:
+            sphere.draw(self.context)
+        frame = self.tracer.end_frame()
+        self.assertEqual(frame.calls['glGenVertexArrays'], COUNT)
+        for sphere in spheres:
+            sphere.draw(self.context)
+        frame = self.tracer.end_frame()
+        self.assertEqual(frame.draw_calls, COUNT)
+        self.tracer.assert_budget(glGenVertexArrays=0,
+            glDeleteVertexArrays=0, glVertexAttribPointer=0)
+    def test_grow(self):
+        vb = pg.VertexBuffer([(0, 0, 0)] * 3)
+        self.context.position = vb
+        for i in xrange(100):
+            self.context.draw()
+            self.assertEqual(self.bound_buffer(), vb.handle)
+            vb.extend([(0, 0, 0)] * 3)
+        # one vertex array object per allocation of the buffer
+        frame = self.tracer.end_frame()
+        self.assertEqual(frame.calls['glGenVertexArrays'], vb.version + 1)
+        # the objects of the grown buffer's old handles are swept
+        self.assertTrue(len(self.vertex_arrays()) <= 32)
+        vb.delete()
+    def test_delete(self):
+        pg.Sphere(1).draw(self.context)
+        handles = self.vertex_arrays()
+        self.assertEqual(len(handles), 1)
+        self.context.delete()
+        self.assertFalse(glIsVertexArray(int(handles[0])))
+        self.assertEqual(self.vertex_arrays(), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+from tests.util import GLTestCase
+import os
+import pg
+import unittest
+
+FONTS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/Library/Fonts/Arial.ttf',
+    'C:/Windows/Fonts/arial.ttf',
+]
+
+class FontTest(GLTestCase):
+    def setUp(self):
+        super(FontTest, self).setUp()
+        paths = [x for x in FONTS if os.path.exists(x)]
+        if not paths:
+            self.skipTest('no font found')
+        self.font = pg.Font(self.window, 0, paths[0], 16)
+    def tearDown(self):
+        self.font.delete()
+        super(FontTest, self).tearDown()
+    def test_encodings(self):
+        # utf-8, unicode and latin-1 text
+        for text in ['caf\xc3\xa9', u'caf\xe9', 'na\xeff']:
+            run = self.font.generate_run(text)
+            self.assertEqual(len(run.data), 4 * 6)
+            self.font.render(text)
+        self.assertEqual(self.font.generate_run('caf\xc3\xa9').size,
+            self.font.generate_run(u'caf\xe9').size)
+
+if __name__ == '__main__':
+    unittest.main()
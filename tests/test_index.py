@@ -0,0 +1,27 @@
+from tests.util import GLTestCase
+import numpy as np
+import pg
+import unittest
+
+class IndexTest(GLTestCase):
+    def test_index(self):
+        positions = [(0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 0)]
+        uvs = [(0, 0), (1, 0), (0, 1), (0, 0)]
+        index_buffer, vertex_buffer, slices = pg.index(positions, [], uvs)
+        self.assertEqual(index_buffer.size, 4)
+        self.assertEqual(vertex_buffer.vertex_count, 3)
+        self.assertEqual(vertex_buffer.components, 5)
+        self.assertEqual([x and x.components for x in slices], [3, None, 2])
+    def test_empty(self):
+        for args in [([], [], []), (np.zeros((0, 3)), [], np.zeros((0, 2)))]:
+            index_buffer, vertex_buffer, slices = pg.index(*args)
+            self.assertEqual(index_buffer.size, 0)
+            self.assertEqual(vertex_buffer.vertex_count, 0)
+            self.assertEqual(slices, [None, None, None])
+        context = pg.Context(pg.SolidColorProgram())
+        context.matrix = pg.Matrix()
+        pg.Mesh().draw(context)
+        context.delete()
+
+if __name__ == '__main__':
+    unittest.main()
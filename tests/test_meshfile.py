@@ -0,0 +1,113 @@
+from pg import meshfile
+from pg.util import vertex_array
+import numpy as np
+import os
+import pg
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+POSITIONS = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 0, 0), (1, 1, 0), (0, 1, 0)]
+NORMALS = [(0, 0, 1)] * 6
+UVS = [(0, 0), (1, 0), (1, 1), (0, 0), (1, 1), (0, 1)]
+
+OBJ = '''v 0 0 0
+v 1 0 0
+v 1 1 0
+v 0 1 0
+vt 0 0
+vt 1 0
+vt 1 1
+vt 0 1
+vn 0 0 1
+f 1/1/1 2/2/1 3/3/1
+f 1/1/1 3/3/1 4/4/1
+'''
+
+def write_stl(path):
+    with open(path, 'wb') as fp:
+        fp.write('\x00' * 80)
+        fp.write(struct.pack('<I', 2))
+        for i in xrange(0, 6, 3):
+            fp.write(struct.pack('<3f', *NORMALS[i]))
+            for v in POSITIONS[i:i + 3]:
+                fp.write(struct.pack('<3f', *v))
+            fp.write(struct.pack('<H', 0))
+
+def write_obj(path):
+    with open(path, 'w') as fp:
+        fp.write(OBJ)
+
+def write_pickle(path):
+    pg.Mesh(POSITIONS, NORMALS, UVS).save_pickle(path)
+
+class MeshFileTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    def path(self, name):
+        return os.path.join(self.directory, name)
+    def convert(self, name, write, *args):
+        source = self.path(name)
+        write(source)
+        output = self.path('output.mesh')
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            meshfile.main([source, output] + list(args))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        return meshfile.load_any(source), output
+    def assert_same(self, expected, actual):
+        for a, b, n in [
+            (expected.positions, actual.positions, 3),
+            (expected.normals, actual.normals, 3),
+            (expected.uvs, actual.uvs, 2)]:
+            self.assertTrue(np.allclose(vertex_array(a, n), b))
+    def check(self, name, write, *args):
+        source, output = self.convert(name, write, *args)
+        self.assert_same(source, pg.load_mesh(output))
+        self.assertEqual(len(pg.load_mesh(output).positions), 6)
+        return output
+    def test_stl(self):
+        self.check('input.stl', write_stl)
+    def test_obj(self):
+        self.check('input.obj', write_obj)
+    def test_pickle(self):
+        self.check('input.pickle', write_pickle)
+    def test_mesh(self):
+        output = self.check('input.pickle', write_pickle, '--index')
+        copy = self.path('copy.mesh')
+        shutil.copy(output, copy)
+        source, output = self.convert('input.mesh',
+            lambda path: shutil.copy(copy, path), '--compress', 'zlib')
+        self.assert_same(source, pg.load_mesh(output))
+    def test_zlib(self):
+        self.check('input.obj', write_obj, '--compress', 'zlib')
+    @unittest.skipIf(meshfile.lz4 is None, 'lz4 is not installed')
+    def test_lz4(self):
+        self.check('input.obj', write_obj, '--compress', 'lz4')
+    def test_index(self):
+        output = self.check('input.pickle', write_pickle, '--index')
+        f = meshfile.MeshFile(output)
+        self.assertEqual(len(f.read('position')), 4)
+        self.assertEqual(f.read('index').tolist(), [0, 1, 2, 0, 2, 3])
+    def test_index_zlib(self):
+        self.check('input.stl', write_stl, '--index', '--compress', 'zlib')
+    def test_truncated(self):
+        for args in [(), ('--compress', 'zlib')]:
+            _, output = self.convert('input.obj', write_obj, *args)
+            with open(output, 'rb') as fp:
+                data = fp.read()
+            for size in [len(data) - 1, meshfile.HEADER.size + 1, 4]:
+                with open(output, 'wb') as fp:
+                    fp.write(data[:size])
+                with self.assertRaises(Exception):
+                    pg.load_mesh(output)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+from pg import obj
+import numpy as np
+import unittest
+
+VERTICES = 'v 0 0 0\nv 1 0 0\nv 0 1 0\nvt 0 0\nvt 1 0\nvt 0 1\nvn 0 0 1\n'
+TRIANGLE = [[0, 0, 0], [1, 0, 0], [0, 1, 0]]
+
+class OBJTest(unittest.TestCase):
+    def parse(self, faces, vertices=VERTICES):
+        return obj.parse_obj_arrays(vertices + faces)
+    def check(self, faces, vertices=VERTICES, uvs=0):
+        positions, normals, result = self.parse(faces, vertices)
+        self.assertEqual(positions.tolist(), TRIANGLE)
+        self.assertEqual(normals.tolist(), [[0, 0, 1]] * 3)
+        self.assertEqual(len(result), uvs)
+        return result
+    def test_formats(self):
+        self.check('f 1 2 3\n')
+        self.check('f 1/1 2/2 3/3\n', uvs=3)
+        self.check('f 1//1 2//1 3//1\n')
+        self.check('f 1/1/1 2/2/1 3/3/1\n', uvs=3)
+        self.check('f -3 -2 -1\n')
+    def test_mixed_corners(self):
+        uvs = self.check('f 1/1 2 3/3/1\n', uvs=3)
+        self.assertEqual(uvs.tolist(), [[0, 0], [0, 0], [0, 1]])
+        self.check('f 1/1/1 2 3/3\n', uvs=3)
+        self.check('f 1/1/ 2/2/ 3/3/\n', uvs=3)
+    def test_whitespace(self):
+        self.check('  f 1 2 3\n', '  ' + VERTICES.replace('\n', '\n  '))
+        self.check('\tf\t1 2 3 \n')
+        self.check('f 1 2 3\r\n', VERTICES.replace('\n', '\r\n'))
+    def test_comments(self):
+        self.check('# f 4 5 6\nf 1 2 3 # a triangle\n',
+            VERTICES.replace('\n', ' # comment\n'))
+    def test_quads(self):
+        positions, _, _ = self.parse(
+            'f 1 2 3 4\nf 1 2 3\n', VERTICES + 'v 1 1 0\n')
+        self.assertEqual(len(positions), 9)
+    def test_invalid(self):
+        for faces, vertices in [
+            ('f 1 2 x\n', VERTICES),
+            ('f 1/1 2/2 3/x\n', VERTICES),
+            ('f 1 2 3\n', 'v 0 0 0\nv 1 0 x\nv 0 1 0\n')]:
+            with self.assertRaises(ValueError):
+                self.parse(faces, vertices)
+    def test_empty(self):
+        positions, normals, uvs = self.parse('', '')
+        self.assertEqual(positions.shape, (0, 3))
+        self.assertEqual(uvs.shape, (0, 2))
+
+if __name__ == '__main__':
+    unittest.main()
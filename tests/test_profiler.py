@@ -0,0 +1,117 @@
+from OpenGL.GL import glFinish
+from pg.profiler import Frame
+from tests.util import GLTestCase
+import json
+import os
+import pg
+import shutil
+import tempfile
+import unittest
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.profiler = pg.Profiler(frames=100, gpu=False)
+    def add_frames(self, count):
+        for i in xrange(count):
+            frame = Frame(i, i)
+            frame.duration = (i + 1) / 1000.0
+            frame.add(frame.phases, 'draw', i, frame.duration / 2, 0)
+            self.profiler.history.append(frame)
+    def test_sections(self):
+        profiler = self.profiler
+        profiler.begin_frame()
+        with profiler.section('update'):
+            with profiler.gpu_section('draw'):
+                pass
+        profiler.end_frame()
+        frame, = profiler.frames()
+        self.assertEqual(sorted(frame.phases), ['draw', 'update'])
+        self.assertEqual([x[0] for x in frame.events], ['draw', 'update'])
+        self.assertEqual(frame.gpu, {})
+    def test_nesting(self):
+        self.profiler.begin('a')
+        self.profiler.begin('b')
+        with self.assertRaises(Exception):
+            self.profiler.end('a')
+    def test_ring_buffer(self):
+        self.add_frames(150)
+        self.assertEqual(len(self.profiler.frames()), 100)
+        self.assertEqual(self.profiler.frames()[0].index, 50)
+    def test_pending(self):
+        self.add_frames(3)
+        self.profiler.history[1].pending = 1
+        self.assertEqual([x.index for x in self.profiler.frames()], [0, 2])
+    def test_percentiles(self):
+        self.add_frames(100)
+        stats = self.profiler.percentiles((0, 50, 100))
+        self.assertEqual(sorted(stats), ['draw', 'frame'])
+        self.assertAlmostEqual(stats['frame'][0], 0.001)
+        self.assertAlmostEqual(stats['frame'][1], 0.0505)
+        self.assertAlmostEqual(stats['frame'][2], 0.1)
+        self.assertAlmostEqual(stats['draw'][2], 0.05)
+    def test_report(self):
+        self.assertEqual(self.profiler.report().split(),
+            ['ms', 'p50', 'p95', 'p99'])
+        self.add_frames(100)
+        lines = self.profiler.report((50,)).split('\n')
+        self.assertEqual(lines[0].split(), ['ms', 'p50'])
+        self.assertEqual(lines[1].split(), ['frame', '50.50'])
+        self.assertEqual(lines[2].split(), ['draw', '25.25'])
+    def test_save_trace(self):
+        self.add_frames(2)
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'trace.json')
+            self.profiler.save_trace(path)
+            with open(path) as fp:
+                events = json.load(fp)['traceEvents']
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([x['name'] for x in events],
+            ['thread_name'] * 2 + ['frame', 'draw'] * 2)
+        frame, draw = events[4:]
+        self.assertEqual(frame['args'], {'index': 1})
+        self.assertEqual((frame['ts'], frame['dur']), (1e6, 2000))
+        self.assertEqual((draw['tid'], draw['dur']), (0, 1000))
+
+class ProfilerGLTest(GLTestCase):
+    def setUp(self):
+        super(ProfilerGLTest, self).setUp()
+        self.profiler = pg.Profiler()
+        if not self.profiler.gpu:
+            self.skipTest('timer queries are not supported')
+        self.profiler.start()
+    def tearDown(self):
+        self.profiler.stop()
+        self.profiler.delete()
+        super(ProfilerGLTest, self).tearDown()
+    def frame(self, *windows):
+        self.app.profiler.begin_frame()
+        for window in windows:
+            window.use()
+            with self.profiler.gpu_section('clear'):
+                window.clear()
+            glFinish()
+        self.app.profiler.end_frame()
+    def test_gpu_section(self):
+        for i in xrange(3):
+            self.frame(self.window)
+        self.profiler.collect()
+        frames = self.profiler.frames()
+        self.assertEqual(len(frames), 3)
+        self.assertTrue(all('clear' in x.gpu for x in frames))
+        self.assertTrue('gpu:clear' in self.profiler.samples())
+        # finished queries are reused
+        self.assertEqual(len(self.profiler.queries[self.window]), 1)
+    def test_closed_window(self):
+        window = pg.Window(size=(64, 64), visible=False)
+        self.frame(self.window, window)
+        self.app.remove_window(window)
+        pg.glfw.destroy_window(window.handle)
+        self.window.use()
+        self.profiler.collect()
+        self.assertEqual(len(self.profiler.frames()), 1)
+        self.assertEqual(self.profiler.pending.keys(), [self.window])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+from pg import stl
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+TRIANGLE = [(0, 0, 0), (1, 0, 0), (0, 1, 0)]
+
+ASCII = '''solid triangle
+facet normal 0 0 1
+outer loop
+vertex 0 0 0
+vertex 1 0 0
+vertex 0 1 0
+endloop
+endfacet
+endsolid triangle
+'''
+
+def binary(header='\x00' * 80, padding=''):
+    data = [header.ljust(80, ' '), struct.pack('<I', 1)]
+    data.append(struct.pack('<3f', 0, 0, 1))
+    for vertex in TRIANGLE:
+        data.append(struct.pack('<3f', *vertex))
+    data.append(struct.pack('<H', 0))
+    return ''.join(data) + padding
+
+class STLTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    def write(self, data):
+        path = os.path.join(self.directory, 'mesh.stl')
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        return path
+    def check(self, data):
+        path = self.write(data)
+        mesh = stl.load_stl(path)
+        self.assertEqual(mesh.positions.tolist(), map(list, TRIANGLE))
+        self.assertEqual(mesh.normals.tolist(), [[0, 0, 1]] * 3)
+        self.assertEqual(stl.STL(path).positions, TRIANGLE)
+    def test_binary(self):
+        self.check(binary())
+        positions, _ = stl.load_binary_stl(binary())
+        self.assertEqual(positions.tolist(), map(list, TRIANGLE))
+    def test_padding(self):
+        self.check(binary(padding='\x00' * 7))
+        positions, _ = stl.load_binary_stl(binary(padding='\x00' * 7))
+        self.assertEqual(len(positions), 3)
+    def test_solid_header(self):
+        # some exporters start binary headers with "solid" too
+        self.check(binary('solid exported'))
+    def test_ascii(self):
+        self.check(ASCII)
+        self.check('  ' + ASCII)
+    def test_truncated(self):
+        for data in [binary()[:-1], binary()[:80], '']:
+            path = self.write(data)
+            with self.assertRaises(Exception) as context:
+                stl.load_stl(path)
+            self.assertEqual(str(context.exception), 'invalid binary STL')
+            with self.assertRaises(Exception):
+                stl.STL(path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+from tests.util import GLTestCase
+import pg
+import unittest
+
+COUNT = 5
+
+class GLTracerTest(GLTestCase):
+    def setUp(self):
+        super(GLTracerTest, self).setUp()
+        self.context = pg.Context(pg.SolidColorProgram())
+        self.sphere = pg.Sphere(2, 0.5, (0, 0, 0))
+        # the first draw creates the buffers and uniforms before the tracer
+        # starts, so that it has to patch existing uniforms too
+        self.draw()
+        self.tracer = pg.GLTracer()
+        self.tracer.start()
+    def tearDown(self):
+        self.tracer.stop()
+        super(GLTracerTest, self).tearDown()
+    def draw(self):
+        self.window.clear()
+        matrix = pg.Matrix().perspective(65, 1, 0.1, 100)
+        for i in xrange(COUNT):
+            self.context.matrix = pg.Matrix().translate((i, 0, -10)) * matrix
+            self.sphere.draw(self.context)
+    def frame(self):
+        self.draw()
+        return self.tracer.end_frame()
+    def test_budget(self):
+        self.frame()
+        frame = self.frame()
+        self.assertEqual(frame.draw_calls, COUNT)
+        self.assertEqual(frame.vertices, COUNT * len(self.sphere.positions))
+        self.assertEqual(frame.calls['glUniformMatrix4fv'], COUNT)
+        self.tracer.assert_budget(draw_calls=COUNT, bytes_uploaded=0,
+            glUseProgram=COUNT, glBufferData=0)
+        with self.assertRaises(AssertionError):
+            self.tracer.assert_budget(draw_calls=COUNT - 1)
+    def test_redundant(self):
+        frame = self.frame()
+        # the program is bound again by every draw after the first
+        self.assertEqual(frame.calls['glUseProgram'], COUNT)
+        self.assertEqual(frame.redundant['glUseProgram'], COUNT - 1)
+        # only the matrix changes, so the unchanged color is not sent again
+        self.assertEqual(frame.redundant['glUniformMatrix4fv'], 0)
+        self.assertEqual(sum(count for name, count in frame.calls.iteritems()
+            if name.startswith('glUniform')), COUNT)
+    def test_stop(self):
+        original = pg.core.glDrawArrays
+        self.assertTrue(getattr(original, 'traced', False))
+        self.tracer.stop()
+        self.assertFalse(getattr(pg.core.glDrawArrays, 'traced', False))
+        self.assertFalse(any(getattr(x, 'traced', False)
+            for funcs in pg.core.Uniform.FUNCS.itervalues() for x in funcs))
+        calls = self.tracer.frame.total_calls
+        self.draw()
+        self.assertEqual(self.tracer.frame.total_calls, calls)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+from ctypes import c_float, sizeof
+from OpenGL.GL import GL_ARRAY_BUFFER, glBindBuffer, glGetBufferSubData
+from tests.util import GLTestCase
+import numpy as np
+import pg
+import unittest
+
+def read(vb):
+    data = (c_float * (vb.vertex_count * vb.components))()
+    glBindBuffer(GL_ARRAY_BUFFER, vb.handle)
+    glGetBufferSubData(GL_ARRAY_BUFFER, 0, sizeof(data), data)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    return np.array(data).reshape((-1, vb.components))
+
+class VertexBufferTest(GLTestCase):
+    def grow(self, vb, expected=[]):
+        expected = list(expected)
+        for i in xrange(10):
+            data = [(i, j, -j) for j in xrange(i + 1)]
+            vb.extend(data)
+            expected.extend(data)
+            self.assertEqual(vb.vertex_count, len(expected))
+            self.assertTrue(vb.vertex_capacity >= vb.vertex_count)
+            self.assertTrue(np.array_equal(read(vb), expected))
+        vb.delete()
+        self.assertIsNone(vb.handle)
+        vb.delete()
+    def test_extend(self):
+        self.grow(pg.VertexBuffer([(0, 0, 0)]), [(0, 0, 0)])
+    def test_extend_empty(self):
+        self.grow(pg.VertexBuffer())
+    def test_extend_on_host(self):
+        vb = pg.VertexBuffer()
+        vb.resize = vb.resize_on_host
+        self.grow(vb)
+    def test_delete(self):
+        buffers = [pg.VertexBuffer([(0, 0, 0)]), pg.IndexBuffer([0, 1, 2])]
+        for buffer in buffers:
+            buffer.delete()
+            self.assertIsNone(buffer.handle)
+
+if __name__ == '__main__':
+    unittest.main()
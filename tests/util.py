@@ -0,0 +1,20 @@
+import os
+os.environ.setdefault('LIBGL_ALWAYS_SOFTWARE', '1')
+
+import pg
+import unittest
+
+class GLTestCase(unittest.TestCase):
+    '''Runs each test with a hidden window, or skips it when no OpenGL
+    context can be created.
+    '''
+    def setUp(self):
+        try:
+            self.app = pg.App()
+            self.window = pg.Window(size=(64, 64), visible=False)
+        except Exception:
+            self.skipTest('no OpenGL context available')
+    def tearDown(self):
+        self.app.remove_window(self.window)
+        pg.glfw.destroy_window(self.window.handle)
+        pg.App.instance = None